@@ -18,6 +18,7 @@ void hexBinDump(const uint8_t*, const uint8_t&);
 
 void setup() {
   Serial.begin(115200);
+  Serial.println(F("[RF] Moistensor receiver"));  // banner for the port auto-detection of the server
   setupReceiver(rxPin);
   pinMode(ledPin, OUTPUT);
 }
@@ -0,0 +1,91 @@
+""" Micro-benchmark of protocolHandler.parsePacket against the per-field regex parser of v0.3
+
+    Usage: python benchmarkParser.py [number of packets] [number of devices]
+"""
+import random, re, sys, time
+from protocolHandler import parsePacket
+from remoteDevice import (
+    RemoteDevice,
+    RemotePacket,
+    RemotePacketCalibration,
+    RemotePacketMeasurement,
+    RemotePacketError
+)
+
+
+def parsePacketV03(msg: str) -> RemotePacket:
+    """ Parser of v0.3 kept as the reference: about ten uncompiled searches per packet """
+    preambule = re.search('\\[D\\d+PRv\\d+-\\d+\\]', msg)
+    def safeParseInt(vStr: str, default: int = 0) -> int:
+        n = default
+        try:
+            n = int(vStr)
+        except:
+            pass
+        return n
+    if preambule:
+        preambuleStr = preambule.group()
+        device = RemoteDevice(id=safeParseInt(re.search('D\\d+', preambuleStr).group()[1:]))
+        protocolVersion = safeParseInt(re.search('PRv\\d+', preambuleStr).group()[3:])
+        body = msg[preambule.start() + len(preambuleStr):]
+        type = safeParseInt(re.search('-\\d+\\]', preambuleStr).group()[1:-1])
+        if type == 1:  # measurement update
+            timeSpan = re.search('t\\d+(h|m)', body).group()
+            return RemotePacketMeasurement(device, protocolVersion, type, measurement=safeParseInt(re.search('m\\d+', body).group()[1:]),
+                                           deviceTimeStamp=safeParseInt(timeSpan[1:-1]) * (1 if timeSpan[-1] == 'm' else 60),
+                                           voltage=safeParseInt(re.search('v(\\d+|\\?)', body).group()[1:]))
+        elif type == 2:  # calibration update
+            timeSpan = re.search('t\\d+(h|m)', body).group()
+            return RemotePacketCalibration(device, protocolVersion, type, calibDry=safeParseInt(re.search('cd\\d+', body).group()[2:]),
+                                           calibWet=safeParseInt(re.search('cw\\d+', body).group()[2:]),
+                                           deviceTimeStamp=safeParseInt(timeSpan[1:-1]) * (1 if timeSpan[-1] == 'm' else 60),
+                                           voltage=safeParseInt(re.search('v(\\d+|\\?)', body).group()[1:]),
+                                           voltageMin=safeParseInt(re.search('vn(\\d+|\\?)', body).group()[2:]),
+                                           voltageMax=safeParseInt(re.search('vx(\\d+|\\?)', body).group()[2:]),
+                                           intervalIdx=safeParseInt(re.search('idx\\d+', body).group()[3:]),
+                                           interval=safeParseInt(re.search('int\\d+', body).group()[3:]),
+                                           first=bool(re.search('f\\d', body).group()[1:]))
+    return RemotePacketError(None, -1, -1, msg)
+
+
+def syntheticLog(packets: int, devices: int = 30, seed: int = 0) -> list:
+    """ Serial lines as printed by the receiver, every 20th packet is a calibration """
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(packets):
+        device = rnd.randrange(devices)
+        voltage = rnd.choice(['?', str(rnd.randint(2800, 4200))])
+        if i % 20 == 0:
+            lines.append('> [D{0}PRv1-2] v{1} t{2}m vn? vx? cd{3} cw{4} idx2 int5 f{5}\n'
+                         .format(device, voltage, i, rnd.randint(300, 400), rnd.randint(150, 250), rnd.randint(0, 1)))
+        else:
+            lines.append('> [D{0}PRv1-1] v{1} t{2}{3} m{4}\n'
+                         .format(device, voltage, i % 60, rnd.choice('mh'), rnd.randint(150, 400)))
+    return lines
+
+
+def measure(parser, lines: list, repeat: int = 3) -> float:
+    """ Best packets/second out of several runs """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            parser(line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+if __name__ == '__main__':
+    packets = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    lines = syntheticLog(packets, devices)
+
+    for line in lines[:1000]:  # both parsers have to agree (apart from the 'first' flag v0.3 always parsed as True)
+        a, b = parsePacket(line), parsePacketV03(line)
+        assert type(a) == type(b) and a.remoteDevice == b.remoteDevice and str(a)[27:].split(', First')[0] == str(b)[27:].split(', First')[0], line
+
+    old = measure(parsePacketV03, lines)
+    new = measure(parsePacket, lines)
+    print('{0} packets, {1} devices'.format(packets, devices))
+    print('v0.3 parser:     {0:>10.0f} packets/s'.format(old))
+    print('current parser:  {0:>10.0f} packets/s ({1:.1f}x)'.format(new, new / old))
@@ -0,0 +1,186 @@
+import contextlib, datetime as dt, io, json, os, os.path as op, platform, subprocess, tempfile, time
+import click
+from collections.abc import Callable
+from typing import Dict, List
+from fleetSimulator import SimulatedFleet
+from protocolHandler import parsePacket
+from deviceManager import DeviceManager
+from fileLogger import FileLogger
+
+BACKENDS = {'memory': '', 'journal': 'bench.pickle', 'sqlite': 'bench.sqlite'}
+CASES = ('parse', 'store', 'filelog', 'telegram')
+
+
+def percentile(sortedValues: List[float], p: float) -> float:
+    return sortedValues[min(len(sortedValues) - 1, int(p / 100 * len(sortedValues)))]
+
+
+def measure(fn: Callable, items: list, rate: float = 0) -> Dict[str, float]:
+    """ Calls fn with every item, at the given rate (items per second, 0 - back to back).
+
+        Latency of an item is counted from the time it was due, so falling behind the rate shows up in the
+        percentiles as queueing delay.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for i, item in enumerate(items):
+        due = start + i / rate if rate else time.perf_counter()
+        wait = due - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        fn(item)
+        latencies.append(time.perf_counter() - due)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'items': len(items), 'seconds': elapsed, 'throughput': len(items) / elapsed,
+            'p50_us': percentile(latencies, 50) * 1e6, 'p90_us': percentile(latencies, 90) * 1e6,
+            'p99_us': percentile(latencies, 99) * 1e6, 'max_us': latencies[-1] * 1e6}
+
+
+def fleetLines(devices: int, count: int, seed: int, firstDevice: int = 1) -> List[str]:
+    stream = SimulatedFleet(devices, seed, malformedRate=0.01, duplicateRate=0.02, firstDevice=firstDevice).lines()
+    return [next(stream) for _ in range(count)]
+
+
+def benchParse(lines: List[str], rate: float, workdir: str) -> Dict[str, Dict[str, float]]:
+    return {'parse': measure(parsePacket, lines, rate)}
+
+
+def benchStore(lines: List[str], rate: float, workdir: str, backend: str, history: int, devices: int, seed: int) -> Dict[str, Dict[str, float]]:
+    """ handleMessageReceived on top of history packets stored beforehand, and the time to load them. The memory
+        backend keeps the history only as long as the manager lives, so it has no load row
+    """
+    filename = op.join(workdir, BACKENDS[backend]) if BACKENDS[backend] else ''
+    results = dict()
+    with contextlib.redirect_stdout(io.StringIO()):  # parse errors are printed
+        manager = DeviceManager(filename)
+        if history:
+            fsync = getattr(manager.storage, 'fsync', None)
+            if fsync is not None:  # filling is not measured, spare the disk
+                manager.storage.fsync = False
+            for line in fleetLines(devices, history, seed + 1):
+                manager.handleMessageReceived(line)
+            if fsync is not None:
+                manager.storage.fsync = fsync
+            if filename:
+                manager.close()
+                start = time.perf_counter()
+                manager = DeviceManager(filename)
+                results['load_' + backend] = {'items': history, 'seconds': time.perf_counter() - start}
+        results['store_' + backend] = measure(manager.handleMessageReceived, lines, rate)
+        manager.close()
+    return results
+
+
+def benchFileLog(lines: List[str], rate: float, workdir: str) -> Dict[str, Dict[str, float]]:
+    results = dict()
+    for name, buffered in (('filelog', False), ('filelog_buffered', True)):
+        logger = FileLogger(op.join(workdir, name + '.txt'), buffered=buffered)
+        results[name] = measure(logger.log, lines, rate)
+        logger.close()
+    return results
+
+
+def benchTelegram(lines: List[str], rate: float, workdir: str, devices: int, chats: int, sendLatency: float) -> Dict[str, Dict[str, float]]:
+    """ TelegramBot.handlePacketReceived with every chat monitoring every device and messages sent right away,
+        Telegram is replaced by a stub taking sendLatency seconds per message
+    """
+    from botobj import TelegramBot, SubscribedChat
+    sent = []
+    def send(chatId: int, msg: str):
+        time.sleep(sendLatency)
+        sent.append(chatId)
+
+    manager = DeviceManager('')
+    with contextlib.redirect_stdout(io.StringIO()):
+        packets = [manager.handleMessageReceived(line) for line in lines]
+    packets = [p for p in packets if p is not None and p.remoteDevice is not None]
+    bot = TelegramBot('123456:benchmark', op.join(workdir, 'tgbot.sqlite'), manager, digestWindow=0)
+    bot.broadcaster.send = send
+    for chatId in range(1, chats + 1):
+        bot.addSubscribedChat(chatId)
+        for device in range(1, devices + 1):
+            bot.subscribedChats[chatId].appendDevice(device)
+            bot.subscribers[device] = bot.subscribers.get(device, frozenset()) | {chatId}
+
+    results = {'telegram': measure(bot.handlePacketReceived, packets, rate)}
+    results['telegram']['queued'] = bot.broadcaster.pending + len(sent)
+    results['telegram']['delivered'] = len(sent)
+    bot.broadcaster.stop(timeout=0)
+    bot.digest.stop()
+    bot.graphRenderer.close()
+    return results
+
+
+def gitRevision() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=op.dirname(op.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def printComparison(results: Dict[str, Dict[str, float]], baseline: dict) -> None:
+    print('\nCompared to {0} ({1}):'.format(baseline['revision'], baseline['date']))
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if not old or 'throughput' not in result or 'throughput' not in old:
+            continue
+        print('  {0:<18} throughput {1:>6.2f}x   p99 {2:>6.2f}x'.format(
+            name, result['throughput'] / old['throughput'], result['p99_us'] / old['p99_us'] if old['p99_us'] else 0))
+
+
+@click.command()
+@click.option('--cases', default=','.join(CASES), help='comma separated: ' + ', '.join(CASES))
+@click.option('--backends', default=','.join(BACKENDS), help='storages of the store case: ' + ', '.join(BACKENDS))
+@click.option('--devices', type=int, default=100, help='number of simulated devices')
+@click.option('--packets', type=int, default=20000, help='number of measured lines per case')
+@click.option('--history', type=int, default=0, help='packets stored before measuring the store case')
+@click.option('--rate', type=float, default=0, help='lines per second fed to each case; 0 - back to back')
+@click.option('--chats', type=int, default=10, help='chats monitoring every device in the telegram case')
+@click.option('--send-latency', type=float, default=0.05, help='seconds the stubbed telegram takes per message')
+@click.option('--seed', type=int, default=0)
+@click.option('--save', type=click.Path(dir_okay=False), help='write the results as JSON')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='JSON results of an earlier run to compare with')
+def main(cases, backends, devices, packets, history, rate, chats, send_latency, seed, save, compare):
+    """ Measures throughput and latency percentiles of the server ingest path stages """
+    lines = fleetLines(devices, packets, seed)
+    results = dict()
+    with tempfile.TemporaryDirectory() as workdir:
+        for case in cases.split(','):
+            if case == 'parse':
+                results.update(benchParse(lines, rate, workdir))
+            elif case == 'store':
+                for backend in backends.split(','):
+                    results.update(benchStore(lines, rate, workdir, backend, history, devices, seed))
+            elif case == 'filelog':
+                results.update(benchFileLog(lines, rate, workdir))
+            elif case == 'telegram':
+                results.update(benchTelegram(lines, rate, workdir, devices, chats, send_latency))
+            else:
+                raise click.BadParameter('Unknown case: {0}'.format(case))
+
+    print('{0} lines, {1} devices, history {2}, rate {3}'.format(packets, devices, history, rate if rate else 'max'))
+    for name, result in results.items():
+        if 'throughput' in result:
+            print('  {0:<18} {1:>10.0f} /s   p50 {2:>9.1f}us   p90 {3:>9.1f}us   p99 {4:>9.1f}us   max {5:>9.1f}us'.format(
+                name, result['throughput'], result['p50_us'], result['p90_us'], result['p99_us'], result['max_us']))
+        else:
+            print('  {0:<18} {1:>10.3f} s for {2} packets'.format(name, result['seconds'], result['items']))
+
+    report = {'revision': gitRevision(), 'date': dt.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'machine': platform.machine(),
+              'parameters': {'devices': devices, 'packets': packets, 'history': history, 'rate': rate,
+                             'chats': chats, 'sendLatency': send_latency, 'seed': seed},
+              'results': results}
+    if compare:
+        with open(compare) as file:
+            printComparison(results, json.load(file))
+    if save:
+        with open(save, 'w') as file:
+            json.dump(report, file, indent=2)
+        print('Results saved to {0}'.format(save))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import hashlib, os, os.path as op, pickle, sqlite3, threading, types
+from collections import defaultdict
+from typing import Any, DefaultDict, Dict, Hashable, List, Set, Tuple
+from telegram.ext import BasePersistence
+from telegram.ext.utils.promise import Promise
+from telegram.ext.utils.types import ConversationDict
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class KeyedPersistence(BasePersistence):
+    """ Bot persistence in an SQLite table of (section, key) -> pickled value.
+
+        Every user data, chat data and conversation state is a row of its own, so is every entry of the dicts kept
+        in bot_data (e.g. bot_data['subscribedChats'][chat_id]); other bot_data values take a row per key.
+        Changes are collected and committed in a single transaction every commitInterval seconds, and only the rows
+        whose pickle differs from the stored one are written.
+
+        bot_data entries are mutated in place by the handlers, so the ones checked for changes are those keyed by
+        the ids of the user and the chat of each update, the added and removed ones, and the ones passed to
+        markChanged(). Everything is compared on flush().
+
+        A file written by PicklePersistence (the given one or '<name>.pickle' next to it) is imported on first use.
+    """
+    def __new__(cls, *args, **kwargs):
+        instance = super().__new__(cls, *args, **kwargs)
+        # bot_data holds no Bot references, so skip the deep copy PTB makes of it on every update
+        object.__setattr__(instance, 'update_bot_data', types.MethodType(cls.update_bot_data, instance))
+        return instance
+
+    def __init__(self, filename: str, commitInterval: float = 1):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True, store_callback_data=False)
+        self.fileName: str = filename
+        self.commitInterval: float = commitInterval
+
+        self._lock = threading.Lock()  # guards the pending changes
+        self._commitLock = threading.Lock()  # one commit at a time
+        self._pending: Dict[Tuple[str, Any], bytes | None] = dict()  # (section, key) -> pickle, None - delete
+        self._candidates: Set[Hashable] = set()  # keys of the bot_data dicts entries to be checked
+        self._botData: Dict | None = None
+        self._botDataTouched: bool = False
+        self._digests: Dict[Tuple[str, Any], bytes] = dict()  # of the stored rows
+        self._sectionKeys: DefaultDict[str, Set] = defaultdict(set)  # keys stored in each section
+
+        self._userData: DefaultDict[int, Dict] = defaultdict(dict)
+        self._chatData: DefaultDict[int, Dict] = defaultdict(dict)
+        self._loadedBotData: Dict = dict()
+        self._conversations: Dict[str, ConversationDict] = dict()
+
+        legacy = self._legacyFile()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                 '(section TEXT NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL, PRIMARY KEY (section, key))')
+        self._connection.commit()
+        self._load()
+        if legacy:
+            self._import(legacy)
+
+        self._closed = threading.Event()
+        self._committer = threading.Thread(target=self._commitPeriodically, name='KeyedPersistence', daemon=True)
+        self._committer.start()
+
+    def _legacyFile(self) -> str | None:
+        """ PicklePersistence file to import, the given file itself is moved to '<name>.bak' first """
+        if op.exists(self.fileName) and op.getsize(self.fileName):
+            with open(self.fileName, 'rb') as file:
+                if file.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+                    return None
+            os.replace(self.fileName, self.fileName + '.bak')
+            return self.fileName + '.bak'
+        legacy = op.splitext(self.fileName)[0] + '.pickle'
+        return legacy if legacy != self.fileName and op.exists(legacy) and not op.exists(self.fileName) else None
+
+    def _load(self) -> None:
+        for section, key, value in self._connection.execute('SELECT section, key, value FROM entries'):
+            key, data = pickle.loads(key), pickle.loads(value)
+            self._digests[(section, key)] = _digest(value)
+            self._sectionKeys[section].add(key)
+            if section == 'user':
+                self._userData[key] = data
+            elif section == 'chat':
+                self._chatData[key] = data
+            elif section == 'bot':  # a dict stands for the entries in its own section, possibly loaded already
+                if isinstance(data, dict):
+                    self._loadedBotData.setdefault(key, dict())
+                else:
+                    self._loadedBotData[key] = data
+            elif section.startswith('bot:'):
+                self._loadedBotData.setdefault(section[4:], dict())[key] = data
+            elif section.startswith('conversation:'):
+                self._conversations.setdefault(section[13:], dict())[key] = data
+
+    def _import(self, filename: str) -> None:
+        print('Importing bot state from {0}'.format(filename))
+        with open(filename, 'rb') as file:
+            data = pickle.load(file)
+        for userId, userData in (data.get('user_data') or dict()).items():
+            self._userData[userId] = userData
+            self._stage('user', userId, userData)
+        for chatId, chatData in (data.get('chat_data') or dict()).items():
+            self._chatData[chatId] = chatData
+            self._stage('chat', chatId, chatData)
+        for name, conversation in (data.get('conversations') or dict()).items():
+            self._conversations[name] = dict(conversation)
+            for key, state in conversation.items():
+                self._stage('conversation:' + name, key, state)
+        self._loadedBotData.update(data.get('bot_data') or dict())
+        self._pending.update(self._botDataChanges(self._loadedBotData, set(), full=True))
+        self._commit()
+
+    def get_user_data(self) -> DefaultDict[int, Dict]:
+        return defaultdict(dict, self._userData)
+
+    def get_chat_data(self) -> DefaultDict[int, Dict]:
+        return defaultdict(dict, self._chatData)
+
+    def get_bot_data(self) -> Dict:
+        return self._loadedBotData
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        return dict(self._conversations.get(name, dict()))
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: object | None) -> None:
+        new_state = self._plainState(new_state)
+        with self._lock:
+            if new_state is None:
+                self._pending[('conversation:' + name, key)] = None
+            else:
+                self._stage('conversation:' + name, key, new_state)
+
+    @staticmethod
+    def _plainState(state: object | None) -> object | None:
+        """ A run_async handler leaves an (old state, Promise) pair, possibly nested, which cannot be pickled: the
+            result is used if it is done, the old state otherwise. ConversationHandler stores the result once resolved
+        """
+        while isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise):
+            oldState, promise = state
+            result = promise.result(0) if promise.done.is_set() and promise.exception is None else None
+            state = result if result is not None else oldState
+        return state
+
+    def update_user_data(self, user_id: int, data: Dict) -> None:
+        with self._lock:
+            self._candidates.add(user_id)
+            self._stage('user', user_id, data)
+
+    def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        with self._lock:
+            self._candidates.add(chat_id)
+            self._stage('chat', chat_id, data)
+
+    def update_bot_data(self, data: Dict) -> None:
+        """ Called with the same dict after every update, the changed entries are looked for on commit """
+        with self._lock:
+            self._botData = data
+            self._botDataTouched = True
+
+    def markChanged(self, *keys: Hashable) -> None:
+        """ Entries of the bot_data dicts under these keys have been changed outside of the update handlers """
+        with self._lock:
+            self._candidates.update(keys)
+            self._botDataTouched = True
+
+    def flush(self) -> None:
+        """ Compares and writes everything, then stops the periodic commits """
+        self._closed.set()
+        self._committer.join()
+        with self._lock:
+            if self._botData is not None:
+                self._pending.update(self._botDataChanges(self._botData, set(), full=True))
+        self._commit()
+
+    def _stage(self, section: str, key: Any, value: Any) -> None:
+        """ Adds the value to the pending changes if it differs from the stored one """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._digests.get((section, key)) != _digest(data):
+            self._pending[(section, key)] = data
+        else:  # back to the stored value before the change has been committed
+            self._pending.pop((section, key), None)
+
+    def _botDataChanges(self, botData: Dict, candidates: Set[Hashable], full: bool) -> Dict[Tuple[str, Any], bytes | None]:
+        changes = dict()
+        def check(section: str, key: Any, value: Any):
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if self._digests.get((section, key)) != _digest(data):
+                changes[(section, key)] = data
+
+        present = set()
+        for name, value in list(botData.items()):
+            if isinstance(value, dict):
+                check('bot', name, dict())  # keeps an empty dict
+                section = 'bot:' + name
+                present.add(section)
+                keys = set(value.keys())
+                stored = self._sectionKeys.get(section, set())
+                for key in (keys if full else (keys - stored) | (keys & candidates)):
+                    check(section, key, value[key])
+                for key in stored - keys:
+                    changes[(section, key)] = None
+            else:
+                check('bot', name, value)
+        for key in self._sectionKeys.get('bot', set()) - set(botData.keys()):
+            changes[('bot', key)] = None
+        for section in [s for s in self._sectionKeys if s.startswith('bot:') and s not in present]:
+            for key in self._sectionKeys[section]:
+                changes[(section, key)] = None
+        return changes
+
+    def _commit(self) -> None:
+        with self._commitLock:
+            with self._lock:
+                pending, self._pending = self._pending, dict()
+                candidates, self._candidates = self._candidates, set()
+                botData, touched, self._botDataTouched = self._botData, self._botDataTouched, False
+            if touched and botData is not None:
+                try:
+                    pending.update(self._botDataChanges(botData, candidates, full=False))
+                except RuntimeError:  # changed by a handler meanwhile, try again next time
+                    with self._lock:
+                        self._candidates |= candidates
+                        self._botDataTouched = True
+            if not pending:
+                return
+
+            writes = [(section, pickle.dumps(key), data) for (section, key), data in pending.items() if data is not None]
+            deletes = [(section, pickle.dumps(key)) for (section, key), data in pending.items() if data is None]
+            with self._connection:  # single transaction
+                self._connection.executemany('INSERT OR REPLACE INTO entries (section, key, value) VALUES (?, ?, ?)', writes)
+                self._connection.executemany('DELETE FROM entries WHERE section = ? AND key = ?', deletes)
+            for (section, key), data in pending.items():
+                if data is None:
+                    self._digests.pop((section, key), None)
+                    self._sectionKeys[section].discard(key)
+                else:
+                    self._digests[(section, key)] = _digest(data)
+                    self._sectionKeys[section].add(key)
+
+    def _commitPeriodically(self) -> None:
+        while not self._closed.wait(self.commitInterval):
+            try:
+                self._commit()
+            except Exception as e:
+                print('Exception raised when saving bot state:\n\t>>{0}'.format(str(e)))
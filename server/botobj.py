@@ -12,13 +12,15 @@ from telegram.ext import (
     MessageHandler,
     Filters,
     ConversationHandler,
-    CallbackContext,
-    PicklePersistence,
-    BasePersistence
+    CallbackContext
 )
 from telegram.ext.utils.types import BD
-from remoteDevice import RemotePacket, RemoteDevice
+from remoteDevice import RemotePacket, RemotePacketCalibration, RemotePacketError, RemoteDevice
 from deviceManager import DeviceManager
+from broadcastEngine import BroadcastEngine
+from notificationDigest import DigestCoalescer
+from graphRenderer import GraphRenderer
+from botPersistence import KeyedPersistence
 
 try:
     from config import *
@@ -42,21 +44,29 @@ class TGUser:
 
 
 class SubscribedChat:
+    digestWindow: float | None = None  # chats persisted before digests have been introduced use the bot default
+
     def __init__(self, chat_id: int):
         self.chat_id: int = chat_id
-        self.deviceList: List[RemoteDevice] = []
+        self.deviceList: Set[RemoteDevice] = set()
+        self.digestWindow: float | None = None  # seconds, None - bot default
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.deviceList = set(self.deviceList)  # chats persisted with a list of devices
 
     def appendDevice(self, device: RemoteDevice | int):
-        self.deviceList.append(RemoteDevice(device) if type(device) == int else device)
+        self.deviceList.add(RemoteDevice(device) if type(device) == int else device)
 
     def removeDevice(self, device: RemoteDevice | int):
-        self.deviceList.remove(device)
+        self.deviceList.discard(device)
 
 
 class TelegramBot:
-    def __init__(self, _token: str, persistenseFileName: str, deviceManager: DeviceManager | None):
+    def __init__(self, _token: str, persistenseFileName: str, deviceManager: DeviceManager | None, digestWindow: float = 0):
         self.TOKEN: str = _token
         self.deviceManager = deviceManager if deviceManager else DeviceManager()
+        self.digestWindow: float = digestWindow  # seconds to collect packets for a digest, 0 - send every packet
 
         self.WAITING_FOR_PASSWORD,\
             self.IN_MAIN_STATE,\
@@ -66,9 +76,20 @@ class TelegramBot:
         self.SEND_MESSAGE_ATTEMPTS = 3
         self.SEND_MESSAGE_REATTEMPT_DELAY = 0.5  # in seconds
 
-        self.persistence: PicklePersistence = PicklePersistence(filename=persistenseFileName)
+        self.persistence: KeyedPersistence = KeyedPersistence(persistenseFileName)
         self.updater: Updater = Updater(self.TOKEN, persistence=self.persistence)
         self.dispatcher: Dispatcher = self.updater.dispatcher
+        self.broadcaster: BroadcastEngine = BroadcastEngine(lambda chatId, msg: self.updater.bot.send_message(chatId, msg),
+                                                            maxAttempts=self.SEND_MESSAGE_ATTEMPTS,
+                                                            baseDelay=self.SEND_MESSAGE_REATTEMPT_DELAY)
+        self.digest: DigestCoalescer = DigestCoalescer(self.broadcaster.submit, self.chatDigestWindow, self.deviceCalibration)
+        self.graphRenderer: GraphRenderer = GraphRenderer(self.deviceManager)
+        # Device id -> ids of the chats monitoring it. The sets are replaced rather than modified,
+        # so routing a packet never iterates a set changed by a handler thread
+        self.subscribers: Dict[int, frozenset] = dict()
+        for schat in self.subscribedChats.values():
+            for device in schat.deviceList:
+                self.subscribers[device.id] = self.subscribers.get(device.id, frozenset()) | {schat.chat_id}
 
         self.dispatcher.add_handler(ConversationHandler(
             entry_points=[CommandHandler('start', self.start)],
@@ -81,6 +102,7 @@ class TelegramBot:
                     CommandHandler('devices', self.showDevices),
                     CommandHandler('visualize', self.visualizeDevice, pass_args=True),
                     CommandHandler('monitor', self.monitorDevice, pass_args=True),
+                    CommandHandler('digest', self.setDigestWindow, pass_args=True),
                     MessageHandler(Filters.text, self.mainMenuSink),
                 ],
                 self.IGNORE: []
@@ -112,6 +134,10 @@ class TelegramBot:
         self.updater.idle()
     def stopBot(self):
         self.updater.stop()
+        self.persistence.flush()  # Updater.stop() leaves it to the signal handler of idle()
+        self.digest.stop()
+        self.broadcaster.stop()
+        self.graphRenderer.close()
 
     def generatePassCode(self, usr: User) -> str:
         dg = hashlib.sha224(secrets.token_bytes(8) + str(usr.id).encode('utf-8')).digest()
@@ -131,7 +157,7 @@ class TelegramBot:
         if DEBUG:
             upd.message.reply_text('!!!DEBUG MODE ON!!! No authentication required!')
             self.authorizedUsers[upd.effective_user.id] = TGUser(upd.effective_user.id, upd.effective_chat.id, True)
-            self.subscribedChats[upd.message.chat_id] = SubscribedChat(upd.message.chat_id)
+            self.addSubscribedChat(upd.message.chat_id)
             return self.IN_MAIN_STATE
 
         upd.message.reply_text(
@@ -182,7 +208,7 @@ class TelegramBot:
 
         upd.message.reply_text(msg)
         self.authorizedUsers[upd.effective_user.id] = TGUser(upd.effective_user.id, upd.effective_chat.id, admin)
-        self.subscribedChats[upd.message.chat_id] = SubscribedChat(upd.message.chat_id)  # TODO: remove this as it needs to be handled smarter through user interaction
+        self.addSubscribedChat(upd.message.chat_id)  # TODO: remove this as it needs to be handled smarter through user interaction
 
         return self.IN_MAIN_STATE
 
@@ -201,15 +227,15 @@ class TelegramBot:
 
         repl = 'List of devices:\n'
         for (d, v) in self.deviceManager.devices.items():
+            v = v.summary  # consistent even if a packet of the device arrives meanwhile
             m = v.latestMeasurement
             c = v.latestCalibration
-            l = v.entries
             if m and c:
                 repl += '&gt; Device#{0}: <b>{2}</b> ({5}m ago) [{1} .. {3}] every {4}m ({6}m up)\n' \
                         '       {7} updates since {8}'\
                     .format(d.id, c.calibrationWet, m.measurement, c.calibrationDry, c.interval, round((dt.datetime.now() - m.timestamp).total_seconds() / 60),
                             m.deviceTimeStamp if m.timestamp > c.timestamp else c.deviceTimeStamp,
-                            len(l), str(min(l, key=lambda x:x.timestamp).timestamp.strftime('%Y-%m-%d %H:%M:%S')))
+                            v.count, str(v.firstTimestamp.strftime('%Y-%m-%d %H:%M:%S')))
             else:
                 repl += 'Device#{0}: None'.format(d.id)
         upd.message.reply_text(
@@ -218,23 +244,30 @@ class TelegramBot:
         return self.IN_MAIN_STATE
 
     def visualizeDevice(self, upd: Update, ctx: CallbackContext) -> int:
+        """ /visualize <device> [hours] """
         if not upd.message:
             return self.IN_MAIN_STATE
 
-        if len(ctx.args) != 1:
+        if len(ctx.args) not in (1, 2):
             upd.message.reply_text('Wrong number of arguments. Use /help to get more info')
             return self.IN_MAIN_STATE
         try:
             device = int(ctx.args[0])
+            window = dt.timedelta(hours=float(ctx.args[1])) if len(ctx.args) > 1 else None
+            assert window is None or window.total_seconds() > 0
         except:
             upd.message.reply_text('Wrong argument passed!')
             return self.IN_MAIN_STATE
+        # Rendered on a worker thread, the handler itself stays synchronous so the persisted state is a plain one
+        self.dispatcher.run_async(self.sendGraph, upd.message, device, window, update=upd)
+        return self.IN_MAIN_STATE
+
+    def sendGraph(self, message: Message, device: int, window: dt.timedelta | None) -> None:
         try:
-            img = self.deviceManager.deviceGraphMeasurements(device)
-            upd.message.reply_photo(img)
+            img = self.graphRenderer.render(device, window)
+            message.reply_photo(img)
         except Exception as e:
-            upd.message.reply_text('Failed to create graph. Exception: {0}'.format(e))
-        return self.IN_MAIN_STATE
+            message.reply_text('Failed to create graph. Exception: {0}'.format(e))
 
     def monitorDevice(self, upd: Update, ctx: CallbackContext) -> int:
         if not upd.message:
@@ -251,36 +284,63 @@ class TelegramBot:
 
         schat = self.subscribedChats[upd.effective_chat.id]
         if device in schat.deviceList:
-            self.subscribedChats[upd.effective_chat.id].removeDevice(device)
+            schat.removeDevice(device)
+            self.subscribers[device] = self.subscribers.get(device, frozenset()) - {schat.chat_id}
             upd.message.reply_text('You are not monitoring device#{0} anymore!'.format(device))
             return self.IN_MAIN_STATE
 
-        self.subscribedChats[upd.effective_chat.id].appendDevice(device)
+        schat.appendDevice(device)
+        self.subscribers[device] = self.subscribers.get(device, frozenset()) | {schat.chat_id}
         upd.message.reply_text('You are now monitoring device#{0}!'.format(device))
         return self.IN_MAIN_STATE
 
 
+    def setDigestWindow(self, upd: Update, ctx: CallbackContext) -> int:
+        if not upd.message:
+            return self.IN_MAIN_STATE
+
+        if len(ctx.args) != 1:
+            upd.message.reply_text('Wrong number of arguments. Use /help to get more info')
+            return self.IN_MAIN_STATE
+        try:
+            minutes = float(ctx.args[0])
+            assert minutes >= 0
+        except:
+            upd.message.reply_text('Wrong argument passed!')
+            return self.IN_MAIN_STATE
+
+        self.subscribedChats[upd.effective_chat.id].digestWindow = minutes * 60
+        if minutes:
+            upd.message.reply_text('Updates of monitored devices are sent as a digest every {0}m'.format(ctx.args[0]))
+        else:
+            upd.message.reply_text('Updates of monitored devices are sent right away')
+        return self.IN_MAIN_STATE
+
+    def addSubscribedChat(self, chatId: int) -> None:
+        """ (Re)creates the chat without any monitored devices """
+        previous = self.subscribedChats.get(chatId)
+        if previous:
+            for device in previous.deviceList:
+                self.subscribers[device.id] = self.subscribers.get(device.id, frozenset()) - {chatId}
+        self.subscribedChats[chatId] = SubscribedChat(chatId)
+
+    def chatDigestWindow(self, chatId: int) -> float:
+        schat = self.subscribedChats.get(chatId)
+        return schat.digestWindow if schat and schat.digestWindow is not None else self.digestWindow
+
+    def deviceCalibration(self, device: RemoteDevice) -> RemotePacketCalibration | None:
+        entry = self.deviceManager.devices.get(device)
+        return entry.latestCalibration if entry else None
+
     def broadcastMessageToChats(self, chatIds: List[int], msg: str) -> bool:
-        assert len(chatIds) < 1e3, 'Too large user list, cannot run multithreaded message sending. Contact developers!'
-        def sendMessage(chatId: int) -> bool:
-            for i in range(self.SEND_MESSAGE_ATTEMPTS):
-                try:
-                    m: Message = self.updater.bot.send_message(chat_id, msg)
-                    return True if m else False
-                except Exception as e:
-                    print('Exception raised when sending to chat_id={0} attempt#{2}:\n\t>>{1}'.format(chatId, str(e), i))
-                    time.sleep(self.SEND_MESSAGE_REATTEMPT_DELAY)
-            return False
-
-        threads = []
-        for chat_id in chatIds:
-            thr = threading.Thread(target=sendMessage, args=(chat_id,))
-            threads.append(thr)
-            thr.start()
-
-        for thr in threads:
-            thr.join()
+        """ Queues the message for every chat, sending happens on the broadcaster workers.
+            Returns False if the message has been dropped for any of the chats, e.g. as its queue was full
+        """
+        return self.broadcaster.broadcast(chatIds, msg)
 
     def handlePacketReceived(self, packet: RemotePacket) -> None:
-        ids = [schat.chat_id for schat in self.subscribedChats.values() if packet.remoteDevice in schat.deviceList]
-        self.broadcastMessageToChats(ids, str(packet))
\ No newline at end of file
+        if packet.remoteDevice is None or type(packet) == RemotePacketError:  # parse errors are for the log, not the chats
+            return
+        ids = self.subscribers.get(packet.remoteDevice.id)
+        if ids:
+            self.digest.handlePacket(packet, list(ids))
\ No newline at end of file
@@ -0,0 +1,173 @@
+import heapq, itertools, threading, time
+from collections import deque
+from collections.abc import Callable
+from typing import Any, Deque, Dict, Iterable, List, Tuple
+from telegram.error import BadRequest, ChatMigrated, RetryAfter, Unauthorized
+from metrics import TELEGRAM_SEND_LATENCY
+
+
+class TokenBucket:
+    """ Allows rate tokens per second with bursts of up to capacity tokens """
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """ Seconds until a token is available, 0 if there is one """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class BroadcastEngine:
+    """ Sends messages with a persistent pool of worker threads within Telegram flood limits.
+
+        Messages are queued per chat and delivered in order. Each chat has its own token bucket (one message per
+        second for private chats, 20 per minute for groups, which have negative ids) and all chats share the global
+        one (30 messages per second). RetryAfter reschedules the chat after the period requested by Telegram, other
+        transient errors are retried with exponential backoff, permanent errors (bot blocked, chat not found) drop
+        the message.
+    """
+    def __init__(self, send: Callable[[int, str], Any], workers: int = 4, globalRate: float = 30, chatRate: float = 1,
+                 groupRate: float = 20 / 60, maxAttempts: int = 3, baseDelay: float = 0.5, maxDelay: float = 60,
+                 maxPending: int = 100000):
+        self.send: Callable[[int, str], Any] = send
+        self.chatRate: float = chatRate
+        self.groupRate: float = groupRate
+        self.maxAttempts: int = maxAttempts
+        self.baseDelay: float = baseDelay
+        self.maxDelay: float = maxDelay
+        self.maxPending: int = maxPending
+
+        self.sent: int = 0
+        self.failed: int = 0
+        self.dropped: int = 0  # rejected because of maxPending
+        self.retries: int = 0
+
+        self._cond = threading.Condition()
+        self._globalBucket = TokenBucket(globalRate, globalRate)
+        self._chatBuckets: Dict[int, TokenBucket] = dict()
+        self._pending: Dict[int, Deque[List]] = dict()  # chat id -> [message, attempts made]
+        self._pendingCount: int = 0
+        self._ready: List[Tuple[float, int, int]] = []  # heap of (time, seq, chat id), a chat is either here or in work
+        self._seq = itertools.count()
+        self._stopping: bool = False
+        self._workers = [threading.Thread(target=self._work, name='BroadcastEngine-{0}'.format(i), daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def pending(self) -> int:
+        return self._pendingCount
+
+    def submit(self, chatId: int, msg: str) -> bool:
+        """ Queues a message without blocking, returns False if it has been dropped """
+        with self._cond:
+            if self._stopping or self._pendingCount >= self.maxPending:
+                self.dropped += 1
+                return False
+            queue = self._pending.get(chatId)
+            if queue is None:
+                queue = self._pending[chatId] = deque()
+                self._schedule(chatId, time.monotonic())
+            queue.append([msg, 0])
+            self._pendingCount += 1
+            self._cond.notify()
+        return True
+
+    def broadcast(self, chatIds: Iterable[int], msg: str) -> bool:
+        """ Queues the message for every chat, returns False if it has been dropped for any of them """
+        queued = [self.submit(chatId, msg) for chatId in chatIds]
+        return all(queued)
+
+    def stop(self, timeout: float | None = 10) -> None:
+        """ Stops accepting messages and waits up to timeout seconds for the queued ones to be sent """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def _schedule(self, chatId: int, when: float) -> None:
+        heapq.heappush(self._ready, (when, next(self._seq), chatId))
+
+    def _bucket(self, chatId: int) -> TokenBucket:
+        bucket = self._chatBuckets.get(chatId)
+        if bucket is None:
+            bucket = self._chatBuckets[chatId] = TokenBucket(self.groupRate if chatId < 0 else self.chatRate)
+        return bucket
+
+    def _take(self) -> Tuple[int, List] | None:
+        """ Waits for a chat allowed to send now and takes its first message, None once stopped and drained """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if not self._ready:
+                    if self._stopping:
+                        return None
+                    self._cond.wait()
+                    continue
+                when, _, chatId = self._ready[0]
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                heapq.heappop(self._ready)
+                chatBucket = self._bucket(chatId)
+                wait = max(chatBucket.delay(now), self._globalBucket.delay(now))
+                if wait:
+                    self._schedule(chatId, now + wait)
+                    continue
+                chatBucket.take()
+                self._globalBucket.take()
+                return chatId, self._pending[chatId][0]
+
+    def _done(self, chatId: int, outcome: str, retryIn: float | None = None) -> None:
+        """ Removes the message being sent to the chat unless it has to be retried, and schedules the chat again """
+        with self._cond:
+            if outcome == 'sent':
+                self.sent += 1
+            elif outcome == 'failed':
+                self.failed += 1
+            else:
+                self.retries += 1
+            queue = self._pending[chatId]
+            if retryIn is None:
+                queue.popleft()
+                self._pendingCount -= 1
+            if queue:
+                self._schedule(chatId, time.monotonic() + (retryIn or 0))
+            else:
+                del self._pending[chatId]
+            self._cond.notify()
+
+    def _work(self) -> None:
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            chatId, job = taken
+            msg, attempts = job
+            start = time.perf_counter()
+            try:
+                self.send(chatId, msg)
+                TELEGRAM_SEND_LATENCY.observe(time.perf_counter() - start)
+                self._done(chatId, 'sent')
+            except RetryAfter as e:  # flood limit hit, does not count as a failed attempt
+                self._done(chatId, 'retry', float(e.retry_after))
+            except (Unauthorized, BadRequest, ChatMigrated) as e:
+                print('Dropping message to chat_id={0}:\n\t>>{1}'.format(chatId, str(e)))
+                self._done(chatId, 'failed')
+            except Exception as e:
+                job[1] = attempts + 1
+                print('Exception raised when sending to chat_id={0} attempt#{2}:\n\t>>{1}'.format(chatId, str(e), attempts))
+                if job[1] < self.maxAttempts:
+                    self._done(chatId, 'retry', min(self.maxDelay, self.baseDelay * 2 ** attempts))
+                else:
+                    self._done(chatId, 'failed')
@@ -1,10 +1,12 @@
-import pickle, os.path as op
-import warnings
 from protocolHandler import parsePacket
-import datetime as dt, io
-from typing import Dict, List, Set, Tuple
-# import matplotlib, matplotlib.pyplot as plt
-# from matplotlib.dates import DateFormatter
+from packetStorage import PacketStorage, createStorage
+from packetHistory import PacketHistory
+from timeSeries import Rollup, RollupStore
+from packetDeduplicator import PacketDeduplicator
+from metrics import DUPLICATES, PACKETS_RECEIVED, PARSE_ERRORS, PARSE_LATENCY, PERSIST_LATENCY
+import datetime as dt, time
+from collections.abc import Callable
+from typing import Dict, Iterator, List, NamedTuple, Set, Tuple
 from remoteDevice import (
     RemoteDevice,
     RemotePacket,
@@ -13,86 +15,190 @@ from remoteDevice import (
     RemotePacketError
 )
 
+class DeviceSummary(NamedTuple):
+    """ Counters and latest packets of a device, replaced as a whole on every packet """
+    count: int = 0
+    firstTimestamp: dt.datetime | None = None
+    latestMeasurement: RemotePacketMeasurement | None = None
+    latestCalibration: RemotePacketCalibration | None = None
+
+
 class RemoteDeviceEntry:
-    def __init__(self, device: RemoteDevice):
+    """ Packets of a single device. Written by the ingest thread only, read by any thread without locking:
+        the summary is swapped by a single assignment and the history exposes a row only once all of its columns
+        have been written
+    """
+    def __init__(self, device: RemoteDevice, source: PacketStorage | None = None):
         self.device: RemoteDevice = device
-        self.entries: List[RemotePacket] = []
-        self._latestMeasurementIdx: int = -1
-        self._latestCalibrationIdx: int = -1
+        self.source: PacketStorage | None = source  # storage answering history queries, None if kept in memory
+        self.summary: DeviceSummary = DeviceSummary()
+        self._history: PacketHistory = PacketHistory(device)
+
+    def __setstate__(self, state: dict):
+        entries = state.get('entries', state.get('_entries'))
+        if entries is not None:  # entry pickled before the history has become columnar
+            self.__init__(state['device'], state.get('source'))
+            for entry in entries:
+                self.appendEntry(entry)
+            return
+        if 'summary' not in state:  # entry pickled before the summary has been introduced
+            state['summary'] = DeviceSummary(state.pop('count'), state.pop('firstTimestamp'),
+                                             state.pop('_latestMeasurement'), state.pop('_latestCalibration'))
+        self.__dict__.update(state)
+
+    def setSummary(self, count: int, firstTimestamp: dt.datetime | None,
+                   latestMeasurement: RemotePacketMeasurement | None, latestCalibration: RemotePacketCalibration | None):
+        """ Restores the in-memory state of an entry whose history is kept by its source """
+        self.summary = DeviceSummary(count, firstTimestamp, latestMeasurement, latestCalibration)
+
+    def attachSource(self, source: PacketStorage):
+        """ Hands the history over to the source, e.g. once it has been written to the database """
+        self.source = source
+        self._history = PacketHistory(self.device)
 
     def appendEntry(self, entry: RemotePacket):
+        if self.source is None:
+            self._history.append(entry)
+        count, firstTimestamp, latestMeasurement, latestCalibration = self.summary
         if type(entry) == RemotePacketMeasurement:
-            self._latestMeasurementIdx = len(self.entries)
+            latestMeasurement = entry
         if type(entry) == RemotePacketCalibration:
-            self._latestCalibrationIdx = len(self.entries)
-        self.entries.append(entry)
+            latestCalibration = entry
+        if firstTimestamp is None or entry.timestamp < firstTimestamp:
+            firstTimestamp = entry.timestamp
+        self.summary = DeviceSummary(count + 1, firstTimestamp, latestMeasurement, latestCalibration)
+
+    @property
+    def count(self) -> int:
+        return self.summary.count
+    @property
+    def firstTimestamp(self) -> dt.datetime | None:
+        return self.summary.firstTimestamp
+
+    @property
+    def history(self) -> PacketHistory:
+        return self.source.deviceHistory(self.device) if self.source else self._history
+
+    @property
+    def entries(self) -> List[RemotePacket]:
+        return self.history.packets()
 
     @property
     def anyCalibration(self) -> bool:
-        return self._latestCalibrationIdx >= 0
+        return self.summary.latestCalibration is not None
     @property
     def anyMeasurement(self) -> bool:
-        return self._latestMeasurementIdx >= 0
+        return self.summary.latestMeasurement is not None
 
     @property
     def latestMeasurement(self) -> RemotePacket | None:
-        return self.entries[self._latestMeasurementIdx] if self.anyMeasurement else None
+        return self.summary.latestMeasurement
     @property
     def latestCalibration(self) -> RemotePacket | None:
-        return self.entries[self._latestCalibrationIdx] if self.anyCalibration else None
+        return self.summary.latestCalibration
+
+    def measurementsBetween(self, since: dt.datetime | None = None, until: dt.datetime | None = None) -> List[RemotePacketMeasurement]:
+        """ Measurements with since <= timestamp < until, any of the bounds can be omitted """
+        if self.source:
+            return self.source.deviceMeasurements(self.device, since, until)
+        return self._history.measurementsBetween(since, until)
+
+    def measurementChunks(self, since: dt.datetime | None = None, until: dt.datetime | None = None,
+                          rows: int = 1000) -> Iterator[List[RemotePacketMeasurement]]:
+        """ measurementsBetween in lists of up to rows measurements, created only as they are iterated """
+        if self.source:
+            return self.source.deviceMeasurementChunks(self.device, since, until, rows)
+        return self._history.measurementChunks(since, until, rows)
 
     @property
     def measurementsSinceLatestCalibration(self) -> List[RemotePacketMeasurement]:
-        if not self.anyCalibration or not self.anyMeasurement:
+        summary = self.summary
+        if summary.latestCalibration is None or summary.latestMeasurement is None:
             return []
-        return [e for e in self.entries if type(e) == RemotePacketMeasurement and e.timestamp >= self.latestCalibration.timestamp]
+        if self.source:
+            return self.source.deviceMeasurements(self.device, since=summary.latestCalibration.timestamp)
+        return self._history.measurementsSinceLatestCalibration()
 
 
 class DeviceManager:
-    def __init__(self, filename: str | None = ''):
+    """ Packets are handled by a single ingest thread, while any other thread may read the devices at the same time.
+
+        Readers take no locks and never block ingest: the devices dict is copied and replaced when a device
+        appears rather than modified, so iterating it is always safe, and the entries are safe to read as well
+        (see RemoteDeviceEntry). Reading entry.summary once gives a consistent view of a device.
+    """
+    def __init__(self, filename: str | None = '', duplicateWindow: float = 5):
         self.fileName = filename if filename else ''
-        self.devices: Dict[RemoteDevice, RemoteDeviceEntry] = dict()
-        if filename and op.exists(filename):
-            # TODO: use another database, as this is inefficient as hell if large number of entries
-            with open(filename, 'rb') as file:
-                self.devices = pickle.load(file)
+        self.deduplicator: PacketDeduplicator | None = PacketDeduplicator(duplicateWindow) if duplicateWindow > 0 else None
+        self.storage: PacketStorage = createStorage(self.fileName)
+        self._devices: Dict[RemoteDevice, RemoteDeviceEntry]
+        self._devices, packets = self.storage.load(RemoteDeviceEntry)
+        for packet in packets:  # packets received after the latest snapshot
+            try:
+                self._appendPacket(packet)
+            except (TypeError, ValueError) as e:  # a bad record must not keep the server from starting
+                print('Skipping journaled packet {0}:\n\t>>{1}'.format(packet, str(e)))
+        self.rollupStore: RollupStore = RollupStore(lambda device: self._devices[device].history)
+        self.packetListeners: List[Callable[[RemotePacket], None]] = []
+
+    @property
+    def devices(self) -> Dict[RemoteDevice, RemoteDeviceEntry]:
+        """ Snapshot of the known devices, must not be modified """
+        return self._devices
 
-    def handleMessageReceived(self, msg: str) -> RemotePacket:
+    def addPacketListener(self, listener: Callable[[RemotePacket], None]) -> None:
+        """ Listener is called with every packet once it has been stored, e.g. to invalidate caches """
+        self.packetListeners.append(listener)
+
+    def handleMessageReceived(self, msg: str) -> RemotePacket | None:
+        """ Stores the packet parsed from msg, returns None if it is a copy of a packet received recently """
+        start = time.perf_counter()
         packet = parsePacket(msg)
+        parsed = time.perf_counter()
+        PARSE_LATENCY.observe(parsed - start)
         if type(packet) == RemotePacketError:
-            print('Error when parsing packet: {0}'.format(packet.msg))
-
-        if not (packet.remoteDevice in self.devices):
-            self.devices[packet.remoteDevice] = RemoteDeviceEntry(packet.remoteDevice)
-        self.devices[packet.remoteDevice].appendEntry(packet)
+            PARSE_ERRORS.inc(packet.remoteDevice.id if packet.remoteDevice else '')
+            print('Error when parsing packet: {0}'.format(packet.msg.strip()))
+            return packet
+        try:
+            PacketHistory.checkRow(packet)  # before it is persisted, so every backend rejects the same packets
+        except (TypeError, ValueError) as e:
+            PARSE_ERRORS.inc(packet.remoteDevice.id)
+            print('Error when storing packet: {0}'.format(str(e)))
+            return RemotePacketError(packet.remoteDevice, packet.protocolVersion, packet.type, msg)
+        if self.deduplicator and self.deduplicator.isDuplicate(packet):
+            DUPLICATES.inc(packet.remoteDevice.id)
+            return None
 
-        self._updateDatabase()
+        self.storage.append(packet)  # stored first, so the history holds every packet the summary counts
+        entry = self._appendPacket(packet)
+        if self.storage.compactionDue:
+            self.storage.compact(self._devices)
+        self.rollupStore.add(packet, entry.count - 1)
+        PERSIST_LATENCY.observe(time.perf_counter() - parsed)
+        PACKETS_RECEIVED.inc(packet.remoteDevice.id)
+        for listener in self.packetListeners:
+            listener(packet)
 
         return packet
 
-    def _updateDatabase(self):
-        if not self.fileName:
-            return
-        with open(self.fileName, 'wb') as file:
-            pickle.dump(self.devices, file)
-
-    def deviceGraphMeasurements(self, device: RemoteDevice) -> io.BytesIO:
-        # deviceEntry = self.devices[device]
-        # packets = deviceEntry.measurementsSinceLatestCalibration
-        #
-        # x = [p.timestamp for p in packets]
-        # y = [p.measurement for p in packets]
-        # with warnings.catch_warnings():  # suppressing userwarning: running matplotlib not in main thread
-        #     warnings.filterwarnings('ignore')
-        #     fig, ax = plt.subplots()
-        # ax.plot(x, y)
-        #
-        # myFmt = DateFormatter("%m-%d %H:%M")
-        # ax.xaxis.set_major_formatter(myFmt)
-        # fig.autofmt_xdate()
-
-        buf = io.BytesIO()
-        # plt.savefig(buf, format='png')
-        buf.seek(0)
-
-        return buf
\ No newline at end of file
+    def deviceRollups(self, device: RemoteDevice, resolution: int, since: dt.datetime | None = None,
+                      until: dt.datetime | None = None) -> List[Rollup]:
+        """ Aggregated measurements in buckets of resolution seconds (one of ROLLUP_RESOLUTIONS) within [since, until) """
+        if device not in self.devices:
+            return []
+        return self.rollupStore.rollups(device, resolution, since, until)
+
+    def close(self) -> None:
+        """ Writes a final snapshot and releases the database files """
+        self.storage.close(self._devices)
+
+    def _appendPacket(self, packet: RemotePacket) -> RemoteDeviceEntry:
+        entry = self._devices.get(packet.remoteDevice)
+        if entry is None:
+            entry = RemoteDeviceEntry(packet.remoteDevice, self.storage.historySource)
+            devices = dict(self._devices)
+            devices[packet.remoteDevice] = entry
+            self._devices = devices  # published only once complete
+        entry.appendEntry(packet)
+        return entry
@@ -0,0 +1,137 @@
+import contextlib, io, os.path as op, random, tempfile, threading, time, traceback
+import click
+from typing import Dict, List
+from benchmarkSuite import BACKENDS, fleetLines, percentile
+from deviceManager import DeviceManager
+from remoteDevice import RemoteDevice
+from timeSeries import ROLLUP_RESOLUTIONS
+
+# ms, every write of the persistent backends hands the GIL over to the busy readers, which adds up to a few switch intervals
+MAX_P99 = {'memory': 1, 'journal': 50, 'sqlite': 50}
+
+
+class Reader(threading.Thread):
+    """ Reads the devices the way the bot handlers and the graph renderer do, checking what it sees never goes back
+        or falls apart
+    """
+    def __init__(self, manager: DeviceManager, stopping: threading.Event, seed: int):
+        super().__init__(name='Reader{0}'.format(seed), daemon=True)
+        self.manager: DeviceManager = manager
+        self.stopping: threading.Event = stopping
+        self.rnd: random.Random = random.Random(seed)
+        self.reads: int = 0
+        self.errors: List[str] = []
+        self._counts: Dict[RemoteDevice, int] = dict()
+
+    def run(self):
+        try:
+            while not self.stopping.is_set() and len(self.errors) < 10:
+                self.readOnce()
+                self.reads += 1
+        except Exception:
+            self.errors.append(traceback.format_exc())
+
+    def check(self, condition: bool, msg: str) -> None:
+        if not condition:
+            self.errors.append(msg)
+
+    def readOnce(self) -> None:
+        devices = self.manager.devices
+        self.check(len(devices) >= len(self._counts), 'devices disappeared')
+        for device, entry in devices.items():  # like /devices
+            summary = entry.summary
+            self.check(summary.count >= self._counts.get(device, 0), 'count of {0} went back'.format(device))
+            self._counts[device] = summary.count
+            m, c = summary.latestMeasurement, summary.latestCalibration
+            if m and c:
+                str(m.deviceTimeStamp if m.timestamp > c.timestamp else c.deviceTimeStamp)
+        if not devices:
+            return
+
+        device = self.rnd.choice(list(devices))
+        entry = devices[device]
+        kind = self.rnd.randrange(4)
+        if kind == 0:  # history holds every packet the summary has counted
+            count = entry.summary.count
+            rows = len(entry.history)
+            self.check(rows >= count, '{0}: {1} rows in history, {2} counted before'.format(device, rows, count))
+        elif kind == 1:
+            for p in entry.measurementsSinceLatestCalibration:
+                self.check(p.remoteDevice == device, 'measurement of another device')
+        elif kind == 2:
+            history = entry.history
+            for p in history.packets(max(0, len(history) - 50)):
+                self.check(p.remoteDevice == device, 'packet of another device')
+        else:  # like /visualize over a long window
+            self.manager.deviceRollups(device, self.rnd.choice(ROLLUP_RESOLUTIONS))
+
+
+def verifyRollups(manager: DeviceManager) -> List[str]:
+    """ Rollups built by the readers and updated by ingest meanwhile must match the history """
+    errors = []
+    for device, entry in manager.devices.items():
+        history = entry.history
+        expected = sum(1 for t in history.types if t == 1)
+        if device not in manager.rollupStore._series:
+            continue
+        for resolution in ROLLUP_RESOLUTIONS:
+            counted = sum(r.count for r in manager.deviceRollups(device, resolution))
+            if counted != expected:
+                errors.append('{0}: {1} measurements in {2}s rollups, {3} in history'.format(device, counted, resolution, expected))
+    return errors
+
+
+@click.command()
+@click.option('--backend', type=click.Choice(list(BACKENDS)), default='memory')
+@click.option('--devices', type=int, default=200, help='number of simulated devices')
+@click.option('--packets', type=int, default=100000, help='number of lines ingested')
+@click.option('--readers', type=int, default=4, help='threads reading the devices meanwhile')
+@click.option('--seed', type=int, default=0)
+@click.option('--max-p99', type=float, default=None,
+              help='ms, fails if ingesting a line takes longer at the 99th percentile, defaults to MAX_P99 of the backend')
+def main(backend, devices, packets, readers, seed, max_p99):
+    """ Ingests a simulated fleet as fast as possible while reader threads query the devices, then checks the
+        readers have seen consistent state and ingest has not been held up by them, and reports how both sides
+        have fared. The maximum latency is reported only: busy readers take the GIL from the ingest thread now
+        and then regardless of any locking
+    """
+    lines = fleetLines(devices, packets, seed)
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        manager = DeviceManager(op.join(workdir, BACKENDS[backend]) if BACKENDS[backend] else '')
+        if hasattr(manager.storage, 'fsync'):
+            manager.storage.fsync = False
+        stopping = threading.Event()
+        threads = [Reader(manager, stopping, seed + i) for i in range(readers)]
+        for thread in threads:
+            thread.start()
+
+        latencies = []
+        start = time.perf_counter()
+        for line in lines:
+            t = time.perf_counter()
+            manager.handleMessageReceived(line)
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+        stopping.set()
+        for thread in threads:
+            thread.join()
+        errors = [e for thread in threads for e in thread.errors] + verifyRollups(manager)
+        manager.close()
+
+    latencies.sort()
+    print('{0}: {1} lines from {2} devices, {3} readers'.format(backend, packets, devices, readers))
+    print('  ingest {0:>9.0f} lines/s   p50 {1:>8.1f}us   p99 {2:>8.1f}us   max {3:>9.1f}us'.format(
+        packets / elapsed, percentile(latencies, 50) * 1e6, percentile(latencies, 99) * 1e6, latencies[-1] * 1e6))
+    print('  reads  {0:>9.0f} /s'.format(sum(thread.reads for thread in threads) / elapsed))
+    for error in errors[:20]:
+        print('  ! ' + error.strip())
+    if errors:
+        raise SystemExit('{0} inconsistencies found'.format(len(errors)))
+    print('  no inconsistencies')
+    maxP99 = max_p99 if max_p99 is not None else MAX_P99[backend]
+    if percentile(latencies, 99) * 1e3 > maxP99:
+        raise SystemExit('p99 ingest latency is over {0}ms'.format(maxP99))
+
+
+if __name__ == '__main__':
+    main()
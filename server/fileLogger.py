@@ -1,9 +1,128 @@
-import datetime as dt
+import datetime as dt, gzip, os, os.path as op, shutil, threading, time
+from typing import List
+from metrics import FILELOG_LATENCY
+
 
 class FileLogger:
-    def __init__(self, path: str):
+    """ Appends timestamped messages to a file.
+
+        In buffered mode messages are collected in memory and written once flushBytes are pending or flushInterval
+        seconds have passed (also checked by a background timer, so quiet periods get flushed too). The file is
+        fsynced at most every fsyncInterval seconds (0 - on every write). The file can be rotated when it exceeds
+        maxBytes ('size') or when the date changes ('daily'); closed segments are renamed to '<path>.<time>' and
+        optionally gzipped in the background.
+    """
+    ROTATE_MODES = ('none', 'size', 'daily')
+
+    def __init__(self, path: str, buffered: bool = False, flushBytes: int = 64 * 1024, flushInterval: float = 5,
+                 fsyncInterval: float = 60, rotate: str = 'none', maxBytes: int = 16 * 1024 * 1024, compress: bool = False):
+        if rotate not in self.ROTATE_MODES:
+            raise ValueError('Unknown rotation mode: {0}'.format(rotate))
         self.path = path
+        self.buffered: bool = buffered
+        self.flushBytes: int = flushBytes
+        self.flushInterval: float = flushInterval
+        self.fsyncInterval: float = fsyncInterval
+        self.rotate: str = rotate
+        self.maxBytes: int = maxBytes
+        self.compress: bool = compress
+
+        self._lock = threading.Lock()
+        self._pending: List[str] = []
+        self._pendingBytes: int = 0
+        self._lastFlush: float = time.monotonic()
+        self._lastFsync: float = time.monotonic()
+        self._compressors: List[threading.Thread] = []
+        self._file = None
+        self._fileDate: dt.date = dt.date.today()
+        self._openFile()
+
+        self._closed = threading.Event()
+        self._timer: threading.Thread | None = None
+        if self.buffered:
+            self._timer = threading.Thread(target=self._flushPeriodically, name='FileLogger', daemon=True)
+            self._timer.start()
 
     def log(self, msg: str):
-        with open(self.path, 'a') as file:
-            file.write(str(dt.datetime.now()) + '\t' + msg)
\ No newline at end of file
+        start = time.perf_counter()
+        line = str(dt.datetime.now()) + '\t' + msg
+        with self._lock:
+            if self._file is None:
+                raise ValueError('Logging to a closed FileLogger')
+            self._pending.append(line)
+            self._pendingBytes += len(line)
+            if not self.buffered or self._pendingBytes >= self.flushBytes \
+                    or time.monotonic() - self._lastFlush >= self.flushInterval:
+                self._flush()
+        FILELOG_LATENCY.observe(time.perf_counter() - start)
+
+    def flush(self, fsync: bool = False) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._flush(fsync)
+
+    def close(self) -> None:
+        """ Writes out everything pending and waits for the segments being compressed """
+        self._closed.set()
+        if self._timer:
+            self._timer.join()
+        with self._lock:
+            if self._file is not None:
+                self._flush(fsync=True)
+                self._file.close()
+                self._file = None
+        for thread in self._compressors:
+            thread.join()
+
+    def _flush(self, fsync: bool = False) -> None:
+        if self._pending:
+            data = ''.join(self._pending)
+            self._pending = []
+            self._pendingBytes = 0
+            if self._rotationDue(len(data)):
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+        now = time.monotonic()
+        self._lastFlush = now
+        if fsync or now - self._lastFsync >= self.fsyncInterval:
+            os.fsync(self._file.fileno())
+            self._lastFsync = now
+
+    def _flushPeriodically(self) -> None:
+        while not self._closed.wait(self.flushInterval):
+            with self._lock:
+                if self._file is not None and time.monotonic() - self._lastFlush >= self.flushInterval:
+                    self._flush()
+
+    def _openFile(self) -> None:
+        self._file = open(self.path, 'a')
+        self._fileDate = dt.date.fromtimestamp(op.getmtime(self.path)) if op.getsize(self.path) else dt.date.today()
+
+    def _rotationDue(self, incomingBytes: int) -> bool:
+        if self.rotate == 'size':
+            return self._file.tell() > 0 and self._file.tell() + incomingBytes > self.maxBytes
+        if self.rotate == 'daily':
+            return self._file.tell() > 0 and dt.date.today() != self._fileDate
+        return False
+
+    def _rotate(self) -> None:
+        os.fsync(self._file.fileno())
+        self._file.close()
+        base = '{0}.{1}'.format(self.path, dt.datetime.now().strftime('%Y-%m-%dT%H-%M-%S'))
+        segment, suffix = base, 1
+        while op.exists(segment) or op.exists(segment + '.gz'):
+            segment, suffix = '{0}.{1}'.format(base, suffix), suffix + 1
+        os.replace(self.path, segment)
+        self._openFile()
+        if self.compress:
+            thread = threading.Thread(target=self._compressSegment, args=(segment,), name='FileLogger-gzip', daemon=True)
+            self._compressors = [t for t in self._compressors if t.is_alive()] + [thread]
+            thread.start()
+
+    @staticmethod
+    def _compressSegment(segment: str) -> None:
+        with open(segment, 'rb') as src, gzip.open(segment + '.gz.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(segment + '.gz.tmp', segment + '.gz')
+        os.remove(segment)
@@ -0,0 +1,107 @@
+import contextlib, heapq, io, os, random, sys, tempfile, time
+from typing import Iterator, List, Tuple
+
+
+class SimulatedDevice:
+    """ State of a single simulated sensor """
+    def __init__(self, id: int, rnd: random.Random):
+        self.id: int = id
+        self.interval: int = rnd.choice((1, 5, 10, 15, 30))  # minutes between measurements
+        self.intervalIdx: int = (1, 5, 10, 15, 30).index(self.interval)
+        self.calibrationDry: int = rnd.randint(330, 420)
+        self.calibrationWet: int = rnd.randint(150, 230)
+        self.dryness: float = rnd.random()  # 0 - just watered, 1 - dry
+        self.dryingRate: float = rnd.uniform(0.0002, 0.002)  # per minute
+        self.voltage: float = rnd.uniform(3900, 4200)  # mV, slowly drained
+        self.drainRate: float = rnd.uniform(0.002, 0.02)  # mV per minute
+        self.reportsVoltage: bool = rnd.random() < 0.8
+        self.lastLine: str | None = None
+
+    def voltageField(self, rnd: random.Random) -> str:
+        return str(int(self.voltage + rnd.gauss(0, 10))) if self.reportsVoltage else '?'
+
+    def calibration(self, minutes: int, rnd: random.Random, first: bool) -> str:
+        return '> [D{0}PRv1-2] v{1} t{2}m vn? vx? cd{3} cw{4} idx{5} int{6} f{7}\n'.format(
+            self.id, self.voltageField(rnd), minutes, self.calibrationDry, self.calibrationWet, self.intervalIdx,
+            self.interval, int(first))
+
+    def measurement(self, minutes: int, rnd: random.Random) -> str:
+        self.dryness += self.dryingRate * self.interval
+        if self.dryness > rnd.uniform(0.7, 1.2):  # watered
+            self.dryness = rnd.uniform(0, 0.1)
+        self.voltage = max(2800.0, self.voltage - self.drainRate * self.interval)
+        value = self.calibrationWet + (self.calibrationDry - self.calibrationWet) * min(1.0, self.dryness)
+        return '> [D{0}PRv1-1] v{1} t{2}m m{3}\n'.format(self.id, self.voltageField(rnd), minutes,
+                                                        max(0, int(value + rnd.gauss(0, 3))))
+
+
+class SimulatedFleet:
+    """ Endless stream of receiver lines from a fleet of sensors, reproducible for a given seed.
+
+        Each device starts with a calibration packet and then sends measurements at its own interval of simulated
+        minutes: moisture slowly drying out between random waterings, battery voltage draining with noise (or '?'
+        for devices without a voltage divider). Devices are recalibrated now and then. A malformedRate fraction of
+        the lines is corrupted (truncated, garbled, unknown packet type), a duplicateRate fraction repeats the
+        previous line of the device like a retransmission or a second receiver would.
+    """
+    def __init__(self, devices: int = 100, seed: int = 0, malformedRate: float = 0.01, duplicateRate: float = 0.02,
+                 recalibrationRate: float = 0.001, firstDevice: int = 1):
+        self.rnd: random.Random = random.Random(seed)
+        self.malformedRate: float = malformedRate
+        self.duplicateRate: float = duplicateRate
+        self.recalibrationRate: float = recalibrationRate
+        self.devices: List[SimulatedDevice] = [SimulatedDevice(firstDevice + i, self.rnd) for i in range(devices)]
+        self._due: List[Tuple[int, int, int]] = [(0, i, 0) for i in range(devices)]  # (minute, device index, packets sent)
+
+    def lines(self) -> Iterator[str]:
+        rnd = self.rnd
+        while True:
+            minutes, index, sent = heapq.heappop(self._due)
+            device = self.devices[index]
+            if sent and rnd.random() < self.duplicateRate and device.lastLine:
+                heapq.heappush(self._due, (minutes, index, sent))
+                yield device.lastLine
+                continue
+            if not sent or rnd.random() < self.recalibrationRate:
+                line = device.calibration(minutes, rnd, first=not sent)
+            else:
+                line = device.measurement(minutes, rnd)
+            device.lastLine = line
+            heapq.heappush(self._due, (minutes + (device.interval if sent else 0), index, sent + 1))
+            yield self._malformed(line) if rnd.random() < self.malformedRate else line
+
+    def _malformed(self, line: str) -> str:
+        rnd = self.rnd
+        kind = rnd.randrange(3)
+        if kind == 0:  # cut off in the middle
+            return line[:rnd.randrange(3, len(line) - 1)] + '\n'
+        if kind == 1:  # bit errors
+            chars = list(line.rstrip('\n'))
+            for _ in range(rnd.randint(1, 3)):
+                chars[rnd.randrange(len(chars))] = chr(rnd.randrange(33, 127))
+            return ''.join(chars) + '\n'
+        return line.replace('PRv1-', 'PRv1-' + str(rnd.randint(3, 9)), 1)  # unknown packet type
+
+
+if __name__ == '__main__':
+    # End-to-end run of main.handleSerialInput: parsing, deduplication, storage and the console output (discarded)
+    import main
+    from deviceManager import DeviceManager
+
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    packets = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    database = sys.argv[3] if len(sys.argv) > 3 else os.path.join(tempfile.mkdtemp(), 'fleet.pickle')
+
+    fleet = SimulatedFleet(devices)
+    stream = fleet.lines()
+    lines = [next(stream) for _ in range(packets)]
+    main.deviceManager = DeviceManager(database)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for line in lines:
+            main.handleSerialInput(line)
+    elapsed = time.perf_counter() - start
+    main.deviceManager.close()
+    print('{0} lines from {1} devices into {2}'.format(packets, devices, database))
+    print('handleSerialInput: {0:>10.0f} lines/s, {1} duplicates dropped'
+          .format(packets / elapsed, main.deviceManager.deduplicator.dropped))
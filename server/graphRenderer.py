@@ -0,0 +1,99 @@
+import datetime as dt, io, multiprocessing, threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Tuple
+from remoteDevice import RemoteDevice, RemotePacket
+from deviceManager import DeviceManager
+from timeSeries import ROLLUP_RESOLUTIONS, lttb
+
+
+def renderMeasurementsPng(timestamps: List[float], measurements: List[float], title: str) -> bytes:
+    """ Runs in a worker process, hence module level and plain lists of POSIX timestamps """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import DateFormatter
+
+    fig, ax = plt.subplots()
+    ax.plot([dt.datetime.fromtimestamp(t) for t in timestamps], measurements)
+    ax.set_title(title)
+    ax.xaxis.set_major_formatter(DateFormatter('%m-%d %H:%M'))
+    fig.autofmt_xdate()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+class GraphRenderer:
+    """ Renders measurement graphs in a process pool and caches the PNGs.
+
+        A graph is cached per (device, time window) together with the calibration epoch and the packets count
+        it has been rendered for; new packets of the device drop its graphs. Concurrent requests of the same graph
+        share a single rendering. Periods too long to plot every measurement are plotted from the means of the
+        finest rollups giving at most maxPoints buckets, and either series is LTTB-downsampled to maxPoints.
+    """
+    def __init__(self, deviceManager: DeviceManager, workers: int = 1, maxPoints: int = 2000, cacheSize: int = 64):
+        self.deviceManager: DeviceManager = deviceManager
+        self.maxPoints: int = maxPoints
+        self.cacheSize: int = cacheSize
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[Tuple[int, float | None], Tuple[float, int, Future]] = OrderedDict()
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        deviceManager.addPacketListener(self.invalidate)
+
+    def invalidate(self, packet: RemotePacket) -> None:
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == packet.remoteDevice.id]:
+                del self._cache[key]
+
+    def render(self, device: RemoteDevice | int, window: dt.timedelta | None = None, timeout: float = 60) -> io.BytesIO:
+        """ Graph of the measurements since the latest calibration, limited to the last window if given """
+        device = RemoteDevice(device) if type(device) == int else device
+        entry = self.deviceManager.devices.get(device)
+        if entry is None:
+            raise KeyError('Unknown device#{0}'.format(device.id))
+        summary = entry.summary
+        if summary.latestCalibration is None:
+            raise ValueError('Device#{0} has no calibration yet'.format(device.id))
+
+        key = (device.id, window.total_seconds() if window else None)
+        epoch, count = summary.latestCalibration.timestamp.timestamp(), summary.count
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[:2] == (epoch, count):
+                self._cache.move_to_end(key)
+                future = cached[2]
+            else:
+                future = None
+        if future is None:
+            since = summary.latestCalibration.timestamp
+            if window:
+                since = max(since, dt.datetime.now() - window)
+            x, y = self._series(device, since)
+            future = self._pool.submit(renderMeasurementsPng, x, y, str(device))
+            with self._lock:
+                self._cache[key] = (epoch, count, future)
+                while len(self._cache) > self.cacheSize:
+                    self._cache.popitem(last=False)
+        try:
+            return io.BytesIO(future.result(timeout))
+        except Exception:
+            with self._lock:
+                if self._cache.get(key, (None, None, None))[2] is future:
+                    del self._cache[key]
+            raise
+
+    def _series(self, device: RemoteDevice, since: dt.datetime) -> Tuple[List[float], List[float]]:
+        span = (dt.datetime.now() - since).total_seconds()
+        if span / ROLLUP_RESOLUTIONS[0] > self.maxPoints:
+            resolution = next((r for r in ROLLUP_RESOLUTIONS if span / r <= self.maxPoints), ROLLUP_RESOLUTIONS[-1])
+            rollups = self.deviceManager.deviceRollups(device, resolution, since=since)
+            x, y = [r.start.timestamp() for r in rollups], [r.measurementMean for r in rollups]
+        else:
+            packets = self.deviceManager.devices[device].measurementsBetween(since=since)
+            x, y = [p.timestamp.timestamp() for p in packets], [p.measurement for p in packets]
+        return lttb(x, y, self.maxPoints)
+
+    def close(self) -> None:
+        self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,163 @@
+import asyncio, time
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Callable
+from typing import Dict, List, Tuple
+from remoteDevice import RemotePacket, RemotePacketError
+from deviceManager import DeviceManager
+from serialMonitor import DataObtainer
+from metrics import QUEUE_LATENCY
+
+
+class StageStats:
+    """ Backpressure counters of a stage input queue """
+    def __init__(self, name: str, queue: asyncio.Queue):
+        self.name: str = name
+        self.queue: asyncio.Queue = queue
+        self.processed: int = 0
+        self.dropped: int = 0  # items rejected because the queue was full
+        self.failed: int = 0
+        self.maxDepth: int = 0
+
+    def asDict(self) -> Dict[str, int]:
+        return {'depth': self.queue.qsize(), 'maxDepth': self.maxDepth, 'capacity': self.queue.maxsize,
+                'processed': self.processed, 'dropped': self.dropped, 'failed': self.failed}
+
+
+class SourceStats:
+    """ Counters of a single obtainer, e.g. a serial port """
+    def __init__(self, name: str):
+        self.name: str = name
+        self.lines: int = 0
+        self.packets: int = 0
+        self.parseErrors: int = 0
+        self.duplicates: int = 0
+        self.dropped: int = 0  # lines rejected because the storage queue was full
+        self.failed: int = 0
+        self.lastReceived: float | None = None  # time.time() of the latest line
+
+    def asDict(self) -> Dict[str, int | float | None]:
+        return {'lines': self.lines, 'packets': self.packets, 'parseErrors': self.parseErrors,
+                'duplicates': self.duplicates, 'dropped': self.dropped, 'failed': self.failed, 'lastReceived': self.lastReceived}
+
+
+class IngestPipeline:
+    """ reader -> parser/storage -> notifiers, the stages are connected by bounded queues.
+
+        The reader only ever enqueues without waiting: when a queue is full the item is dropped and counted,
+        so a slow notifier (e.g. Telegram) can neither stall the serial port nor the other notifiers.
+        Blocking work (DeviceManager, notifiers) runs on a worker thread of each stage, so every stage handles its
+        items in order and DeviceManager is always called from the same single thread storing the packets.
+        Several obtainers (e.g. receivers on different serial ports) can feed the pipeline at once, each of them
+        gets its own counters.
+    """
+    def __init__(self, deviceManager: DeviceManager, queueSize: int = 10000):
+        self.deviceManager: DeviceManager = deviceManager
+        self.queueSize: int = queueSize
+        self.notifiers: Dict[str, Tuple[Callable[[str, RemotePacket], None], int]] = dict()
+        self.stages: Dict[str, StageStats] = dict()
+        self.sources: Dict[str, SourceStats] = dict()
+        self.obtainers: List[DataObtainer] = []
+        self._executors: Dict[str, ThreadPoolExecutor] = dict()  # single worker thread of each stage
+
+    def addNotifier(self, name: str, notifier: Callable[[str, RemotePacket], None], queueSize: int | None = None) -> None:
+        """ Registers a sink receiving the raw message and the packet parsed from it """
+        self.notifiers[name] = (notifier, queueSize if queueSize else self.queueSize)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: stage.asDict() for name, stage in self.stages.items()}
+
+    def sourceStats(self) -> Dict[str, Dict[str, int | float | None]]:
+        """ Counters of every source together with the health of its obtainer, e.g. serial reconnects """
+        stats = {name: source.asDict() for name, source in self.sources.items()}
+        for obtainer in self.obtainers:
+            stats.setdefault(obtainer.name, dict()).update(obtainer.stats())
+        return stats
+
+    def submit(self, msg: str, source: str = '') -> None:
+        """ Entry point of the readers, has to be called in the event loop. Never blocks """
+        if source not in self.sources:
+            self.sources[source] = SourceStats(source)
+        stats = self.sources[source]
+        stats.lines += 1
+        stats.lastReceived = time.time()
+        if not self._put(self.stages['storage'], (stats, msg, time.perf_counter())):
+            stats.dropped += 1
+
+    async def run(self, *obtainers: DataObtainer) -> None:
+        """ Runs until all the obtainers stop listening, the queued items are processed before returning """
+        self.stages = {'storage': StageStats('storage', asyncio.Queue(self.queueSize))}
+        for name, (_, queueSize) in self.notifiers.items():
+            self.stages[name] = StageStats(name, asyncio.Queue(queueSize))
+        self._executors = {name: ThreadPoolExecutor(max_workers=1, thread_name_prefix='IngestPipeline-' + name)
+                           for name in self.stages}
+        self.obtainers = list(obtainers)
+        for obtainer in obtainers:
+            self.sources[obtainer.name] = SourceStats(obtainer.name)
+
+        tasks = [asyncio.create_task(self._store())]
+        tasks += [asyncio.create_task(self._notify(name, notifier)) for name, (notifier, _) in self.notifiers.items()]
+        try:
+            results = await asyncio.gather(*[self._listen(obtainer) for obtainer in obtainers], return_exceptions=True)
+            for obtainer, result in zip(obtainers, results):
+                if isinstance(result, Exception):
+                    print('{0} stopped listening:\n\t>>{1}'.format(obtainer.name, str(result)))
+            for stage in self.stages.values():  # storage goes first, so nothing is added to the notifiers afterwards
+                await stage.queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for executor in self._executors.values():
+                executor.shutdown()  # lets the item being handled finish
+
+    async def _listen(self, obtainer: DataObtainer) -> None:
+        await obtainer.listenAsync(lambda msg: self.submit(msg, obtainer.name))
+
+    def _put(self, stage: StageStats, item) -> bool:
+        try:
+            stage.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            stage.dropped += 1
+            return False
+        stage.maxDepth = max(stage.maxDepth, stage.queue.qsize())
+        return True
+
+    async def _store(self) -> None:
+        stage = self.stages['storage']
+        while True:
+            source, msg, submitted = await stage.queue.get()
+            QUEUE_LATENCY.observe(time.perf_counter() - submitted)
+            try:
+                packet = await asyncio.get_running_loop().run_in_executor(self._executors['storage'],
+                                                                          self.deviceManager.handleMessageReceived, msg)
+                stage.processed += 1
+                if packet is None:
+                    source.duplicates += 1
+                elif type(packet) == RemotePacketError:
+                    source.parseErrors += 1
+                else:
+                    source.packets += 1
+            except Exception as e:
+                stage.failed += 1
+                source.failed += 1
+                print('Exception raised when storing message {0}:\n\t>>{1}'.format(msg.strip(), str(e)))
+                continue
+            finally:
+                stage.queue.task_done()
+            if packet is None:  # duplicate, has been handled already
+                continue
+            for name in self.notifiers:
+                self._put(self.stages[name], (msg, packet))
+
+    async def _notify(self, name: str, notifier: Callable[[str, RemotePacket], None]) -> None:
+        stage = self.stages[name]
+        while True:
+            msg, packet = await stage.queue.get()
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._executors[name], notifier, msg, packet)
+                stage.processed += 1
+            except Exception as e:
+                stage.failed += 1
+                print('Exception raised in notifier {0}:\n\t>>{1}'.format(name, str(e)))
+            finally:
+                stage.queue.task_done()
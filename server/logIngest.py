@@ -0,0 +1,74 @@
+import gzip, re
+import numpy as np
+from typing import Dict, List
+
+# Line written by FileLogger: '<timestamp>\t> [D<id>PRv<version>-<type>] <body>', the timestamp is missing for the
+# continuation lines of a multi-line message. Bodies follow the layout of protocol v1 measurements and calibrations.
+LOG_LINE = re.compile(
+    r'^(?:(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d{1,6})?)\t)?[^\n\[]*'
+    r'\[D(\d+)PRv(\d+)-(\d+)\][ \t]*v(\d+|\?)[ \t]+t(\d+)([hm])'
+    r'(?:[ \t]+m(\d+)|[ \t]+vn(\d+|\?)[ \t]+vx(\d+|\?)[ \t]+cd(\d+)[ \t]+cw(\d+)[ \t]+idx(\d+)[ \t]+int(\d+)[ \t]+f(\d))',
+    re.MULTILINE
+)
+# Names of the LOG_LINE groups after the timestamp, unit of the time span is folded into 'timeSpan'
+COLUMNS = ('device', 'protVers', 'packetType', 'voltage', 'timeSpan', 'timeUnit', 'measurement',
+           'voltageMin', 'voltageMax', 'calibrDry', 'calibrWet', 'intervalIdx', 'interval', 'first')
+
+
+def _intColumn(values: tuple) -> np.ndarray:
+    """ Converts a column of digit strings to int64, '?' and missing values become 0 """
+    return np.fromstring(' '.join([v or '0' for v in values]).replace('?', '0'), dtype=np.int64, sep=' ')
+
+
+def _parseChunk(text: str) -> Dict[str, np.ndarray] | None:
+    rows = LOG_LINE.findall(text)
+    if not rows:
+        return None
+    columns = list(zip(*rows))
+    chunk = {'timestamp': np.array(columns[0], dtype='datetime64[us]')}  # empty timestamps become NaT
+    for name, values in zip(COLUMNS, columns[1:]):
+        if name != 'timeUnit':
+            chunk[name] = _intColumn(values)
+    chunk['timeSpan'] *= np.where(np.array(columns[COLUMNS.index('timeUnit') + 1]) == 'h', 60, 1)
+    chunk['first'] = chunk['first'].astype(bool)
+    return chunk
+
+
+def readLogFile(path: str, devices: List[int] | None = None, chunkSize: int = 1 << 24) -> Dict[int, Dict[str, np.ndarray]]:
+    """ Reads a FileLogger output in chunks of chunkSize characters
+
+        :returns:
+            Dict of device id to its columns ('timestamp' as datetime64[us], 'packetType', 'measurement', 'calibrDry'
+            etc. as int64 arrays), rows are in the order they appear in the log. Values not present in a packet of
+            the given type (e.g. 'measurement' of a calibration) are 0.
+    """
+    chunks = []
+    rest = ''
+    opener = gzip.open if path.endswith('.gz') else open  # segments compressed by FileLogger rotation
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as file:
+        while True:
+            text = file.read(chunkSize)
+            if not text:
+                break
+            text = rest + text
+            end = text.rfind('\n') + 1
+            rest = text[end:]
+            chunk = _parseChunk(text[:end])
+            if chunk is not None:
+                chunks.append(chunk)
+    chunk = _parseChunk(rest)
+    if chunk is not None:
+        chunks.append(chunk)
+    if not chunks:
+        return dict()
+
+    table = {name: np.concatenate([c[name] for c in chunks]) for name in chunks[0]}
+    if devices:
+        selected = np.isin(table['device'], devices)
+        table = {name: column[selected] for name, column in table.items()}
+
+    order = np.argsort(table['device'], kind='stable')
+    deviceIds, starts = np.unique(table['device'][order], return_index=True)
+    bounds = list(starts[1:]) + [len(order)]
+    return {int(d): {name: column[order[start:stop]] for name, column in table.items() if name != 'device'}
+            for d, start, stop in zip(deviceIds, starts, bounds)}
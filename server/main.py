@@ -2,7 +2,11 @@ from botobj import TelegramBot
 from serialMonitor import SerialMonitor, DebugMonitor, DataObtainer
 from fileLogger import FileLogger
 from deviceManager import DeviceManager
-import click, re
+from ingestPipeline import IngestPipeline
+from metrics import REGISTRY, MetricsServer
+from queryApi import QueryApi
+import asyncio, click, os.path as op, re
+from typing import List
 
 MOISTENSOR_VERSION = '0.3'
 
@@ -11,9 +15,12 @@ fLogger: FileLogger | None = None
 deviceManager: DeviceManager | None = None
 
 def handleSerialInput(msg: str):
+    """ Synchronous equivalent of the ingest pipeline: all the steps on the calling thread """
     global bot, fLogger, deviceManager
 
     packet = deviceManager.handleMessageReceived(msg)
+    if packet is None:
+        return
 
     if fLogger:
         fLogger.log(msg)
@@ -23,50 +30,122 @@ def handleSerialInput(msg: str):
     if bot:
         bot.handlePacketReceived(packet)
 
+def registerGauges(pipeline: IngestPipeline) -> None:
+    """ Values read from the components when /metrics is scraped, so they cost nothing per packet """
+    def sourceValues(key: str):
+        return lambda: {(name,): stats.get(key) for name, stats in pipeline.sourceStats().items()}
+    REGISTRY.gauge('moistensor_queue_depth', 'Items waiting in the ingest stage queue',
+                   lambda: {(name,): stats['depth'] for name, stats in pipeline.stats().items()}, ('stage',))
+    REGISTRY.gauge('moistensor_queue_dropped', 'Items dropped because the ingest stage queue was full',
+                   lambda: {(name,): stats['dropped'] for name, stats in pipeline.stats().items()}, ('stage',))
+    REGISTRY.gauge('moistensor_source_lines', 'Lines received from the source', sourceValues('lines'), ('source',))
+    REGISTRY.gauge('moistensor_source_connected', '1 if the serial port is open', sourceValues('connected'), ('source',))
+    REGISTRY.gauge('moistensor_source_reconnects', 'Times the serial port has been lost', sourceValues('reconnects'), ('source',))
+    REGISTRY.gauge('moistensor_source_downtime_seconds', 'Time the serial port has been closed', sourceValues('downtime'), ('source',))
+    REGISTRY.gauge('moistensor_devices', 'Devices known to the server', lambda: len(deviceManager.devices))
+    REGISTRY.gauge('moistensor_database_bytes', 'Size of the database files',
+                   lambda: sum(op.getsize(f) for f in deviceManager.storage.files if op.exists(f)))
+    if bot:
+        REGISTRY.gauge('moistensor_telegram_pending', 'Telegram messages waiting to be sent', lambda: bot.broadcaster.pending)
+
 @click.command()
 @click.option('-t', '--telegram-token', help='telegram bot token')
-@click.option('-p', '--com-port', help='name of the serial port to start listening to; auto - to autodetect')
+@click.option('-p', '--com-port', multiple=True, help='name of the serial port to start listening to, repeat to listen to several receivers; auto - to autodetect')
 @click.option('-o', '--out-file', help='file for logging serial port')
-@click.option('-b', '--bot-file', help='file for saving telegram bot state', default='tgbot.pickle')
-@click.option('-d', '--database-file', help='file for saving entries', default='db.pickle')
+@click.option('--out-buffered', is_flag=True, help='buffer the log file writes in memory and flush them periodically')
+@click.option('--out-rotate', type=click.Choice(FileLogger.ROTATE_MODES, case_sensitive=False), help='rotate the log file by size or date', default='none')
+@click.option('--out-max-size', type=int, help='size of the log file in MB to rotate it at', default=16)
+@click.option('--out-compress', is_flag=True, help='gzip rotated log files')
+@click.option('--digest-window', type=float, help='minutes to collect device updates for a single telegram message; 0 - send every update', default=0)
+@click.option('-b', '--bot-file', help='file for saving telegram bot state', default='tgbot.sqlite')
+@click.option('-d', '--database-file', help='file for saving entries; *.sqlite, *.sqlite3 or *.db - to use SQLite database', default='db.pickle')
+@click.option('--duplicate-window', type=float, help='seconds within which copies of a packet (retransmits, several receivers) are dropped, keep it well below the shortest device interval; 0 - keep all', default=5)
+@click.option('--metrics-port', type=int, help='port of the local http://127.0.0.1:<port>/metrics endpoint (Prometheus text format); 0 - disabled', default=0)
+@click.option('--api-port', type=int, help='port of the local http://127.0.0.1:<port>/devices JSON API for dashboards; 0 - disabled', default=0)
 @click.option('-m', '--monitor', type=click.Choice(['debug', 'serial'], case_sensitive=False), help='type of monitor to use', default='serial')
-def main(telegram_token, com_port, out_file, bot_file, database_file, monitor):
+@click.option('--debug-fleet', type=int, help='number of devices simulated by the debug monitor; 0 - a single sine signal device', default=0)
+@click.option('--debug-rate', type=float, help='lines per second sent by the simulated fleet; 0 - as fast as possible', default=10)
+@click.option('--debug-seed', type=int, help='seed of the simulated fleet', default=0)
+@click.option('--debug-malformed', type=float, help='fraction of malformed lines sent by the simulated fleet', default=0.01)
+@click.option('--debug-duplicates', type=float, help='fraction of duplicate lines sent by the simulated fleet', default=0.02)
+@click.option('--debug-lines', type=int, help='number of lines to send by the simulated fleet before stopping; unlimited by default')
+def main(telegram_token, com_port, out_file, out_buffered, out_rotate, out_max_size, out_compress, digest_window, bot_file, database_file, duplicate_window, metrics_port, api_port, monitor,
+         debug_fleet, debug_rate, debug_seed, debug_malformed, debug_duplicates, debug_lines):
     global bot, fLogger, deviceManager
 
-    deviceManager = DeviceManager(database_file)
+    deviceManager = DeviceManager(database_file, duplicateWindow=duplicate_window)
 
     # Initialize Telegram bot
     if telegram_token:
-        bot = TelegramBot(telegram_token, bot_file, deviceManager)
+        bot = TelegramBot(telegram_token, bot_file, deviceManager, digestWindow=digest_window * 60)
         bot.startBot()
         print('> Telegram bot started!')
     else:
         print('> No telegram bot token provided! Bot has not been started!')
 
-    # Initialize data obtainer
-    data: DataObtainer | None = None
-    if monitor == 'serial':
-        data: SerialMonitor = SerialMonitor()
-    elif monitor == 'debug':
-        data: DebugMonitor = DebugMonitor()
-    else:
-        raise Exception('Unknown monitor provided: {0}'.format(monitor))
+    # Initialize data obtainers, one per serial port
+    obtainers: List[DataObtainer] = []
+    for port in (com_port if com_port else (None,)):
+        if monitor == 'serial':
+            data: SerialMonitor = SerialMonitor()
+        elif monitor == 'debug':
+            data: DebugMonitor = DebugMonitor(type='fleet', devices=debug_fleet, rate=debug_rate, seed=debug_seed,
+                                              malformedRate=debug_malformed, duplicateRate=debug_duplicates,
+                                              limit=debug_lines) if debug_fleet else DebugMonitor()
+        else:
+            raise Exception('Unknown monitor provided: {0}'.format(monitor))
 
-    if com_port:
-        data.setup(port=com_port)
-    else:
-        data.setup()
-    print('> {0} with comport {1} started!'.format(type(data).__name__, data.port))
+        if (data.setup(port=port) if port else data.setup()) is False:
+            print('> {0} with comport {1} skipped!'.format(type(data).__name__, port))
+            continue
+        print('> {0} with comport {1} started!'.format(type(data).__name__, data.name))
+        obtainers.append(data)
+    if not obtainers:
+        print('> No data obtainers to listen to!')
 
     # Initialize file logger
     if out_file:
-        fLogger = FileLogger(out_file)
+        fLogger = FileLogger(out_file, buffered=out_buffered, rotate=out_rotate.lower(),
+                             maxBytes=out_max_size * 1024 * 1024, compress=out_compress)
         print('> File logging started!')
     else:
         print('> No output file specified. No logging to file enabled')
 
-    data.listen(handleSerialInput)
-    bot.stopBot()
+    pipeline = IngestPipeline(deviceManager)
+    if fLogger:
+        pipeline.addNotifier('file', lambda msg, packet: fLogger.log(msg))
+    pipeline.addNotifier('console', lambda msg, packet: print(msg.rstrip('\n')))
+    if bot:
+        pipeline.addNotifier('telegram', lambda msg, packet: bot.handlePacketReceived(packet))
+
+    metricsServer: MetricsServer | None = None
+    if metrics_port:
+        registerGauges(pipeline)
+        metricsServer = MetricsServer(metrics_port)
+        print('> Metrics served at http://127.0.0.1:{0}/metrics'.format(metrics_port))
+    queryApi: QueryApi | None = None
+    if api_port:
+        queryApi = QueryApi(deviceManager, api_port)
+        print('> Device API served at http://127.0.0.1:{0}/devices'.format(api_port))
+
+    try:
+        asyncio.run(pipeline.run(*obtainers))
+    finally:
+        for data in obtainers:
+            data.stop()
+        for name, stats in pipeline.sourceStats().items():
+            print('> {0}: {1}'.format(name, stats))
+        if deviceManager.deduplicator:
+            print('> Duplicates dropped: {0}'.format(deviceManager.deduplicator.dropped))
+        if queryApi:
+            queryApi.stop()
+        deviceManager.close()
+        if metricsServer:
+            metricsServer.stop()
+        if fLogger:
+            fLogger.close()
+        if bot:
+            bot.stopBot()
 
 if __name__ == '__main__':
     print('Welcome to Moistensor v{0}'.format(MOISTENSOR_VERSION))
@@ -0,0 +1,211 @@
+import threading
+import numpy as np
+from collections import Counter as Tally, deque
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+# Upper bounds in seconds, from the microseconds of parsing to the seconds of a Telegram request
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FOLD_EVERY = 4096  # pending observations are aggregated in batches of this size or when rendering
+
+
+def _drain(pending: deque) -> list:
+    """ Takes the items appended so far, deque appends and pops are thread-safe """
+    return [pending.popleft() for _ in range(len(pending))]
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = ['{0}="{1}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """ Increments are only appended to a deque on the hot path (tens of nanoseconds, no lock), and are added up
+        in batches of FOLD_EVERY or when the metric is rendered
+    """
+    def __init__(self, name: str, help: str, labelNames: Tuple[str, ...] = ()):
+        self.name: str = name
+        self.help: str = help
+        self.labelNames: Tuple[str, ...] = labelNames
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = dict()
+        self._pending: deque = deque()  # label values of the increments by 1 not added up yet
+
+    def inc(self, label=(), amount: float = 1) -> None:
+        """ Label values are given as a tuple, or as a plain value for a single label """
+        if amount == 1:
+            self._pending.append(label)
+            if len(self._pending) >= FOLD_EVERY:
+                self._fold()
+            return
+        with self._lock:
+            key = label if type(label) == tuple else (label,)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, label=()) -> float:
+        self._fold()
+        return self._values.get(label if type(label) == tuple else (label,), 0)
+
+    def _fold(self) -> None:
+        with self._lock:
+            for label, count in Tally(_drain(self._pending)).items():
+                key = label if type(label) == tuple else (label,)
+                self._values[key] = self._values.get(key, 0) + count
+
+    def render(self) -> List[str]:
+        self._fold()
+        with self._lock:
+            values = list(self._values.items())
+        return ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} counter'.format(self.name)] + \
+               ['{0}{1} {2}'.format(self.name, _labels(self.labelNames, labels), value) for labels, value in values]
+
+
+class HistogramSeries:
+    """ Histogram of a single label values tuple. Like Counter, observations are appended to a deque and are sorted
+        into the buckets in batches
+    """
+    __slots__ = ('buckets', 'counts', 'sum', '_pending', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets: Tuple[float, ...] = buckets
+        self.counts: np.ndarray = np.zeros(len(buckets) + 1, dtype=np.int64)  # +Inf last
+        self.sum: float = 0.0
+        self._pending: deque = deque()
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        self._pending.append(value)
+        if len(self._pending) >= FOLD_EVERY:
+            self.fold()
+
+    def fold(self) -> None:
+        with self._lock:
+            values = np.array(_drain(self._pending), dtype=np.float64)
+            self.counts += np.bincount(np.searchsorted(self.buckets, values, side='left'), minlength=len(self.counts))
+            self.sum += float(values.sum())
+
+
+class Histogram:
+    """ Cumulative buckets are computed when rendering. Hot paths should keep the series returned by labels() """
+    def __init__(self, name: str, help: str, labelNames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name: str = name
+        self.help: str = help
+        self.labelNames: Tuple[str, ...] = labelNames
+        self.buckets: Tuple[float, ...] = buckets
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple, HistogramSeries] = dict()
+
+    def labels(self, *labels) -> HistogramSeries:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = HistogramSeries(self.buckets)
+            return series
+
+    def observe(self, *labels, value: float) -> None:
+        self.labels(*labels).observe(value)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = list(self._series.items())
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} histogram'.format(self.name)]
+        for labels, values in series:
+            values.fold()
+            with values._lock:
+                counts, total = values.counts.tolist(), values.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{0}"'.format('+Inf' if bound == float('inf') else repr(bound))
+                lines.append('{0}_bucket{1} {2}'.format(self.name, _labels(self.labelNames, labels, le), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _labels(self.labelNames, labels), total))
+            lines.append('{0}_count{1} {2}'.format(self.name, _labels(self.labelNames, labels), cumulative))
+        return lines
+
+
+class Gauge:
+    """ Value read at scrape time: fn returns a number, or a dict of label values tuple -> number """
+    def __init__(self, name: str, help: str, fn: Callable[[], float | Dict[Tuple, float]], labelNames: Tuple[str, ...] = ()):
+        self.name: str = name
+        self.help: str = help
+        self.fn: Callable[[], float | Dict[Tuple, float]] = fn
+        self.labelNames: Tuple[str, ...] = labelNames
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} gauge'.format(self.name)]
+        try:
+            values = self.fn()
+        except Exception as e:
+            print('Exception raised when reading gauge {0}:\n\t>>{1}'.format(self.name, str(e)))
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        return lines + ['{0}{1} {2}'.format(self.name, _labels(self.labelNames, labels), float(value))
+                        for labels, value in values.items() if value is not None]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Counter | Histogram | Gauge] = dict()
+
+    def register(self, metric: Counter | Histogram | Gauge) -> Counter | Histogram | Gauge:
+        """ Replaces a metric of the same name, e.g. a gauge of a recreated pipeline """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float | Dict[Tuple, float]], labelNames: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, fn, labelNames))
+
+    def render(self) -> str:
+        """ Prometheus text exposition format """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PACKETS_RECEIVED: Counter = REGISTRY.register(Counter('moistensor_packets_received_total', 'Packets stored per device', ('device',)))
+PARSE_ERRORS: Counter = REGISTRY.register(Counter('moistensor_parse_errors_total', 'Lines that failed to parse per device ("" - unknown)', ('device',)))
+DUPLICATES: Counter = REGISTRY.register(Counter('moistensor_duplicates_total', 'Duplicate packets dropped per device', ('device',)))
+STAGE_LATENCY: Histogram = REGISTRY.register(Histogram('moistensor_stage_seconds', 'Time spent per item in each ingest stage', ('stage',)))
+READ_LATENCY: HistogramSeries = STAGE_LATENCY.labels('read')  # from the bytes read to the line handed over
+QUEUE_LATENCY: HistogramSeries = STAGE_LATENCY.labels('queue')  # waiting for the storage stage
+PARSE_LATENCY: HistogramSeries = STAGE_LATENCY.labels('parse')
+PERSIST_LATENCY: HistogramSeries = STAGE_LATENCY.labels('persist')
+FILELOG_LATENCY: HistogramSeries = STAGE_LATENCY.labels('filelog')
+TELEGRAM_SEND_LATENCY: HistogramSeries = STAGE_LATENCY.labels('telegram_send')
+
+
+class MetricsServer:
+    """ Serves REGISTRY on http://<host>:<port>/metrics from a daemon thread """
+    def __init__(self, port: int, host: str = '127.0.0.1', registry: Registry = REGISTRY):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # scrapes are not worth a console line each
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
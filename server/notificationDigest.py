@@ -0,0 +1,139 @@
+import heapq, threading, time
+from collections.abc import Callable
+from typing import Any, Dict, List, Tuple
+from remoteDevice import (
+    RemoteDevice,
+    RemotePacket,
+    RemotePacketCalibration,
+    RemotePacketMeasurement
+)
+
+
+def moisturePercent(measurement: int, calibration: RemotePacketCalibration | None) -> float | None:
+    """ 0% at the dry calibration value, 100% at the wet one, None if the device is not calibrated """
+    if not calibration or calibration.calibrationDry == calibration.calibrationWet:
+        return None
+    return 100 * (calibration.calibrationDry - measurement) / (calibration.calibrationDry - calibration.calibrationWet)
+
+
+class DeviceDigest:
+    """ Packets of a single device received during the digest window """
+    def __init__(self):
+        self.measurements: int = 0
+        self.calibrations: int = 0
+        self.latest: RemotePacketMeasurement | None = None
+        self.minimum: int | None = None
+        self.maximum: int | None = None
+
+    def add(self, packet: RemotePacket) -> None:
+        if type(packet) == RemotePacketCalibration:
+            self.calibrations += 1
+        elif type(packet) == RemotePacketMeasurement:
+            self.measurements += 1
+            self.latest = packet
+            self.minimum = packet.measurement if self.minimum is None else min(self.minimum, packet.measurement)
+            self.maximum = packet.measurement if self.maximum is None else max(self.maximum, packet.measurement)
+
+
+class DigestCoalescer:
+    """ Collects the packets for each chat during its window and sends them as a single digest message.
+
+        Chats with a window of 0 get every packet right away. A measurement moving the moisture of a device below
+        dryAlertLevel (or above wetAlertLevel) percent of its calibration range, or back, is sent immediately as an
+        alert regardless of the window.
+    """
+    def __init__(self, send: Callable[[int, str], Any], windowOf: Callable[[int], float],
+                 calibrationOf: Callable[[RemoteDevice], RemotePacketCalibration | None],
+                 dryAlertLevel: float | None = 20, wetAlertLevel: float | None = None):
+        self.send: Callable[[int, str], Any] = send
+        self.windowOf: Callable[[int], float] = windowOf  # seconds to collect packets for the chat
+        self.calibrationOf: Callable[[RemoteDevice], RemotePacketCalibration | None] = calibrationOf
+        self.dryAlertLevel: float | None = dryAlertLevel
+        self.wetAlertLevel: float | None = wetAlertLevel
+
+        self._cond = threading.Condition()
+        self._digests: Dict[int, Tuple[float, Dict[RemoteDevice, DeviceDigest]]] = dict()  # chat -> (start, devices)
+        self._deadlines: List[Tuple[float, int]] = []  # heap of (flush time, chat id)
+        self._alertStates: Dict[RemoteDevice, str] = dict()  # 'dry', 'wet' or 'ok'
+        self._stopping: bool = False
+        self._flusher = threading.Thread(target=self._flushPeriodically, name='DigestCoalescer', daemon=True)
+        self._flusher.start()
+
+    def handlePacket(self, packet: RemotePacket, chatIds: List[int]) -> None:
+        alert = self._alert(packet)
+        for chatId in chatIds:
+            if alert:
+                self.send(chatId, alert)
+            window = self.windowOf(chatId)
+            if window <= 0:
+                self.send(chatId, str(packet))
+                continue
+            with self._cond:
+                if chatId not in self._digests:
+                    self._digests[chatId] = (time.monotonic(), dict())
+                    heapq.heappush(self._deadlines, (time.monotonic() + window, chatId))
+                    self._cond.notify()
+                devices = self._digests[chatId][1]
+                if packet.remoteDevice not in devices:
+                    devices[packet.remoteDevice] = DeviceDigest()
+                devices[packet.remoteDevice].add(packet)
+
+    def stop(self) -> None:
+        """ Sends out all the collected digests """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._flusher.join()
+
+    def _alert(self, packet: RemotePacket) -> str | None:
+        if type(packet) != RemotePacketMeasurement:
+            return None
+        moisture = moisturePercent(packet.measurement, self.calibrationOf(packet.remoteDevice))
+        if moisture is None:
+            return None
+        state = 'ok'
+        if self.dryAlertLevel is not None and moisture < self.dryAlertLevel:
+            state = 'dry'
+        elif self.wetAlertLevel is not None and moisture > self.wetAlertLevel:
+            state = 'wet'
+        previous = self._alertStates.get(packet.remoteDevice, 'ok')
+        self._alertStates[packet.remoteDevice] = state
+        if state == previous:
+            return None
+        if state == 'dry':
+            return 'Alert: {0} is dry: {1}% (measurement {2})'.format(packet.remoteDevice, round(moisture), packet.measurement)
+        if state == 'wet':
+            return 'Alert: {0} is too wet: {1}% (measurement {2})'.format(packet.remoteDevice, round(moisture), packet.measurement)
+        return '{0} is back to normal: {1}% (measurement {2})'.format(packet.remoteDevice, round(moisture), packet.measurement)
+
+    def _format(self, start: float, devices: Dict[RemoteDevice, DeviceDigest]) -> str:
+        lines = ['Digest of the last {0}m:'.format(max(1, round((time.monotonic() - start) / 60)))]
+        for device in sorted(devices, key=lambda d: d.id):
+            digest = devices[device]
+            line = '{0}:'.format(device)
+            if digest.latest:
+                moisture = moisturePercent(digest.latest.measurement, self.calibrationOf(device))
+                line += ' {0}{1} [{2} .. {3}] {4} updates, last at {5}'.format(
+                    digest.latest.measurement, ' ({0}%)'.format(round(moisture)) if moisture is not None else '',
+                    digest.minimum, digest.maximum, digest.measurements, digest.latest.timestamp.strftime('%H:%M'))
+            if digest.calibrations:
+                line += ' recalibrated'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def _flushPeriodically(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopping and (not self._deadlines or self._deadlines[0][0] > time.monotonic()):
+                    self._cond.wait(self._deadlines[0][0] - time.monotonic() if self._deadlines else None)
+                if self._stopping:
+                    due = list(self._digests.items())
+                    self._digests.clear()
+                    self._deadlines.clear()
+                else:
+                    _, chatId = heapq.heappop(self._deadlines)
+                    due = [(chatId, self._digests.pop(chatId))]
+            for chatId, (start, devices) in due:
+                self.send(chatId, self._format(start, devices))
+            if self._stopping:
+                return
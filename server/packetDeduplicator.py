@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+from remoteDevice import RemotePacket, RemotePacketCalibration, RemotePacketMeasurement
+
+
+def packetKey(packet: RemotePacket) -> Tuple:
+    """ Identifies a transmission regardless of the receiver and the time it has been received at """
+    key = (packet.remoteDevice.id, packet.type, packet.protocolVersion)
+    if type(packet) == RemotePacketMeasurement:
+        return key + (packet.deviceTimeStamp, packet.measurement, packet.voltage)
+    if type(packet) == RemotePacketCalibration:
+        return key + (packet.deviceTimeStamp, packet.voltage, packet.voltageMin, packet.voltageMax,
+                      packet.calibrationDry, packet.calibrationWet, packet.intervalIdx, packet.interval, packet.first)
+    return key + (str(packet),)
+
+
+class PacketDeduplicator:
+    """ Recognizes copies of a packet received within window seconds of the first one.
+
+        Retransmissions and overlapping receivers deliver the same packet several times within a second or two.
+        The window has to stay well below the shortest device interval: once a device reports its time in hours,
+        consecutive equal readings have equal keys. The keys seen during the window are kept in insertion order, so expired ones are evicted from the front; at most maxKeys are kept.
+        Not thread-safe, meant to be called by the single thread storing the packets.
+    """
+    def __init__(self, window: float = 5, maxKeys: int = 100000):
+        self.window: float = window
+        self.maxKeys: int = maxKeys
+        self.dropped: int = 0
+        self.droppedPerDevice: Dict[int, int] = dict()
+        self._seen: OrderedDict[Tuple, float] = OrderedDict()  # key -> monotonic time of the first copy
+
+    def isDuplicate(self, packet: RemotePacket) -> bool:
+        """ Remembers the packet, True if a copy of it has been seen within the window """
+        now = time.monotonic()
+        while self._seen and (len(self._seen) >= self.maxKeys or next(iter(self._seen.values())) <= now - self.window):
+            self._seen.popitem(last=False)
+        key = packetKey(packet)
+        if key in self._seen:
+            self.dropped += 1
+            self.droppedPerDevice[packet.remoteDevice.id] = self.droppedPerDevice.get(packet.remoteDevice.id, 0) + 1
+            return True
+        self._seen[key] = now
+        return False
@@ -0,0 +1,171 @@
+import datetime as dt
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterable, Iterator, List
+from remoteDevice import (
+    RemoteDevice,
+    RemotePacket,
+    RemotePacketCalibration,
+    RemotePacketMeasurement
+)
+
+INT8_RANGE = range(-2 ** 7, 2 ** 7)
+INT32_RANGE = range(-2 ** 31, 2 ** 31)
+
+
+class PacketHistory:
+    """ Packets of a single device stored column-wise in typed arrays.
+
+        Every packet takes a row in each of the columns (a few dozen bytes), calibrations are rare and are
+        additionally kept as objects. Packet objects are created only when they are requested.
+
+        Packets arrive in chronological order, so the timestamps column is sorted and range queries are answered
+        by binary search. The calibration rows split the history into calibration epochs. Should the clock ever
+        go backwards, the history is marked as unordered and falls back to scanning.
+
+        A single thread appends while others read without locking: the timestamps column is appended last, so
+        len(history) counts only the rows complete in every column.
+    """
+    __slots__ = ('device', 'timestamps', 'types', 'protocolVersions', 'deviceTimeStamps', 'measurements', 'voltages',
+                 'calibrations', 'calibrationRows', 'ordered')
+
+    def __init__(self, device: RemoteDevice):
+        self.device: RemoteDevice = device
+        self.timestamps: array = array('d')  # POSIX timestamps of reception
+        self.types: array = array('b')
+        self.protocolVersions: array = array('i')
+        self.deviceTimeStamps: array = array('i')
+        self.measurements: array = array('i')  # 0 for calibrations
+        self.voltages: array = array('i')
+        self.calibrations: List[RemotePacketCalibration] = []
+        self.calibrationRows: array = array('q')  # row of each calibration, ascending
+        self.ordered: bool = True  # timestamps column is sorted
+
+    @classmethod
+    def fromPackets(cls, device: RemoteDevice, packets: Iterable[RemotePacket]) -> 'PacketHistory':
+        history = cls(device)
+        for packet in packets:
+            history.append(packet)
+        return history
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, state: dict):
+        self.ordered = True
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    @staticmethod
+    def checkRow(packet: RemotePacket) -> None:
+        """ Raises if the packet cannot be stored, e.g. before it is persisted anywhere """
+        if type(packet) not in (RemotePacketMeasurement, RemotePacketCalibration):
+            raise TypeError('{0} cannot be stored in the history'.format(type(packet).__name__))
+        measurement = packet.measurement if type(packet) == RemotePacketMeasurement else 0
+        if packet.type not in INT8_RANGE or any(v not in INT32_RANGE for v in (packet.protocolVersion, packet.deviceTimeStamp,
+                                                                                measurement, packet.voltage)):
+            raise ValueError('Values of {0} are out of range of the history columns'.format(packet))
+
+    def append(self, packet: RemotePacket) -> None:
+        """ Appends a row to every column or, if any of the values does not fit its column, to none of them """
+        self.checkRow(packet)
+        measurement = packet.measurement if type(packet) == RemotePacketMeasurement else 0
+        timestamp = packet.timestamp.timestamp()
+        if type(packet) == RemotePacketCalibration:
+            self.calibrations.append(packet)
+            self.calibrationRows.append(len(self.timestamps))
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            self.ordered = False
+        self.types.append(packet.type)
+        self.protocolVersions.append(packet.protocolVersion)
+        self.deviceTimeStamps.append(packet.deviceTimeStamp)
+        self.measurements.append(measurement)
+        self.voltages.append(packet.voltage)
+        self.timestamps.append(timestamp)  # publishes the row
+
+    def extend(self, other: 'PacketHistory') -> None:
+        offset = len(self.timestamps)
+        if not other.ordered or (self.timestamps and other.timestamps and other.timestamps[0] < self.timestamps[-1]):
+            self.ordered = False
+        self.calibrations.extend(other.calibrations)
+        self.calibrationRows.extend(row + offset for row in other.calibrationRows)
+        self.types.extend(other.types)
+        self.protocolVersions.extend(other.protocolVersions)
+        self.deviceTimeStamps.extend(other.deviceTimeStamps)
+        self.measurements.extend(other.measurements)
+        self.voltages.extend(other.voltages)
+        self.timestamps.extend(other.timestamps)
+
+    def packet(self, row: int) -> RemotePacket:
+        c = bisect_left(self.calibrationRows, row)
+        if c < len(self.calibrationRows) and self.calibrationRows[c] == row:
+            return self.calibrations[c]
+        return self._measurement(row)
+
+    def packets(self, start: int = 0, stop: int | None = None) -> List[RemotePacket]:
+        return [self.packet(row) for row in range(*slice(start, stop).indices(len(self.timestamps)))]
+
+    def measurementsBetween(self, since: dt.datetime | None = None, until: dt.datetime | None = None) -> List[RemotePacketMeasurement]:
+        """ Measurements with since <= timestamp < until, any of the bounds can be omitted """
+        sinceTs = since.timestamp() if since is not None else float('-inf')
+        untilTs = until.timestamp() if until is not None else float('inf')
+        if not self.ordered:
+            calibrationRows = set(self.calibrationRows)
+            return [self._measurement(row) for row, ts in enumerate(self.timestamps)
+                    if sinceTs <= ts < untilTs and row not in calibrationRows]
+        return self._measurementsInRows(bisect_left(self.timestamps, sinceTs), bisect_left(self.timestamps, untilTs))
+
+    def measurementChunks(self, since: dt.datetime | None = None, until: dt.datetime | None = None,
+                          rows: int = 1000) -> Iterator[List[RemotePacketMeasurement]]:
+        """ measurementsBetween in lists of the measurements of up to rows rows, created only as they are iterated.
+            Rows appended after the iteration has started are left out
+        """
+        if not self.ordered:
+            measurements = self.measurementsBetween(since, until)
+            for start in range(0, len(measurements), rows):
+                yield measurements[start:start + rows]
+            return
+        start = bisect_left(self.timestamps, since.timestamp()) if since is not None else 0
+        stop = bisect_left(self.timestamps, until.timestamp()) if until is not None else len(self.timestamps)
+        for row in range(start, stop, rows):
+            chunk = self._measurementsInRows(row, min(row + rows, stop))
+            if chunk:
+                yield chunk
+
+    def measurementsSinceLatestCalibration(self) -> List[RemotePacketMeasurement]:
+        epoch = bisect_left(self.calibrationRows, len(self.timestamps)) - 1  # a calibration being appended is not in yet
+        if epoch < 0:
+            return []
+        return self.measurementsInEpoch(epoch)
+
+    def measurementsInEpoch(self, epoch: int) -> List[RemotePacketMeasurement]:
+        """ Measurements following the calibration #epoch up to the next calibration """
+        start = self.calibrationRows[epoch] + 1
+        stop = self.calibrationRows[epoch + 1] if epoch + 1 < len(self.calibrationRows) else len(self.timestamps)
+        return [self._measurement(row) for row in range(start, stop)]
+
+    def epochAt(self, timestamp: dt.datetime) -> int:
+        """ Index of the calibration in effect at the given time, -1 if there was none yet """
+        if not self.ordered:
+            ts = timestamp.timestamp()
+            return max((c for c, row in enumerate(self.calibrationRows) if self.timestamps[row] <= ts), default=-1)
+        return bisect_right(self.calibrationRows, bisect_right(self.timestamps, timestamp.timestamp()) - 1) - 1
+
+    def _measurementsInRows(self, start: int, stop: int) -> List[RemotePacketMeasurement]:
+        """ Measurements in rows [start, stop), skipping the calibration rows """
+        measurements = []
+        c = bisect_left(self.calibrationRows, start)
+        for row in range(start, stop):
+            if c < len(self.calibrationRows) and self.calibrationRows[c] == row:
+                c += 1
+                continue
+            measurements.append(self._measurement(row))
+        return measurements
+
+    def _measurement(self, row: int) -> RemotePacketMeasurement:
+        return RemotePacketMeasurement(self.device, self.protocolVersions[row], self.types[row],
+                                       measurement=self.measurements[row], deviceTimeStamp=self.deviceTimeStamps[row],
+                                       voltage=self.voltages[row], datetime=dt.datetime.fromtimestamp(self.timestamps[row]))
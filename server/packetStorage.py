@@ -0,0 +1,561 @@
+import contextlib, mmap, os, os.path as op, pickle, sqlite3, struct, threading, zlib
+import datetime as dt
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any, Dict, Iterator, List, Tuple
+from remoteDevice import (
+    RemoteDevice,
+    RemotePacket,
+    RemotePacketCalibration,
+    RemotePacketMeasurement
+)
+from packetHistory import PacketHistory
+
+
+class PacketStorage:
+    """ Base class for persisting packets received from remote devices. Keeps nothing on disk """
+    def __init__(self):
+        pass
+
+    def load(self, entryFactory: Callable[..., Any]) -> Tuple[Dict[RemoteDevice, Any], List[RemotePacket]]:
+        """ Returns the devices dict from the latest snapshot and the packets received after it """
+        return dict(), []
+
+    @property
+    def files(self) -> List[str]:
+        """ Files the storage keeps on disk """
+        return []
+
+    @property
+    def historySource(self) -> 'PacketStorage | None':
+        """ Storage to be queried for device histories, None if the histories are kept in memory """
+        return None
+
+    def deviceHistory(self, device: RemoteDevice) -> PacketHistory:
+        return PacketHistory(device)
+
+    def deviceMeasurements(self, device: RemoteDevice, since: dt.datetime | None = None,
+                           until: dt.datetime | None = None) -> List[RemotePacketMeasurement]:
+        return []
+
+    def deviceMeasurementChunks(self, device: RemoteDevice, since: dt.datetime | None = None, until: dt.datetime | None = None,
+                                rows: int = 1000) -> Iterator[List[RemotePacketMeasurement]]:
+        """ deviceMeasurements in lists of up to rows measurements, read as they are iterated """
+        measurements = self.deviceMeasurements(device, since, until)
+        for start in range(0, len(measurements), rows):
+            yield measurements[start:start + rows]
+
+    def append(self, packet: RemotePacket) -> None:
+        pass
+
+    @property
+    def compactionDue(self) -> bool:
+        return False
+
+    def compact(self, devices: Dict[RemoteDevice, Any]) -> None:
+        pass
+
+    def close(self, devices: Dict[RemoteDevice, Any]) -> None:
+        pass
+
+
+class JournalStorage(PacketStorage):
+    """ Snapshot file with an append-only journal next to it.
+
+        Every packet is appended to '<filename>.journal' as a length+crc framed pickle, so writing a packet
+        costs the same regardless of the history size. Once the journal grows large compared to the snapshot,
+        the whole state is written to a new snapshot and the journal starts over. Both files carry a generation
+        number: a journal whose generation does not match the snapshot has already been folded into it.
+        A torn or corrupted journal tail (e.g. power loss in the middle of a write) is truncated on load.
+
+        The snapshot keeps the history of every device as a separate pickle followed by an index with the
+        per-device summary. Only the index is read at startup, the snapshot itself is memory-mapped and
+        the history of a device is unpickled when it is requested. The most recently used histories stay
+        decoded, up to cacheRows rows in total, until the next compaction.
+    """
+    SNAPSHOT_FORMAT = 'moistensor-snapshot'  # snapshots written as two consecutive pickles
+    SNAPSHOT_MAGIC = b'MSSNAP02'
+    SNAPSHOT_FOOTER = struct.Struct('<QQ8s')  # index offset, index length, magic
+    JOURNAL_MAGIC = b'MSJ1'
+    JOURNAL_HEADER = struct.Struct('<4sQ')  # magic, generation
+    RECORD_HEADER = struct.Struct('<II')  # payload length, crc32 of payload
+
+    def __init__(self, filename: str, fsync: bool = True, compactMinBytes: int = 1 << 20, compactRatio: float = 1.0,
+                 cacheRows: int = 2_000_000):
+        super().__init__()
+        self.fileName: str = filename
+        self.journalFileName: str = filename + '.journal'
+        self.fsync: bool = fsync
+        self.compactMinBytes: int = compactMinBytes
+        self.compactRatio: float = compactRatio
+        self.cacheRows: int = cacheRows
+
+        self.generation: int = 0
+        self._snapshotBytes: int = 0
+        self._journalBytes: int = 0
+        self._journal = None
+        self._legacySnapshot: bool = False  # snapshot has been loaded as a whole and is to be rewritten
+
+        self._lock = threading.RLock()  # guards the mapping, which is replaced on compaction
+        self._mmap: mmap.mmap | None = None
+        self._blobs: Dict[RemoteDevice, Tuple[int, int]] = dict()  # offset and length of each device history
+        self._tails: Dict[RemoteDevice, PacketHistory] = dict()  # packets received after the snapshot
+        self._decoded: OrderedDict[RemoteDevice, PacketHistory] = OrderedDict()  # snapshot histories, least recently used first
+        self._decodedRows: int = 0
+
+    @property
+    def files(self) -> List[str]:
+        return [self.fileName, self.journalFileName]
+
+    def load(self, entryFactory: Callable[..., Any]) -> Tuple[Dict[RemoteDevice, Any], List[RemotePacket]]:
+        devices = dict()
+        if op.exists(self.fileName) and op.getsize(self.fileName):
+            self._snapshotBytes = op.getsize(self.fileName)
+            with open(self.fileName, 'rb') as file:
+                mapped = file.read(len(self.SNAPSHOT_MAGIC)) == self.SNAPSHOT_MAGIC
+            devices = self._mapSnapshot(entryFactory) if mapped else self._loadPickledSnapshot()
+
+        packets, stale = self._readJournal()
+        for packet in packets:
+            self._appendToTail(packet)
+        self._openJournal(truncate=stale)
+        return devices, packets
+
+    @property
+    def historySource(self) -> PacketStorage | None:
+        return self
+
+    def deviceHistory(self, device: RemoteDevice) -> PacketHistory:
+        snapshot, tail = self._historyParts(device)
+        history = PacketHistory(device)
+        if snapshot is not None:
+            history.extend(snapshot)
+        history.extend(tail)
+        return history
+
+    def _historyParts(self, device: RemoteDevice) -> Tuple[PacketHistory | None, PacketHistory]:
+        """ Snapshot history (shared, must not be modified) and a copy of the tail, both of the same generation """
+        while True:
+            with self._lock:
+                generation = self.generation
+                snapshot = self._decoded.get(device)
+                if snapshot is not None:
+                    self._decoded.move_to_end(device)
+                blob = self._blobs.get(device) if snapshot is None else None
+                data = self._mmap[blob[0]:blob[0] + blob[1]] if blob else None
+            if data is not None:  # unpickled without the lock, so the ingest thread is not held up
+                snapshot = self._unpickleHistory(device, data)
+            with self._lock:
+                if generation != self.generation:  # compacted meanwhile, the tail belongs to the new snapshot
+                    continue
+                if data is not None:
+                    self._cacheDecoded(device, snapshot)
+                tail = PacketHistory(device)
+                if device in self._tails:
+                    tail.extend(self._tails[device])
+                return snapshot, tail
+
+    def _cacheDecoded(self, device: RemoteDevice, history: PacketHistory) -> None:
+        """ Keeps the history decoded, dropping the least recently used ones over cacheRows """
+        previous = self._decoded.pop(device, None)
+        if previous is not None:
+            self._decodedRows -= len(previous)
+        self._decoded[device] = history
+        self._decodedRows += len(history)
+        while self._decodedRows > self.cacheRows and len(self._decoded) > 1:
+            self._decodedRows -= len(self._decoded.popitem(last=False)[1])
+
+    def deviceMeasurements(self, device: RemoteDevice, since: dt.datetime | None = None,
+                           until: dt.datetime | None = None) -> List[RemotePacketMeasurement]:
+        """ Bisects the cached snapshot history and the tail, in the row order of the whole history """
+        snapshot, tail = self._historyParts(device)
+        measurements = snapshot.measurementsBetween(since, until) if snapshot is not None else []
+        return measurements + tail.measurementsBetween(since, until)
+
+    def deviceMeasurementChunks(self, device: RemoteDevice, since: dt.datetime | None = None, until: dt.datetime | None = None,
+                                rows: int = 1000) -> Iterator[List[RemotePacketMeasurement]]:
+        snapshot, tail = self._historyParts(device)
+        if snapshot is not None:
+            yield from snapshot.measurementChunks(since, until, rows)
+        yield from tail.measurementChunks(since, until, rows)
+
+    def append(self, packet: RemotePacket) -> None:
+        PacketHistory.checkRow(packet)  # a record that cannot be replayed must not reach the journal
+        if self._journal is None:
+            self._openJournal()
+        payload = pickle.dumps(packet, protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.write(self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._journalBytes += self.RECORD_HEADER.size + len(payload)
+        self._appendToTail(packet)
+
+    @property
+    def compactionDue(self) -> bool:
+        return self._legacySnapshot or self._journalBytes >= max(self.compactMinBytes, self._snapshotBytes * self.compactRatio)
+
+    def compact(self, devices: Dict[RemoteDevice, Any]) -> None:
+        """ Called on the thread appending the packets, so the snapshot, the histories and the tails do not change
+            while the new snapshot is written; readers are held up only while the files are swapped
+        """
+        generation = self.generation + 1
+        tmpFileName = self.fileName + '.tmp'
+        index = dict()
+        with open(tmpFileName, 'wb') as file:
+            file.write(self.SNAPSHOT_MAGIC)
+            for device, entry in devices.items():
+                if entry.source is self and device in self._blobs and device not in self._tails:
+                    offset, length = self._blobs[device]
+                    data = self._mmap[offset:offset + length]  # unchanged history is copied as is
+                else:
+                    data = pickle.dumps(entry.history, protocol=pickle.HIGHEST_PROTOCOL)
+                index[device.id] = (file.tell(), len(data), entry.count, entry.firstTimestamp,
+                                    entry.latestMeasurement, entry.latestCalibration)
+                file.write(data)
+            indexData = pickle.dumps({'generation': generation, 'devices': index}, protocol=pickle.HIGHEST_PROTOCOL)
+            indexOffset = file.tell()
+            file.write(indexData)
+            file.write(self.SNAPSHOT_FOOTER.pack(indexOffset, len(indexData), self.SNAPSHOT_MAGIC))
+            file.flush()
+            os.fsync(file.fileno())
+
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            os.replace(tmpFileName, self.fileName)
+            self._syncDirectory()
+            self.generation = generation
+            self._snapshotBytes = op.getsize(self.fileName)
+            self._legacySnapshot = False
+            self._mapFile()
+            self._blobs = {RemoteDevice(deviceId): (offset, length) for deviceId, (offset, length, *_) in index.items()}
+            self._tails = dict()
+            self._decoded = OrderedDict()
+            self._decodedRows = 0
+
+        for entry in devices.values():
+            if entry.source is not self:
+                entry.attachSource(self)
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._openJournal(truncate=True)
+
+    def close(self, devices: Dict[RemoteDevice, Any]) -> None:
+        if self._journalBytes or self._legacySnapshot:
+            self.compact(devices)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+
+    def _mapSnapshot(self, entryFactory: Callable[..., Any]) -> Dict[RemoteDevice, Any]:
+        self._mapFile()
+        indexOffset, indexLength, magic = self.SNAPSHOT_FOOTER.unpack_from(self._mmap, len(self._mmap) - self.SNAPSHOT_FOOTER.size)
+        if magic != self.SNAPSHOT_MAGIC:
+            raise ValueError('Snapshot {0} is corrupted'.format(self.fileName))
+        index = pickle.loads(self._mmap[indexOffset:indexOffset + indexLength])
+        self.generation = index['generation']
+
+        devices = dict()
+        for deviceId, (offset, length, count, firstTimestamp, latestMeasurement, latestCalibration) in index['devices'].items():
+            device = RemoteDevice(deviceId)
+            self._blobs[device] = (offset, length)
+            entry = entryFactory(device, self)
+            entry.setSummary(count, firstTimestamp, latestMeasurement, latestCalibration)
+            devices[device] = entry
+        return devices
+
+    def _loadPickledSnapshot(self) -> Dict[RemoteDevice, Any]:
+        """ Loads snapshots written before the snapshot has been split per device """
+        self._legacySnapshot = True
+        with open(self.fileName, 'rb') as file:
+            obj = pickle.load(file)
+            if isinstance(obj, dict) and obj.get('format') == self.SNAPSHOT_FORMAT:
+                self.generation = obj['generation']
+                return pickle.load(file)
+            return obj  # legacy database: the whole devices dict pickled at once
+
+    def _appendToTail(self, packet: RemotePacket) -> None:
+        if type(packet) not in (RemotePacketMeasurement, RemotePacketCalibration):
+            return
+        with self._lock:
+            if packet.remoteDevice not in self._tails:
+                self._tails[packet.remoteDevice] = PacketHistory(packet.remoteDevice)
+            self._tails[packet.remoteDevice].append(packet)
+
+    @staticmethod
+    def _unpickleHistory(device: RemoteDevice, data: bytes) -> PacketHistory:
+        history = pickle.loads(data)
+        if isinstance(history, list):  # histories snapshotted as lists of packets
+            history = PacketHistory.fromPackets(device, history)
+        return history
+
+    def _mapFile(self) -> None:
+        with open(self.fileName, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _readJournal(self) -> Tuple[List[RemotePacket], bool]:
+        """ Returns the valid packets from the journal and whether the journal has to be started over """
+        packets = []
+        if not op.exists(self.journalFileName):
+            return packets, True
+        with open(self.journalFileName, 'rb') as file:
+            data = file.read()
+
+        if len(data) < self.JOURNAL_HEADER.size:
+            return packets, True
+        magic, generation = self.JOURNAL_HEADER.unpack_from(data)
+        if magic != self.JOURNAL_MAGIC or generation != self.generation:
+            print('Journal {0} is outdated or unknown, ignoring it'.format(self.journalFileName))
+            return packets, True
+
+        offset = self.JOURNAL_HEADER.size
+        while offset + self.RECORD_HEADER.size <= len(data):
+            length, crc = self.RECORD_HEADER.unpack_from(data, offset)
+            start = offset + self.RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            offset = start + length
+            try:  # a record framed correctly but unusable is skipped, the records after it are still valid
+                packet = pickle.loads(payload)
+                PacketHistory.checkRow(packet)
+            except Exception as e:
+                print('Skipping journal record at offset {0}:\n\t>>{1}'.format(start - self.RECORD_HEADER.size, str(e)))
+                continue
+            packets.append(packet)
+
+        if offset != len(data):
+            print('Journal {0} has a broken tail of {1} bytes, truncating'.format(self.journalFileName, len(data) - offset))
+            with open(self.journalFileName, 'r+b') as file:
+                file.truncate(offset)
+        self._journalBytes = offset - self.JOURNAL_HEADER.size
+        return packets, False
+
+    def _openJournal(self, truncate: bool = False) -> None:
+        if truncate or not op.exists(self.journalFileName):
+            tmpFileName = self.journalFileName + '.tmp'
+            with open(tmpFileName, 'wb') as file:
+                file.write(self.JOURNAL_HEADER.pack(self.JOURNAL_MAGIC, self.generation))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmpFileName, self.journalFileName)
+            self._syncDirectory()
+            self._journalBytes = 0
+        self._journal = open(self.journalFileName, 'ab')
+
+    def _syncDirectory(self) -> None:
+        if os.name != 'posix':
+            return
+        fd = os.open(op.dirname(op.abspath(self.fileName)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SqliteStorage(PacketStorage):
+    """ Keeps measurements and calibrations in SQLite tables indexed by (device, timestamp).
+
+        Only the per-device summary (packets count, first timestamp, latest measurement and calibration) is
+        loaded at startup, everything else is queried on demand.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS devices (
+            device INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL,
+            firstTimestamp REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS measurements (
+            device INTEGER NOT NULL,
+            timestamp REAL NOT NULL,
+            protocolVersion INTEGER NOT NULL,
+            type INTEGER NOT NULL,
+            deviceTimeStamp INTEGER NOT NULL,
+            measurement INTEGER NOT NULL,
+            voltage INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS measurementsDeviceTimestamp ON measurements (device, timestamp);
+        CREATE TABLE IF NOT EXISTS calibrations (
+            device INTEGER NOT NULL,
+            timestamp REAL NOT NULL,
+            protocolVersion INTEGER NOT NULL,
+            type INTEGER NOT NULL,
+            deviceTimeStamp INTEGER NOT NULL,
+            voltage INTEGER NOT NULL,
+            voltageMin INTEGER NOT NULL,
+            voltageMax INTEGER NOT NULL,
+            calibrationDry INTEGER NOT NULL,
+            calibrationWet INTEGER NOT NULL,
+            intervalIdx INTEGER NOT NULL,
+            interval INTEGER NOT NULL,
+            first INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS calibrationsDeviceTimestamp ON calibrations (device, timestamp);
+    """
+    MEASUREMENT_COLUMNS = 'device, timestamp, protocolVersion, type, deviceTimeStamp, measurement, voltage'
+    CALIBRATION_COLUMNS = 'device, timestamp, protocolVersion, type, deviceTimeStamp, voltage, voltageMin, voltageMax, ' \
+                          'calibrationDry, calibrationWet, intervalIdx, interval, first'
+
+    def __init__(self, filename: str):
+        super().__init__()
+        self.fileName: str = filename
+        # The connection is written by a single thread, the one appending the first packet. Other threads query
+        # through connections of their own, which in WAL mode read the latest commit without waiting for the writer
+        # or holding it up
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+        self._connection.commit()
+        self._writerThread: int | None = None  # pinned by the first append
+        self._readers = threading.local()
+        self._readConnections: List[sqlite3.Connection] = []
+
+    @property
+    def files(self) -> List[str]:
+        return [self.fileName, self.fileName + '-wal', self.fileName + '-shm']
+
+    def load(self, entryFactory: Callable[..., Any]) -> Tuple[Dict[RemoteDevice, Any], List[RemotePacket]]:
+        devices = dict()
+        with self._lock:
+            rows = self._connection.execute('SELECT device, count, firstTimestamp FROM devices').fetchall()
+            for deviceId, count, firstTimestamp in rows:
+                device = RemoteDevice(deviceId)
+                measurement = self._connection.execute(
+                    'SELECT {0} FROM measurements WHERE device = ? ORDER BY timestamp DESC LIMIT 1'
+                    .format(self.MEASUREMENT_COLUMNS), (deviceId,)).fetchone()
+                calibration = self._connection.execute(
+                    'SELECT {0} FROM calibrations WHERE device = ? ORDER BY timestamp DESC LIMIT 1'
+                    .format(self.CALIBRATION_COLUMNS), (deviceId,)).fetchone()
+                entry = entryFactory(device, self)
+                entry.setSummary(count, dt.datetime.fromtimestamp(firstTimestamp),
+                                 self._measurementFromRow(measurement) if measurement else None,
+                                 self._calibrationFromRow(calibration) if calibration else None)
+                devices[device] = entry
+        return devices, []
+
+    @property
+    def historySource(self) -> PacketStorage | None:
+        return self
+
+    def append(self, packet: RemotePacket) -> None:
+        if type(packet) == RemotePacketMeasurement:
+            query = 'INSERT INTO measurements ({0}) VALUES (?, ?, ?, ?, ?, ?, ?)'.format(self.MEASUREMENT_COLUMNS)
+            values = (packet.remoteDevice.id, packet.timestamp.timestamp(), packet.protocolVersion, packet.type,
+                      packet.deviceTimeStamp, packet.measurement, packet.voltage)
+        elif type(packet) == RemotePacketCalibration:
+            query = 'INSERT INTO calibrations ({0}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(self.CALIBRATION_COLUMNS)
+            values = (packet.remoteDevice.id, packet.timestamp.timestamp(), packet.protocolVersion, packet.type,
+                      packet.deviceTimeStamp, packet.voltage, packet.voltageMin, packet.voltageMax, packet.calibrationDry,
+                      packet.calibrationWet, packet.intervalIdx, packet.interval, int(packet.first))
+        else:
+            return
+        with self._lock:
+            if self._writerThread is None:
+                self._writerThread = threading.get_ident()
+            elif self._writerThread != threading.get_ident():
+                raise RuntimeError('Packets are stored by another thread already')
+            self._connection.execute(query, values)
+            self._connection.execute(
+                'INSERT INTO devices (device, count, firstTimestamp) VALUES (?, 1, ?) '
+                'ON CONFLICT(device) DO UPDATE SET count = count + 1, firstTimestamp = MIN(firstTimestamp, excluded.firstTimestamp)',
+                (packet.remoteDevice.id, packet.timestamp.timestamp()))
+            self._connection.commit()
+
+    def deviceHistory(self, device: RemoteDevice) -> PacketHistory:
+        query = 'SELECT {0} FROM {1} WHERE device = ? ORDER BY timestamp'
+        with self._reading() as connection:
+            connection.execute('BEGIN')  # both tables from the same commit
+            try:
+                measurementRows = connection.execute(query.format(self.MEASUREMENT_COLUMNS, 'measurements'), (device.id,)).fetchall()
+                calibrationRows = connection.execute(query.format(self.CALIBRATION_COLUMNS, 'calibrations'), (device.id,)).fetchall()
+            finally:
+                connection.execute('COMMIT')
+        packets = [self._measurementFromRow(row) for row in measurementRows] + [self._calibrationFromRow(row) for row in calibrationRows]
+        return PacketHistory.fromPackets(device, sorted(packets, key=lambda p: p.timestamp))
+
+    def deviceMeasurements(self, device: RemoteDevice, since: dt.datetime | None = None,
+                           until: dt.datetime | None = None) -> List[RemotePacketMeasurement]:
+        query, values = self._measurementsQuery(device, since, until)
+        with self._reading() as connection:
+            rows = connection.execute(query, values).fetchall()
+        return [self._measurementFromRow(row) for row in rows]
+
+    def deviceMeasurementChunks(self, device: RemoteDevice, since: dt.datetime | None = None, until: dt.datetime | None = None,
+                                rows: int = 1000) -> Iterator[List[RemotePacketMeasurement]]:
+        query, values = self._measurementsQuery(device, since, until)
+        with self._reading() as connection:
+            cursor = connection.execute(query, values)
+            while True:
+                chunk = cursor.fetchmany(rows)
+                if not chunk:
+                    return
+                yield [self._measurementFromRow(row) for row in chunk]
+
+    def _measurementsQuery(self, device: RemoteDevice, since: dt.datetime | None, until: dt.datetime | None) -> Tuple[str, List]:
+        query = 'SELECT {0} FROM measurements WHERE device = ?'.format(self.MEASUREMENT_COLUMNS)
+        values = [device.id]
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            values.append(since.timestamp())
+        if until is not None:
+            query += ' AND timestamp < ?'
+            values.append(until.timestamp())
+        return query + ' ORDER BY timestamp', values
+
+    def close(self, devices: Dict[RemoteDevice, Any]) -> None:
+        with self._lock:
+            self._connection.close()
+            for connection in self._readConnections:
+                connection.close()
+            self._readConnections = []
+
+    @contextlib.contextmanager
+    def _reading(self) -> Iterator[sqlite3.Connection]:
+        """ Connection for queries: the shared one under the lock on the writing thread, a thread's own otherwise """
+        if threading.get_ident() == self._writerThread:
+            with self._lock:
+                yield self._connection
+            return
+        connection = getattr(self._readers, 'connection', None)
+        if connection is None:
+            connection = self._readers.connection = sqlite3.connect(self.fileName, check_same_thread=False, isolation_level=None)
+            with self._lock:
+                self._readConnections.append(connection)
+        yield connection
+
+    @staticmethod
+    def _measurementFromRow(row: tuple) -> RemotePacketMeasurement:
+        device, timestamp, protocolVersion, type, deviceTimeStamp, measurement, voltage = row
+        return RemotePacketMeasurement(RemoteDevice(device), protocolVersion, type, measurement=measurement,
+                                       deviceTimeStamp=deviceTimeStamp, voltage=voltage,
+                                       datetime=dt.datetime.fromtimestamp(timestamp))
+
+    @staticmethod
+    def _calibrationFromRow(row: tuple) -> RemotePacketCalibration:
+        device, timestamp, protocolVersion, type, deviceTimeStamp, voltage, voltageMin, voltageMax, \
+            calibDry, calibWet, intervalIdx, interval, first = row
+        return RemotePacketCalibration(RemoteDevice(device), protocolVersion, type, calibDry=calibDry, calibWet=calibWet,
+                                       deviceTimeStamp=deviceTimeStamp, voltage=voltage, voltageMin=voltageMin,
+                                       voltageMax=voltageMax, intervalIdx=intervalIdx, interval=interval, first=bool(first),
+                                       datetime=dt.datetime.fromtimestamp(timestamp))
+
+
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+
+def createStorage(filename: str | None) -> PacketStorage:
+    """ Picks the storage by the database file extension: SQLite for *.sqlite/*.sqlite3/*.db, journal otherwise """
+    if not filename:
+        return PacketStorage()
+    if op.splitext(filename)[1].lower() in SQLITE_EXTENSIONS:
+        return SqliteStorage(filename)
+    return JournalStorage(filename)
@@ -1,4 +1,6 @@
 import re
+from collections.abc import Callable
+from typing import Dict, Tuple
 from remoteDevice import (
     RemoteDevice,
     RemotePacket,
@@ -46,35 +48,70 @@ def parseMessage(msg: str) -> dict:
     return msgDict
 
 
+class PacketFormat:
+    """ Body pattern of a single (protocol version, packet type) pair and the function building the packet from its match """
+    def __init__(self, body: re.Pattern, build: Callable[[RemoteDevice, int, int, re.Match], RemotePacket]):
+        self.body: re.Pattern = body
+        self.build: Callable[[RemoteDevice, int, int, re.Match], RemotePacket] = build
+
+
+PREAMBULE = re.compile(r'\[D(\d+)PRv(\d+)-(\d+)\]')
+packetFormats: Dict[Tuple[int, int], PacketFormat] = dict()
+
+def registerPacketFormat(protocolVersion: int, packetType: int, body: str):
+    """ Decorator registering a packet builder for the body following the '[D<id>PRv<version>-<type>]' preambule """
+    def decorator(build: Callable[[RemoteDevice, int, int, re.Match], RemotePacket]):
+        packetFormats[(protocolVersion, packetType)] = PacketFormat(re.compile(body), build)
+        return build
+    return decorator
+
+INT32_MAX = 2 ** 31 - 1  # packet values are stored in 32-bit columns
+
+def _checked(value: int) -> int:
+    """ Values too large to be stored (e.g. garbled digits) make the packet invalid """
+    if value > INT32_MAX:
+        raise ValueError('Value {0} is out of range'.format(value))
+    return value
+
+def _int(vStr: str) -> int:
+    return _checked(int(vStr))
+
+def _optionalInt(vStr: str) -> int:
+    """ Values unknown to the device are transmitted as '?' """
+    return 0 if vStr == '?' else _int(vStr)
+
+def _minutes(value: str, unit: str) -> int:
+    return _checked(int(value) * (60 if unit == 'h' else 1))
+
+@registerPacketFormat(1, 1, r'\s*v(\d+|\?)\s+t(\d+)([hm])\s+m(\d+)')
+def _measurementV1(device: RemoteDevice, protocolVersion: int, type: int, m: re.Match) -> RemotePacket:
+    return RemotePacketMeasurement(device, protocolVersion, type, measurement=_int(m[4]),
+                                   deviceTimeStamp=_minutes(m[2], m[3]), voltage=_optionalInt(m[1]))
+
+@registerPacketFormat(1, 2, r'\s*v(\d+|\?)\s+t(\d+)([hm])\s+vn(\d+|\?)\s+vx(\d+|\?)\s+cd(\d+)\s+cw(\d+)\s+idx(\d+)\s+int(\d+)\s+f(\d)')
+def _calibrationV1(device: RemoteDevice, protocolVersion: int, type: int, m: re.Match) -> RemotePacket:
+    return RemotePacketCalibration(device, protocolVersion, type, calibDry=_int(m[6]), calibWet=_int(m[7]),
+                                   deviceTimeStamp=_minutes(m[2], m[3]), voltage=_optionalInt(m[1]),
+                                   voltageMin=_optionalInt(m[4]), voltageMax=_optionalInt(m[5]),
+                                   intervalIdx=_int(m[8]), interval=_int(m[9]), first=m[10] != '0')
+
+
 def parsePacket(msg: str) -> RemotePacket:
-    preambule = re.search('\[D\d+PRv\d+-\d+\]', msg)
-    def safeParseInt(vStr: str, default: int = 0) -> int:
-        n = default
-        try:
-            n = int(vStr)
-        except:
-            pass
-        return n
-    if preambule:
-        preambuleStr = preambule.group()
-        device = RemoteDevice(id=safeParseInt(re.search('D\d+', preambuleStr).group()[1:]))
-        protocolVersion = safeParseInt(re.search('PRv\d+', preambuleStr).group()[3:])
-        body = msg[preambule.start() + len(preambuleStr):]
-        type = safeParseInt(re.search('-\d+\]', preambuleStr).group()[1:-1])
-        if type == 1:  # measurement update
-            timeSpan = re.search('t\d+(h|m)', body).group()
-            return RemotePacketMeasurement(device, protocolVersion, type, measurement=safeParseInt(re.search('m\d+', body).group()[1:]),
-                                             deviceTimeStamp=safeParseInt(timeSpan[1:-1]) * (1 if timeSpan[-1] == 'm' else 60),
-                                             voltage=safeParseInt(re.search('v(\d+|\?)', body).group()[1:]))
-        elif type == 2:  # calibration update
-            timeSpan = re.search('t\d+(h|m)', body).group()
-            return RemotePacketCalibration(device, protocolVersion, type, calibDry=safeParseInt(re.search('cd\d+', body).group()[2:]),
-                                           calibWet=safeParseInt(re.search('cw\d+', body).group()[2:]),
-                                           deviceTimeStamp=safeParseInt(timeSpan[1:-1]) * (1 if timeSpan[-1] == 'm' else 60),
-                                           voltage=safeParseInt(re.search('v(\d+|\?)', body).group()[1:]),
-                                           voltageMin=safeParseInt(re.search('vn(\d+|\?)', body).group()[2:]),
-                                           voltageMax=safeParseInt(re.search('vx(\d+|\?)', body).group()[2:]),
-                                           intervalIdx=safeParseInt(re.search('idx\d+', body).group()[3:]),
-                                           interval=safeParseInt(re.search('int\d+', body).group()[3:]),
-                                           first=bool(re.search('f\d', body).group()[1:]))
-    return RemotePacketError(None, -1, msg)
+    preambule = PREAMBULE.search(msg)
+    if not preambule:
+        return RemotePacketError(None, -1, -1, msg)
+    deviceId = int(preambule[1])
+    if deviceId > INT32_MAX:
+        return RemotePacketError(None, -1, -1, msg)
+    device = RemoteDevice(id=deviceId)
+    protocolVersion, type = int(preambule[2]), int(preambule[3])
+    packetFormat = packetFormats.get((protocolVersion, type))
+    if not packetFormat:
+        return RemotePacketError(device, protocolVersion, type, msg)
+    body = packetFormat.body.match(msg, preambule.end())
+    if not body:
+        return RemotePacketError(device, protocolVersion, type, msg)
+    try:
+        return packetFormat.build(device, protocolVersion, type, body)
+    except ValueError:
+        return RemotePacketError(device, protocolVersion, type, msg)
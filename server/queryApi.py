@@ -0,0 +1,267 @@
+import datetime as dt, itertools, json, secrets, threading
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+from deviceManager import DeviceManager, RemoteDeviceEntry
+from remoteDevice import RemoteDevice, RemotePacket, RemotePacketCalibration, RemotePacketMeasurement
+from timeSeries import ROLLUP_RESOLUTIONS, Rollup
+
+
+class QueryError(Exception):
+    def __init__(self, status: int, msg: str):
+        super().__init__(msg)
+        self.status: int = status
+
+
+def parseTime(value: str) -> dt.datetime:
+    """ POSIX seconds or ISO 8601, converted to the naive local time the packets are stamped with """
+    try:
+        return dt.datetime.fromtimestamp(float(value))
+    except (ValueError, OverflowError, OSError):
+        pass
+    try:
+        timestamp = dt.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise QueryError(400, 'Invalid time: {0}'.format(value))
+    return timestamp.astimezone().replace(tzinfo=None) if timestamp.tzinfo else timestamp
+
+
+def isoTime(timestamp: dt.datetime | None) -> str | None:
+    return timestamp.astimezone().isoformat(timespec='seconds') if timestamp else None
+
+
+def measurementJson(packet: RemotePacketMeasurement | None) -> Dict | None:
+    if packet is None:
+        return None
+    return {'timestamp': isoTime(packet.timestamp), 'measurement': packet.measurement,
+            'voltage': packet.voltage if packet.voltage else None, 'deviceTimeStamp': packet.deviceTimeStamp}
+
+
+def calibrationJson(packet: RemotePacketCalibration | None) -> Dict | None:
+    if packet is None:
+        return None
+    return {'timestamp': isoTime(packet.timestamp), 'calibrationDry': packet.calibrationDry,
+            'calibrationWet': packet.calibrationWet, 'interval': packet.interval,
+            'voltage': packet.voltage if packet.voltage else None, 'deviceTimeStamp': packet.deviceTimeStamp}
+
+
+def rollupJson(rollup: Rollup) -> Dict:
+    return {'start': isoTime(rollup.start), 'count': rollup.count, 'min': rollup.measurementMin,
+            'max': rollup.measurementMax, 'mean': rollup.measurementMean, 'last': rollup.measurementLast,
+            'voltageMin': rollup.voltageMin if rollup.voltageCount else None,
+            'voltageMax': rollup.voltageMax if rollup.voltageCount else None,
+            'voltageMean': rollup.voltageMean if rollup.voltageCount else None}
+
+
+def deviceJson(device: RemoteDevice, entry: RemoteDeviceEntry) -> Dict:
+    summary = entry.summary
+    return {'id': device.id, 'count': summary.count, 'firstTimestamp': isoTime(summary.firstTimestamp),
+            'latestMeasurement': measurementJson(summary.latestMeasurement),
+            'latestCalibration': calibrationJson(summary.latestCalibration)}
+
+
+class QueryApi:
+    """ Read-only JSON API over the DeviceManager for dashboards, served from daemon threads:
+
+        GET /devices                            every device with its counters and latest readings
+        GET /devices/<id>                       a single device
+        GET /devices/<id>/measurements          measurements within ?since=&until= (POSIX seconds or ISO 8601),
+                                                with &resolution=300|3600|86400 - rollups of the measurements
+
+        Every response carries an ETag made of the version of the data it depends on: the versions are counters
+        bumped for a device (and the devices list) by each of its packets, so a conditional request is answered
+        with 304 before any data is read. Responses up to cacheMaxBytes are kept until a packet of their device
+        arrives, larger ones are not cached and are serialized and streamed in chunks of chunkRows rows.
+    """
+    def __init__(self, deviceManager: DeviceManager, port: int, host: str = '127.0.0.1',
+                 cacheMaxBytes: int = 256 * 1024, cacheEntries: int = 32, chunkRows: int = 1000):
+        self.deviceManager: DeviceManager = deviceManager
+        self.cacheMaxBytes: int = cacheMaxBytes
+        self.cacheEntries: int = cacheEntries  # responses cached per device
+        self.chunkRows: int = chunkRows
+        self._instance: str = secrets.token_hex(4)  # ETags of an earlier run must not match
+        self._lock = threading.Lock()
+        self._version: int = 0  # of the devices list
+        self._deviceVersions: Dict[int, int] = dict()
+        self._cache: Dict[int | None, Dict[str, Tuple[str, bytes]]] = dict()  # device id, None - list -> target -> (etag, body)
+        self.hits: int = 0
+        self.misses: int = 0
+        self.notModified: int = 0
+        deviceManager.addPacketListener(self.invalidate)
+
+        api = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive and chunked responses
+
+            def do_GET(self):
+                api.handle(self)
+
+            def log_message(self, format, *args):  # dashboards poll, a console line each would drown the packets
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='QueryApi', daemon=True)
+        self._thread.start()
+
+    def invalidate(self, packet: RemotePacket) -> None:
+        """ Packet listener, runs on the ingest thread so only bumps counters and drops references """
+        deviceId = packet.remoteDevice.id
+        with self._lock:
+            self._version += 1
+            self._deviceVersions[deviceId] = self._deviceVersions.get(deviceId, 0) + 1
+            self._cache.pop(deviceId, None)
+            self._cache.pop(None, None)
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler) -> None:
+        try:
+            self._handle(request)
+        except ConnectionError:  # the client has gone away, e.g. a dashboard tab closed mid-response
+            request.close_connection = True
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        url = urlsplit(request.path)
+        try:
+            deviceId, respond = self._route(url.path.rstrip('/').split('/')[1:], parse_qs(url.query))
+        except QueryError as e:
+            self._sendJson(request, e.status, json.dumps({'error': str(e)}).encode('utf-8'))
+            return
+        except Exception as e:
+            self._sendError(request, e)
+            return
+
+        with self._lock:
+            version = self._version if deviceId is None else self._deviceVersions.get(deviceId, 0)
+            etag = '"{0}-{1}"'.format(self._instance, version)
+            cached = self._cache.get(deviceId, dict()).get(request.path)
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            self.notModified += 1
+            request.send_response(304)
+            request.send_header('ETag', etag)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+        if cached and cached[0] == etag:
+            self.hits += 1
+            self._sendJson(request, 200, cached[1], etag)
+            return
+
+        self.misses += 1
+        try:
+            body = respond()
+        except QueryError as e:
+            self._sendJson(request, e.status, json.dumps({'error': str(e)}).encode('utf-8'))
+            return
+        except Exception as e:
+            self._sendError(request, e)
+            return
+        if isinstance(body, bytes):
+            self._sendJson(request, 200, body, etag)
+            if len(body) <= self.cacheMaxBytes:
+                self._store(deviceId, request.path, etag, body)
+            return
+        self._streamJson(request, body, etag)
+
+    def _route(self, parts: List[str], query: Dict[str, List[str]]) -> Tuple[int | None, Callable[[], bytes | Iterator[bytes]]]:
+        """ Device the response depends on (None - all of them) and the function producing it """
+        if parts == ['devices']:
+            return None, lambda: json.dumps([deviceJson(d, e) for d, e in sorted(self.deviceManager.devices.items(),
+                                                                                  key=lambda item: item[0].id)]).encode('utf-8')
+        if len(parts) not in (2, 3) or parts[0] != 'devices' or not parts[1].isdigit():
+            raise QueryError(404, 'Unknown path')
+        device = RemoteDevice(int(parts[1]))
+        if len(parts) == 2:
+            return device.id, lambda: json.dumps(deviceJson(device, self._entry(device))).encode('utf-8')
+        if parts[2] != 'measurements':
+            raise QueryError(404, 'Unknown path')
+
+        since = parseTime(query['since'][0]) if 'since' in query else None
+        until = parseTime(query['until'][0]) if 'until' in query else None
+        if 'resolution' in query:
+            try:
+                resolution = int(query['resolution'][0])
+            except ValueError:
+                resolution = 0
+            if resolution not in ROLLUP_RESOLUTIONS:
+                raise QueryError(400, 'Resolution must be one of {0}'.format(', '.join(map(str, ROLLUP_RESOLUTIONS))))
+            return device.id, lambda: self._rows(device, since, until, resolution)
+        return device.id, lambda: self._rows(device, since, until, 0)
+
+    def _entry(self, device: RemoteDevice) -> RemoteDeviceEntry:
+        entry = self.deviceManager.devices.get(device)
+        if entry is None:
+            raise QueryError(404, 'Unknown device#{0}'.format(device.id))
+        return entry
+
+    def _rows(self, device: RemoteDevice, since: dt.datetime | None, until: dt.datetime | None,
+              resolution: int) -> bytes | Iterator[bytes]:
+        """ Measurements or rollups as a JSON array, bytes if they fit in a chunk of chunkRows rows and chunks
+            otherwise, the measurements of each chunk are read from the history only once it is serialized
+        """
+        entry = self._entry(device)
+        if resolution:
+            rollups = self.deviceManager.deviceRollups(device, resolution, since, until)
+            chunks, toJson = (rollups[start:start + self.chunkRows] for start in range(0, len(rollups), self.chunkRows)), rollupJson
+        else:
+            chunks, toJson = entry.measurementChunks(since, until, self.chunkRows), measurementJson
+        first, second = next(chunks, []), next(chunks, None)
+        if second is None:
+            return json.dumps([toJson(row) for row in first]).encode('utf-8')
+
+        def serialized() -> Iterator[bytes]:
+            separator = b'['
+            for chunk in itertools.chain((first, second), chunks):
+                yield separator + json.dumps([toJson(row) for row in chunk])[1:-1].encode('utf-8')
+                separator = b','
+            yield b']'
+        return serialized()
+
+    def _store(self, deviceId: int | None, target: str, etag: str, body: bytes) -> None:
+        with self._lock:
+            version = self._version if deviceId is None else self._deviceVersions.get(deviceId, 0)
+            if etag != '"{0}-{1}"'.format(self._instance, version):  # a packet has arrived meanwhile
+                return
+            responses = self._cache.setdefault(deviceId, dict())
+            responses.pop(target, None)
+            responses[target] = (etag, body)
+            while len(responses) > self.cacheEntries:
+                del responses[next(iter(responses))]
+
+    @staticmethod
+    def _headers(request: BaseHTTPRequestHandler, status: int, etag: str | None) -> None:
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Access-Control-Allow-Origin', '*')
+        if etag:
+            request.send_header('ETag', etag)
+            request.send_header('Cache-Control', 'no-cache')  # may be kept, but has to be revalidated
+
+    def _sendJson(self, request: BaseHTTPRequestHandler, status: int, body: bytes, etag: str | None = None) -> None:
+        self._headers(request, status, etag)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _sendError(self, request: BaseHTTPRequestHandler, e: Exception) -> None:
+        print('Exception raised when answering {0}:\n\t>>{1}'.format(request.path, str(e)))
+        self._sendJson(request, 500, json.dumps({'error': 'Internal error'}).encode('utf-8'))
+
+    def _streamJson(self, request: BaseHTTPRequestHandler, chunks: Iterator[bytes], etag: str) -> None:
+        self._headers(request, 200, etag)
+        request.send_header('Transfer-Encoding', 'chunked')
+        request.end_headers()
+        try:
+            for chunk in chunks:
+                request.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        except ConnectionError:
+            raise
+        except Exception as e:  # 200 has been sent already, closing without the last chunk tells the body is cut short
+            print('Exception raised when streaming {0}:\n\t>>{1}'.format(request.path, str(e)))
+            request.close_connection = True
+            return
+        request.wfile.write(b'0\r\n\r\n')
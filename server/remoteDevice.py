@@ -1,6 +1,15 @@
 import datetime as dt
 
+def _restoreSlots(obj, state) -> None:
+    """ Restores both, the objects pickled before __slots__ have been introduced and the slotted ones """
+    if isinstance(state, tuple):  # (__dict__, slots) pair
+        state = {**(state[0] or {}), **state[1]}
+    for k, v in state.items():
+        setattr(obj, k, v)
+
 class RemoteDevice:
+    __slots__ = ('id',)
+
     def __init__(self, id: int):
         self.id: int = id
 
@@ -16,7 +25,12 @@ class RemoteDevice:
     def __str__(self):
         return 'Device#{0}'.format(self.id)
 
+    def __setstate__(self, state):
+        _restoreSlots(self, state)
+
 class RemotePacket:
+    __slots__ = ('remoteDevice', 'protocolVersion', 'type', 'timestamp')
+
     def __init__(self, remoteDevice: RemoteDevice, protoclVersion: int, type: int, datetime: dt.datetime=None):
         self.remoteDevice: RemoteDevice = remoteDevice
         self.protocolVersion: int = protoclVersion
@@ -26,17 +40,25 @@ class RemotePacket:
     def __str__(self):
         return '[{3} {0} PRv{1} Type:{2}]'.format(self.remoteDevice, self.protocolVersion, self.type, self.timestamp)
 
+    def __setstate__(self, state):
+        _restoreSlots(self, state)
+
 class RemotePacketError(RemotePacket):
+    __slots__ = ('msg',)
+
     def __init__(self, remoteDevice: RemoteDevice, protoclVersion: int, type: int, msg: str):
         super().__init__(remoteDevice, protoclVersion, type)
         self.msg = msg
 
     def __str__(self):
-        return '{0} Message - {1}'.format((RemotePacketError, self).__str__(), self.msg)
+        return '{0} Message - {1}'.format(super(RemotePacketError, self).__str__(), self.msg)
 
 class RemotePacketMeasurement(RemotePacket):
-    def __init__(self, remoteDevice: RemoteDevice, protoclVersion: int, type: int, measurement: int, deviceTimeStamp: int = 0, voltage: int = 0):
-        super().__init__(remoteDevice, protoclVersion, type)
+    __slots__ = ('measurement', 'deviceTimeStamp', 'voltage')
+
+    def __init__(self, remoteDevice: RemoteDevice, protoclVersion: int, type: int, measurement: int, deviceTimeStamp: int = 0, voltage: int = 0,
+                 datetime: dt.datetime = None):
+        super().__init__(remoteDevice, protoclVersion, type, datetime)
         self.measurement: int = measurement
         self.deviceTimeStamp: int = deviceTimeStamp
         self.voltage: int = voltage
@@ -46,11 +68,14 @@ class RemotePacketMeasurement(RemotePacket):
                                                                               self.measurement, self.deviceTimeStamp, self.voltage)
 
 class RemotePacketCalibration(RemotePacket):
+    __slots__ = ('deviceTimeStamp', 'voltage', 'voltageMin', 'voltageMax', 'calibrationDry', 'calibrationWet',
+                 'intervalIdx', 'interval', 'first')
+
     def __init__(self, remoteDevice: RemoteDevice, protoclVersion: int, type: int,
                  calibDry: int, calibWet: int, deviceTimeStamp: int = 0,
                  voltage: int = 0, voltageMin: int = 0, voltageMax: int = 0,
-                 intervalIdx: int = 2, interval: int = 0, first: bool = 0):
-        super().__init__(remoteDevice, protoclVersion, type)
+                 intervalIdx: int = 2, interval: int = 0, first: bool = 0, datetime: dt.datetime = None):
+        super().__init__(remoteDevice, protoclVersion, type, datetime)
         self.deviceTimeStamp: int = deviceTimeStamp
         self.voltage: int = voltage
         self.voltageMin: int = voltageMin
@@ -1,9 +1,12 @@
 import math
 
-import serial, time
+import asyncio, concurrent.futures, serial, threading, time
 from collections.abc import Callable
-from util import listSerialPorts
+from typing import Dict, List
+from util import detectReceivers, listSerialPorts, portIdentifier, resolvePort, serialPortInfos
 from deviceManager import DeviceManager
+from fleetSimulator import SimulatedFleet
+from metrics import READ_LATENCY
 
 
 class DataObtainer:
@@ -11,47 +14,192 @@ class DataObtainer:
     def __init__(self):
         pass
 
+    @property
+    def name(self) -> str:
+        """ Identifies the obtainer in logs and statistics """
+        return type(self).__name__
+
     def setup(self, *args, **kwargs) -> None:
         pass
 
     def listen(self, callback: Callable[[str], None], blockthread: bool = False) -> None:
         pass
 
+    def stop(self) -> None:
+        """ Asks listen() to return """
+        pass
+
+    def stats(self) -> Dict[str, int | float | None]:
+        """ Health counters of the obtainer """
+        return dict()
+
+    async def listenAsync(self, callback: Callable[[str], None]) -> None:
+        """ Runs the blocking listen() in a daemon thread, callback is invoked in the event loop and must not block """
+        loop = asyncio.get_running_loop()
+        finished = concurrent.futures.Future()
+        def run():
+            try:
+                self.listen(lambda msg: loop.call_soon_threadsafe(callback, msg))
+                finished.set_result(None)
+            except BaseException as e:
+                finished.set_exception(e)
+        threading.Thread(target=run, name=self.name, daemon=True).start()
+        await asyncio.wrap_future(finished)
+
+
+class LineFramer:
+    """ Splits a byte stream into lines, the incomplete tail is kept in the buffer until its newline arrives """
+    def __init__(self, maxLineLength: int = 1024):
+        self.maxLineLength: int = maxLineLength
+        self.buffer: bytearray = bytearray()
+
+    def feed(self, data: bytes) -> List[str]:
+        """ Returns the lines completed by data, each terminated with '\\n' """
+        self.buffer += data
+        lines = []
+        start = 0
+        end = self.buffer.find(b'\n')
+        while end >= 0:
+            line = self.buffer[start:end].rstrip(b'\r')
+            if line:
+                lines.append(line.decode('utf-8', errors='replace') + '\n')
+            start = end + 1
+            end = self.buffer.find(b'\n', start)
+        del self.buffer[:start]
+        if len(self.buffer) > self.maxLineLength:  # garbage without line breaks
+            print('Dropping {0} bytes without a line break'.format(len(self.buffer)))
+            self.buffer.clear()
+        return lines
+
 
 class DebugMonitor(DataObtainer):
-    def __init__(self, interval: float = 5, type: str = 'sine'):
+    """ Fake receiver: a single device 'sine' signal or, with type 'fleet', a SimulatedFleet of devices lines
+
+        :param rate: lines per second of the fleet, 0 - as fast as the callback takes them
+        :param limit: number of lines to send before listen() returns, None - endless
+    """
+    def __init__(self, interval: float = 5, type: str = 'sine', devices: int = 100, rate: float = 10, seed: int = 0,
+                 malformedRate: float = 0.01, duplicateRate: float = 0.02, limit: int | None = None):
+        super().__init__()
+        self.port: str = 'debug'
         self.interval = interval
-        if type.lower() == 'sine':
+        self.type: str = type.lower()
+        self.rate: float = rate
+        self.limit: int | None = limit
+        self.fleet: SimulatedFleet | None = None
+        self._stopping = threading.Event()
+        if self.type == 'sine':
             self.fn = lambda x: 150 * (0.5 * math.sin(0.03 * x) + 0.5) + 200
+        elif self.type == 'fleet':
+            self.fleet = SimulatedFleet(devices, seed, malformedRate, duplicateRate)
         else:
-            raise NotImplemented('The \'{0}\' type of signal is not implemented'.format(type))
+            raise NotImplementedError('The \'{0}\' type of signal is not implemented'.format(type))
+
+    @property
+    def name(self) -> str:
+        return self.port
+
+    def setup(self, port: str = None) -> None:
+        if port:
+            self.port = port
+
+    def stop(self) -> None:
+        self._stopping.set()
 
     def listen(self, callback: Callable[[str], None], blockthread: bool = True) -> None:
         if not blockthread:
-            raise NotImplemented('Non-blocking behavior is not implemented yet')
+            raise NotImplementedError('Non-blocking behavior is not implemented yet')
+        if self.fleet:
+            self._listenFleet(callback)
+            return
 
-        time.sleep(self.interval)
-        callback('[D9PRv1-2] v? t0m vn? vx? cd350 cw200 idx0 int{0} f1'.format(self.interval))
-        time.sleep(self.interval)
+        if self._stopping.wait(self.interval):
+            return
+        callback('> [D9PRv1-2] v? t0m vn? vx? cd350 cw200 idx0 int{0} f1\n'.format(int(self.interval)))
         startTime = time.time()
-        while True:
+        while not self._stopping.wait(self.interval):
             deltat = time.time() - startTime
-            callback('[D9PRv1-1] v? t{0}m m{1}'.format(int(deltat / 60), self.fn(deltat)))
-            time.sleep(self.interval)
+            callback('> [D9PRv1-1] v? t{0}m m{1}\n'.format(int(deltat / 60), int(self.fn(deltat))))
+
+    def _listenFleet(self, callback: Callable[[str], None]) -> None:
+        """ Sends the lines in batches of the ones due by now, so high rates do not sleep per line """
+        start = time.monotonic()
+        sent = 0
+        lines = self.fleet.lines()
+        while not self._stopping.is_set() and (self.limit is None or sent < self.limit):
+            due = self.limit if self.limit is not None else sent + 1000
+            if self.rate > 0:
+                due = min(due, int((time.monotonic() - start) * self.rate) + 1)
+                if due <= sent:
+                    self._stopping.wait((sent + 1) / self.rate - (time.monotonic() - start))
+                    continue
+            for _ in range(due - sent):
+                callback(next(lines))
+            sent = due
+        elapsed = time.monotonic() - start
+        print('{0} sent {1} lines in {2:.1f}s ({3:.0f} lines/s)'.format(self.name, sent, elapsed, sent / max(elapsed, 1e-9)))
 
 class SerialMonitor(DataObtainer):
+    """ Reads the receiver lines from a serial port.
+
+        When the port disappears (e.g. the USB cable glitches) or fails, the monitor keeps trying to reopen it with
+        exponential backoff. The port is looked up again by its identifier each time, so the receiver is found even
+        if it is re-enumerated under another device name.
+    """
     def __init__(self):
         super().__init__()
         self.port = None
+        self.identifier: str | None = None  # stable identifier of the port, see util.portIdentifier
         self.baudRate = None
         self.timeout = None
+        self.readSize = None
+        self.reconnectDelay: float = 0.5
+        self.maxReconnectDelay: float = 30
+        self.framer: LineFramer = LineFramer()
+
+        self.connected: bool = False
+        self.reconnects: int = 0
+        self.downtime: float = 0  # seconds spent disconnected, not including the current outage
+        self._disconnectedAt: float | None = None  # monotonic time the connection has been lost at, None - not lost
+        self._stopping = threading.Event()
 
-    def setup(self, port: str = None, baudrate: int = 115200, timeout: int = 10) -> bool:
-        """ Takes control of the thread for setting up the """
+    @property
+    def name(self) -> str:
+        return self.identifier if self.identifier else self.port if self.port else super().name
+
+    def stats(self) -> Dict[str, int | float | None]:
+        outage = time.monotonic() - self._disconnectedAt if self._disconnectedAt is not None else 0
+        return {'port': self.port, 'connected': self.connected, 'reconnects': self.reconnects,
+                'downtime': self.downtime + outage}
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    def setup(self, port: str = None, baudrate: int = 115200, timeout: float = 1, readSize: int = 256, maxLineLength: int = 1024,
+              reconnectDelay: float = 0.5, maxReconnectDelay: float = 30) -> bool:
+        """ Takes control of the thread for setting up the port
+
+            :param port: device name, identifier (see util.portIdentifier) or USB serial number of the port;
+                'auto' - the first port a Moistensor receiver is detected on
+            :param timeout: seconds a single read waits for the first byte
+            :param readSize: maximum number of bytes taken from the port at once
+            :param reconnectDelay: seconds before the first attempt to reopen a lost port, doubled after each failure
+                up to maxReconnectDelay
+        """
         self.port = port
         self.baudRate = baudrate
         self.timeout = timeout
+        self.readSize = readSize
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.framer = LineFramer(maxLineLength)
+        if not self._select():
+            return False
+        self.identifier = next((portIdentifier(info) for info in serialPortInfos() if info.device == self.port), self.port)
+        return True
 
+    def _select(self) -> bool:
+        """ Resolves the requested port to a device name, asks the user if no port has been requested """
         ports = listSerialPorts()
         if not len(ports):
             print('No Serial ports available')
@@ -65,26 +213,26 @@ class SerialMonitor(DataObtainer):
             print('Port ' + self.port + ' is not available!')
             return False
 
-        if len(ports) == 1:
-            if self.port and ports[0].lower() != self.port.lower():  # the only available port mismatch requested port
-                return portNotAvailable()
-            if self.port:  # requested port matches the only available one
-                return portSelected(ports[0])
-            else:  # no requested port and only one available
-                print('Selected the only available port: ' + ports[0])
-                self.port = ports[0]
-            return True
+        if self.port and self.port.lower() == 'auto':  # the first port a receiver speaks on
+            detected = detectReceivers(ports)
+            if not len(detected):
+                print('No Moistensor receiver detected')
+                return False
+            return portSelected(detected[0])
 
-        if self.port:  # port requested
-            reqAvail = [i for i, p in enumerate(ports) if p.lower() == self.port.lower()]
-            if not len(reqAvail):  # no port from list of available ports match the requested one
-                return portNotAvailable()
-            return portSelected(ports[reqAvail[0]])  # requested port has been found
+        if self.port:  # port requested by its name or identifier
+            resolved = resolvePort(self.port)
+            return portSelected(resolved) if resolved else portNotAvailable()
+
+        if len(ports) == 1:  # no requested port and only one available
+            print('Selected the only available port: ' + ports[0])
+            self.port = ports[0]
+            return True
 
         # port is not requested
         print('The following ports are available:')
-        for i, p in enumerate(ports):
-            print('[' + str(i) + '] ' + p)
+        for i, info in enumerate(serialPortInfos()):
+            print('[' + str(i) + '] ' + info.device + ' (' + info.description + ', ' + portIdentifier(info) + ')')
         print('X - to exit')  # TODO: exit from loop does not work
         print('Choose correct port (0-' + str(len(ports) - 1) + '): ', end='')
         inp = input()
@@ -92,7 +240,7 @@ class SerialMonitor(DataObtainer):
             inp = int(inp)
         except:
             inp = -1
-        if inp >= 0 or inp < len(ports):
+        if 0 <= inp < len(ports):
             self.port = ports[inp]
             print('Port ' + self.port + ' has been chosen!')
             return True
@@ -101,33 +249,70 @@ class SerialMonitor(DataObtainer):
         return False
 
     def listen(self, callback: Callable[[str], None], blockthread: bool = True) -> None:
-        """ Blocking function that listens for serial port """
+        """ Blocking function that listens for serial port and calls back with every '[D..]' line as soon as it is complete.
+            Returns only once stop() has been called
+        """
         if not blockthread:
-            raise NotImplemented('Non-blocking version if not implemented yet')
+            raise NotImplementedError('Non-blocking version is not implemented yet')
 
-        ser = None
-        try:
-            ser = serial.Serial(self.port, self.baudRate, timeout=self.timeout)
-        except:
-            print('Serial could not been opened')
-
-        if ser and ser.isOpen():
-            print(ser.name)
-            ser.flushInput()
-            while True:
-                # try:
-                    msg = ser.readall().decode('utf-8')
-                    if not msg:
+        delay = self.reconnectDelay
+        while not self._stopping.is_set():
+            ser = self._open()
+            if ser is None:
+                self._stopping.wait(delay)
+                delay = min(self.maxReconnectDelay, delay * 2)
+                continue
+
+            self._connected()
+            delay = self.reconnectDelay
+            try:
+                print(ser.name)
+                ser.flushInput()
+                while not self._stopping.is_set():
+                    # Wait for a single byte, then take everything that has arrived meanwhile
+                    data = ser.read(max(1, min(ser.in_waiting, self.readSize)))
+                    if not data:
                         continue
-                    # print('Received: ' + msg)
-                    if callback:
-                        callback(msg)
-                # except KeyboardInterrupt:
-                #     break
-                # except:
-                #     print('Error while reading Serial port')
+                    start = time.perf_counter()
+                    for line in self.framer.feed(data):
+                        if '[D' not in line:  # receiver diagnostics, e.g. '[RF] Received corrupted data.'
+                            print(line, end='')
+                            continue
+                        if callback:
+                            callback(line)
+                        READ_LATENCY.observe(time.perf_counter() - start)
+            except (OSError, serial.SerialException) as e:
+                print('Serial port {0} has been lost:\n\t>>{1}'.format(self.port, str(e)))
+            finally:
+                ser.close()
+                self._disconnected()
+
+    def _open(self) -> serial.Serial | None:
+        port = resolvePort(self.identifier) if self.identifier else self.port
+        if port is None:
+            return None
+        try:
+            ser = serial.Serial(port, self.baudRate, timeout=self.timeout)
+        except (OSError, ValueError, serial.SerialException) as e:
+            print('Serial could not been opened:\n\t>>{0}'.format(str(e)))
+            return None
+        self.port = port
+        return ser
+
+    def _connected(self) -> None:
+        if self._disconnectedAt is not None:
+            self.downtime += time.monotonic() - self._disconnectedAt
+            self._disconnectedAt = None
+        self.connected = True
+
+    def _disconnected(self) -> None:
+        self.connected = False
+        self.framer.buffer.clear()  # the rest of the line is gone with the connection
+        if not self._stopping.is_set():  # closing the port on stop() is not an outage
+            self._disconnectedAt = time.monotonic()
+            self.reconnects += 1
 
 
 class HomeAssistantObtainer(DataObtainer):
     def __int__(self):
-        raise NotImplemented()
\ No newline at end of file
+        raise NotImplementedError()
\ No newline at end of file
@@ -0,0 +1,47 @@
+import os.path as op, queue, threading
+from telegram import Bot, Update, User
+from telegram.ext import CommandHandler, ConversationHandler, Dispatcher
+from botPersistence import KeyedPersistence
+
+
+def commandUpdate(bot: Bot, updateId: int, text: str) -> Update:
+    return Update.de_json({'update_id': updateId, 'message': {
+        'message_id': updateId, 'date': 0, 'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        'chat': {'id': 7, 'type': 'private'}, 'from': {'id': 7, 'is_bot': False, 'first_name': 'U'}}}, bot)
+
+
+def test_run_async_handler_in_persistent_conversation(tmp_path):
+    filename = op.join(tmp_path, 'tgbot.sqlite')
+    persistence = KeyedPersistence(filename)
+    bot = Bot('123456:test')
+    bot._bot = User(1, 'Moistensor', True, username='moistensor_bot')  # instead of asking getMe
+    dispatcher = Dispatcher(bot, queue.Queue(), persistence=persistence)
+    release, finished = threading.Event(), threading.Event()
+    def slow(upd, ctx):
+        release.wait(5)
+        return 1
+    conversation = ConversationHandler(entry_points=[CommandHandler('start', lambda upd, ctx: 0)],
+                                       states={0: [CommandHandler('slow', slow, run_async=True)],
+                                               1: [CommandHandler('done', lambda upd, ctx: finished.set() or 0)]},
+                                       fallbacks=[], name='test', persistent=True)
+    dispatcher.add_handler(conversation)
+    ready = threading.Event()
+    threading.Thread(target=dispatcher.start, args=(ready,), daemon=True).start()
+    ready.wait()
+
+    dispatcher.process_update(commandUpdate(bot, 1, '/start'))
+    dispatcher.process_update(commandUpdate(bot, 2, '/slow'))  # still running: the old state is persisted
+    persistence._commit()
+    assert KeyedPersistence(filename).get_conversations('test') == {(7, 7): 0}
+
+    release.set()
+    conversation.conversations[(7, 7)][1].done.wait(5)
+    persistence.update_conversation('test', (7, 7), conversation.conversations[(7, 7)])  # done: the result is persisted
+    persistence._commit()
+    assert KeyedPersistence(filename).get_conversations('test') == {(7, 7): 1}
+
+    dispatcher.process_update(commandUpdate(bot, 3, '/done'))  # resolves the state to 1 first
+    assert finished.wait(5)
+    dispatcher.stop()
+    persistence.flush()
+    assert KeyedPersistence(filename).get_conversations('test') == {(7, 7): 0}
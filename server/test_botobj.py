@@ -0,0 +1,76 @@
+import contextlib, io, os.path as op, threading
+from telegram import Update, User
+from botPersistence import KeyedPersistence
+from botobj import TelegramBot
+from deviceManager import DeviceManager
+
+LINES = ['> [D1PRv1-1] v? t5m m300\n', '> [D1PRv1-1] v? t0m m99999999999\n', '> [D1PRv1-9] garbage\n']
+
+
+def test_parse_errors_are_not_sent_to_chats(tmp_path):
+    manager = DeviceManager('', duplicateWindow=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        packets = [manager.handleMessageReceived(line) for line in LINES]
+    bot = TelegramBot('123456:test', op.join(tmp_path, 'tgbot.sqlite'), manager)
+    sent = []
+    bot.digest.send = lambda chatId, msg: sent.append((chatId, msg))
+    for chatId, window in ((1, 0), (2, 3600)):
+        bot.addSubscribedChat(chatId)
+        bot.subscribedChats[chatId].appendDevice(1)
+        bot.subscribedChats[chatId].digestWindow = window
+        bot.subscribers[1] = bot.subscribers.get(1, frozenset()) | {chatId}
+
+    for packet in packets:
+        bot.handlePacketReceived(packet)
+    bot.digest.stop()
+    bot.persistence.flush()
+
+    assert [chatId for chatId, _ in sent] == [1, 2]  # the measurement right away, then the digest with it alone
+    assert all('Message -' not in msg for _, msg in sent)
+    assert sent[1][1].count('Device#') == 1
+
+
+def startOffline(bot: TelegramBot) -> None:
+    """ Runs the dispatcher and its async workers without polling """
+    bot.updater.bot._bot = User(1, 'Moistensor', True, username='moistensor_bot')  # instead of asking getMe
+    ready = threading.Event()
+    threading.Thread(target=bot.dispatcher.start, args=(ready,), daemon=True).start()
+    ready.wait()
+
+
+def commandUpdate(bot: TelegramBot, text: str) -> Update:
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        'chat': {'id': 7, 'type': 'private'}, 'from': {'id': 7, 'is_bot': False, 'first_name': 'U'}}}, bot.updater.bot)
+
+
+def test_visualize_persists_a_plain_state(tmp_path):
+    bot = TelegramBot('123456:test', op.join(tmp_path, 'tgbot.sqlite'), DeviceManager('', duplicateWindow=0))
+    rendered = threading.Event()
+    bot.sendGraph = lambda message, device, window: rendered.set()
+    conversation = bot.dispatcher.handlers[0][0]
+    conversation.conversations[(7, 7)] = bot.IN_MAIN_STATE
+
+    startOffline(bot)
+    bot.dispatcher.process_update(commandUpdate(bot, '/visualize 1 2'))
+    assert rendered.wait(5)
+    bot.dispatcher.stop()
+    bot.persistence.flush()
+
+    assert conversation.conversations[(7, 7)] == bot.IN_MAIN_STATE
+    stored = KeyedPersistence(op.join(tmp_path, 'tgbot.sqlite'))
+    assert stored.get_conversations('Moistensor_v0.3') == {(7, 7): bot.IN_MAIN_STATE}
+    stored.flush()
+
+
+def test_broadcast_tells_whether_every_chat_got_the_message_queued(tmp_path):
+    bot = TelegramBot('123456:test', op.join(tmp_path, 'tgbot.sqlite'), DeviceManager('', duplicateWindow=0))
+    release = threading.Event()
+    bot.broadcaster.send = lambda chatId, msg: release.wait(5)
+    bot.broadcaster.maxPending = 2
+
+    assert bot.broadcastMessageToChats([1, 2], 'hello')
+    assert not bot.broadcastMessageToChats([3, 4], 'hello')
+    release.set()
+    bot.broadcaster.stop()
+    bot.persistence.flush()
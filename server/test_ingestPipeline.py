@@ -0,0 +1,36 @@
+import asyncio, contextlib, io, threading
+from deviceManager import DeviceManager
+from ingestPipeline import IngestPipeline
+from serialMonitor import DataObtainer
+
+
+class ListObtainer(DataObtainer):
+    def __init__(self, lines):
+        super().__init__()
+        self.lines = lines
+
+    def listen(self, callback, blockthread: bool = False) -> None:
+        for line in self.lines:
+            callback(line)
+
+
+def test_packets_are_stored_on_a_single_thread(tmp_path):
+    manager = DeviceManager(str(tmp_path / 'db.sqlite'), duplicateWindow=0)
+    threads = set()
+    handleMessageReceived = manager.handleMessageReceived
+    def storing(msg):
+        threads.add(threading.get_ident())
+        return handleMessageReceived(msg)
+    manager.handleMessageReceived = storing
+    pipeline = IngestPipeline(manager)
+    notified = []
+    pipeline.addNotifier('test', lambda msg, packet: notified.append(packet))
+
+    lines = ['> [D{0}PRv1-1] v? t{1}m m{2}\n'.format(1 + i % 3, i, 300 + i) for i in range(200)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(pipeline.run(ListObtainer(lines)))
+
+    assert len(threads) == 1 and threading.get_ident() not in threads
+    assert [p.measurement for p in notified] == [300 + i for i in range(200)]
+    assert pipeline.stats()['storage']['processed'] == 200
+    manager.close()
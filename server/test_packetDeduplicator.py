@@ -0,0 +1,17 @@
+import packetDeduplicator
+from packetDeduplicator import PacketDeduplicator
+from protocolHandler import parsePacket
+
+
+def test_equal_readings_one_interval_apart_are_kept(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(packetDeduplicator.time, 'monotonic', lambda: now[0])
+    deduplicator = PacketDeduplicator()
+    line = '> [D1PRv1-1] v? t2h m300\n'  # time reported in hours, so readings within the hour look the same
+
+    assert not deduplicator.isDuplicate(parsePacket(line))
+    now[0] += 0.5  # a retransmission or a second receiver
+    assert deduplicator.isDuplicate(parsePacket(line))
+    now[0] += 55  # the next reading of a device on the 1-minute interval, a bit early
+    assert not deduplicator.isDuplicate(parsePacket(line))
+    assert deduplicator.dropped == 1
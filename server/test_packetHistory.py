@@ -0,0 +1,43 @@
+import contextlib, io
+import pytest
+from deviceManager import DeviceManager
+from packetHistory import PacketHistory
+from protocolHandler import parsePacket
+from remoteDevice import RemoteDevice, RemotePacketError, RemotePacketMeasurement
+
+POISON = '> [D1PRv1-1] v? t0m m99999999999\n'
+
+
+def columnLengths(history: PacketHistory):
+    return {name: len(getattr(history, name)) for name in
+            ('timestamps', 'types', 'protocolVersions', 'deviceTimeStamps', 'measurements', 'voltages')}
+
+
+def test_out_of_range_values_are_parse_errors():
+    assert type(parsePacket(POISON)) == RemotePacketError
+    assert type(parsePacket('> [D1PRv1-1] v? t99999999999h m300\n')) == RemotePacketError
+    assert type(parsePacket('> [D99999999999PRv1-1] v? t0m m300\n')) == RemotePacketError
+
+
+def test_append_out_of_range_leaves_columns_aligned():
+    history = PacketHistory(RemoteDevice(1))
+    history.append(RemotePacketMeasurement(RemoteDevice(1), 1, 1, measurement=300, deviceTimeStamp=5))
+    with pytest.raises(ValueError):
+        history.append(RemotePacketMeasurement(RemoteDevice(1), 1, 1, measurement=99999999999, deviceTimeStamp=7))
+    history.append(RemotePacketMeasurement(RemoteDevice(1), 1, 1, measurement=310, deviceTimeStamp=9))
+
+    assert set(columnLengths(history).values()) == {2}
+    assert [(p.measurement, p.deviceTimeStamp) for p in history.packets()] == [(300, 5), (310, 9)]
+
+
+def test_poison_packet_does_not_corrupt_device_history():
+    manager = DeviceManager('', duplicateWindow=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager.handleMessageReceived('> [D1PRv1-1] v? t5m m300\n')
+        assert type(manager.handleMessageReceived(POISON)) == RemotePacketError
+        manager.handleMessageReceived('> [D1PRv1-1] v? t9m m310\n')
+
+    history = manager.devices[RemoteDevice(1)].history
+    assert set(columnLengths(history).values()) == {2}
+    assert [(p.measurement, p.deviceTimeStamp) for p in history.packets()] == [(300, 5), (310, 9)]
+    assert manager.devices[RemoteDevice(1)].count == 2
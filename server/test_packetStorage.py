@@ -0,0 +1,100 @@
+import contextlib, io, pickle, threading, zlib
+from deviceManager import DeviceManager
+from remoteDevice import RemoteDevice, RemotePacketError, RemotePacketMeasurement
+
+
+def test_every_backend_rejects_out_of_range_packet(tmp_path):
+    for filename in ('', str(tmp_path / 'db.pickle'), str(tmp_path / 'db.sqlite')):
+        manager = DeviceManager(filename, duplicateWindow=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager.handleMessageReceived('> [D1PRv1-1] v? t5m m300\n')
+            packet = manager.handleMessageReceived('> [D1PRv1-1] v? t0m m99999999999\n')
+        assert type(packet) == RemotePacketError
+        assert manager.devices[RemoteDevice(1)].count == 1
+        manager.close()
+
+
+def test_journal_replay_skips_records_that_cannot_be_applied(tmp_path):
+    filename = str(tmp_path / 'db.pickle')
+    manager = DeviceManager(filename, duplicateWindow=0)
+    manager.storage.fsync = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager.handleMessageReceived('> [D1PRv1-1] v? t5m m300\n')
+    # journaled by an older version without validation, then the server crashed without close()
+    payload = pickle.dumps(RemotePacketMeasurement(RemoteDevice(1), 1, 1, measurement=99999999999, deviceTimeStamp=7))
+    manager.storage._journal.write(manager.storage.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager.handleMessageReceived('> [D1PRv1-1] v? t9m m310\n')
+
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        restarted = DeviceManager(filename, duplicateWindow=0)
+    assert 'Skipping journal record' in output.getvalue()
+    entry = restarted.devices[RemoteDevice(1)]
+    assert entry.count == 2
+    assert [(p.measurement, p.deviceTimeStamp) for p in entry.history.packets()] == [(300, 5), (310, 9)]
+    restarted.close()
+
+
+def fillJournal(filename: str, lines):
+    manager = DeviceManager(filename, duplicateWindow=0)
+    manager.storage.fsync = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        for line in lines:
+            manager.handleMessageReceived(line)
+    manager.close()
+    return DeviceManager(filename, duplicateWindow=0)
+
+
+def test_journal_keeps_decoded_histories_until_compaction(tmp_path):
+    lines = ['> [D{0}PRv1-1] v? t{1}m m{2}\n'.format(device, i, 300 + i) for i in range(100) for device in (1, 2, 3)]
+    manager = fillJournal(str(tmp_path / 'db.pickle'), lines)
+    storage = manager.storage
+    storage.cacheRows = 250
+
+    first = storage._historyParts(RemoteDevice(1))[0]
+    assert storage._historyParts(RemoteDevice(1))[0] is first  # decoded once
+    assert len(manager.devices[RemoteDevice(1)].history) == 100
+    storage._historyParts(RemoteDevice(2))
+    storage._historyParts(RemoteDevice(3))  # over cacheRows, the least recently used one is dropped
+    assert list(storage._decoded) == [RemoteDevice(2), RemoteDevice(3)] and storage._decodedRows == 200
+
+    storage.compact(manager.devices)
+    assert not storage._decoded and storage._decodedRows == 0
+    assert len(manager.devices[RemoteDevice(1)].history) == 100
+    manager.close()
+
+
+def test_journal_range_query_spans_snapshot_and_tail(tmp_path):
+    lines = ['> [D1PRv1-1] v? t{0}m m{1}\n'.format(i, 300 + i) for i in range(50)]
+    manager = fillJournal(str(tmp_path / 'db.pickle'), lines)
+    manager.storage.fsync = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(50, 60):  # journaled after the snapshot
+            manager.handleMessageReceived('> [D1PRv1-1] v? t{0}m m{1}\n'.format(i, 300 + i))
+
+    entry = manager.devices[RemoteDevice(1)]
+    packets = entry.history.packets()
+    since, until = packets[45].timestamp, packets[55].timestamp
+    assert [p.measurement for p in entry.measurementsBetween(since, until)] == \
+           [p.measurement for p in packets if since <= p.timestamp < until]
+    manager.close()
+
+
+def test_sqlite_is_written_by_a_single_thread(tmp_path):
+    manager = DeviceManager(str(tmp_path / 'db.sqlite'), duplicateWindow=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager.handleMessageReceived('> [D1PRv1-1] v? t5m m300\n')
+    errors = []
+    def appendElsewhere():
+        try:
+            manager.storage.append(RemotePacketMeasurement(RemoteDevice(1), 1, 1, measurement=310, deviceTimeStamp=9))
+        except RuntimeError as e:
+            errors.append(e)
+    thread = threading.Thread(target=appendElsewhere)
+    thread.start()
+    thread.join()
+
+    assert len(errors) == 1
+    assert manager.storage._writerThread == threading.get_ident()
+    assert [p.measurement for p in manager.devices[RemoteDevice(1)].measurementsBetween()] == [300]
+    manager.close()
@@ -0,0 +1,53 @@
+import contextlib, http.client, io, json
+from benchmarkSuite import fleetLines
+from deviceManager import DeviceManager
+from queryApi import QueryApi, measurementJson
+from remoteDevice import RemoteDevice
+
+
+def get(api: QueryApi, path: str):
+    connection = http.client.HTTPConnection(*api.server.server_address, timeout=10)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+
+def test_measurements_are_streamed_lazily_from_every_backend(tmp_path):
+    lines = fleetLines(3, 1500, 0)
+    for filename in ('', str(tmp_path / 'db.pickle'), str(tmp_path / 'db.sqlite')):
+        manager = DeviceManager(filename, duplicateWindow=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, line in enumerate(lines):
+                manager.handleMessageReceived(line)
+                if i == len(lines) // 2 and hasattr(manager.storage, 'compact'):
+                    manager.storage.compact(manager._devices)  # the journal answers from the snapshot and the tail
+        api = QueryApi(manager, 0, chunkRows=100, cacheMaxBytes=0)
+
+        expected = [measurementJson(p) for p in manager.devices[RemoteDevice(1)].measurementsBetween()]
+        response, body = get(api, '/devices/1/measurements')
+        assert response.status == 200 and response.getheader('Transfer-Encoding') == 'chunked'
+        assert len(expected) > 200 and json.loads(body) == expected
+        response, body = get(api, '/devices/1/measurements?since=0&until=1')
+        assert response.getheader('Content-Length') and json.loads(body) == []
+        api.stop()
+        manager.close()
+
+
+def test_unexpected_errors_are_answered_with_500(tmp_path):
+    manager = DeviceManager('', duplicateWindow=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager.handleMessageReceived('> [D1PRv1-1] v? t5m m300\n')
+    api = QueryApi(manager, 0)
+    def broken(*args):
+        raise RuntimeError('broken')
+    manager.deviceRollups = broken
+
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        response, body = get(api, '/devices/1/measurements?resolution=3600')
+    assert response.status == 500 and json.loads(body) == {'error': 'Internal error'}
+    assert 'broken' in output.getvalue()
+    response, body = get(api, '/devices/1')  # the server keeps answering
+    assert response.status == 200 and json.loads(body)['count'] == 1
+    api.stop()
@@ -0,0 +1,39 @@
+import datetime as dt, threading
+from packetHistory import PacketHistory
+from remoteDevice import RemoteDevice, RemotePacketMeasurement
+from timeSeries import RollupStore
+
+
+def measurement(device: int, value: int, minute: int) -> RemotePacketMeasurement:
+    return RemotePacketMeasurement(RemoteDevice(device), 1, 1, measurement=value, deviceTimeStamp=minute,
+                                   datetime=dt.datetime(2022, 1, 1) + dt.timedelta(minutes=minute))
+
+
+def test_build_holds_up_neither_ingest_nor_loses_its_packets():
+    histories = {RemoteDevice(d): PacketHistory(RemoteDevice(d)) for d in (1, 2)}
+    building, release = threading.Event(), threading.Event()
+    def historyOf(device):
+        history = PacketHistory(device)
+        history.extend(histories[device])  # a copy, as the persistent backends return
+        building.set()
+        release.wait(5)
+        return history
+    store = RollupStore(historyOf)
+    def ingest(packet):
+        histories[packet.remoteDevice].append(packet)
+        store.add(packet, len(histories[packet.remoteDevice]) - 1)
+
+    ingest(measurement(1, 300, 0))
+    reader = threading.Thread(target=lambda: store.rollups(RemoteDevice(1), 3600))
+    reader.start()
+    assert building.wait(5)
+    ingest(measurement(1, 310, 1))  # while the device is being built
+    ingest(measurement(2, 500, 1))
+    assert reader.is_alive()
+    release.set()
+    reader.join()
+
+    rollups = store.rollups(RemoteDevice(1), 3600)
+    assert [(r.count, r.measurementMin, r.measurementMax) for r in rollups] == [(2, 300, 310)]
+    ingest(measurement(1, 290, 2))
+    assert store.rollups(RemoteDevice(1), 300)[0].count == 3
@@ -0,0 +1,245 @@
+import datetime as dt, threading
+import numpy as np
+from array import array
+from bisect import bisect_left
+from collections.abc import Callable
+from typing import Dict, List, Tuple
+from remoteDevice import RemoteDevice, RemotePacket, RemotePacketMeasurement
+from packetHistory import PacketHistory
+
+ROLLUP_RESOLUTIONS = (5 * 60, 60 * 60, 24 * 60 * 60)  # seconds, buckets are aligned to UTC
+
+
+class Rollup:
+    """ Aggregates of the measurements within [start, start + resolution), unknown voltages (0) are skipped """
+    __slots__ = ('start', 'count', 'measurementMin', 'measurementMax', 'measurementMean', 'measurementLast',
+                 'voltageCount', 'voltageMin', 'voltageMax', 'voltageMean', 'voltageLast')
+
+    def __init__(self, start: dt.datetime, count: int, measurementMin: int, measurementMax: int, measurementMean: float,
+                 measurementLast: int, voltageCount: int, voltageMin: int, voltageMax: int, voltageMean: float,
+                 voltageLast: int):
+        self.start: dt.datetime = start
+        self.count: int = count
+        self.measurementMin: int = measurementMin
+        self.measurementMax: int = measurementMax
+        self.measurementMean: float = measurementMean
+        self.measurementLast: int = measurementLast
+        self.voltageCount: int = voltageCount  # measurements with a known voltage
+        self.voltageMin: int = voltageMin
+        self.voltageMax: int = voltageMax
+        self.voltageMean: float = voltageMean
+        self.voltageLast: int = voltageLast
+
+    def __str__(self):
+        return '{0} n{1} m[{2} .. {3}] ~{4:.1f} last {5}'.format(self.start, self.count, self.measurementMin,
+                                                                 self.measurementMax, self.measurementMean,
+                                                                 self.measurementLast)
+
+
+class RollupSeries:
+    """ Buckets of a single device and resolution stored column-wise, ordered by their start """
+    COLUMNS = (('starts', 'd'), ('lastTimestamps', 'd'), ('counts', 'q'), ('measurementMins', 'i'),
+               ('measurementMaxs', 'i'), ('measurementSums', 'q'), ('measurementLasts', 'i'), ('voltageCounts', 'q'),
+               ('voltageMins', 'i'), ('voltageMaxs', 'i'), ('voltageSums', 'q'), ('voltageLasts', 'i'),
+               ('voltageTimestamps', 'd'))
+
+    def __init__(self, resolution: int):
+        self.resolution: int = resolution
+        self.columns: Dict[str, array] = {name: array(code) for name, code in self.COLUMNS}
+        self.rows: int = 0  # history rows aggregated by fromHistory
+
+    def __len__(self) -> int:
+        return len(self.columns['starts'])
+
+    @classmethod
+    def fromHistory(cls, history: PacketHistory, resolution: int) -> 'RollupSeries':
+        """ Aggregates the measurements of the history in a few vectorized passes """
+        series = cls(resolution)
+        # Columns are copied up to the rows complete by now: the ingest thread may be appending to them, which
+        # a buffer exported to numpy would not allow
+        series.rows = rows = len(history)
+        types = np.frombuffer(history.types[:rows], dtype=np.int8) if rows else np.empty(0, np.int8)
+        selected = np.flatnonzero(types == 1)
+        if not len(selected):
+            return series
+        timestamps = np.frombuffer(history.timestamps[:rows], dtype=np.float64)[selected]
+        measurements = np.frombuffer(history.measurements[:rows], dtype=np.int32)[selected].astype(np.int64)
+        voltages = np.frombuffer(history.voltages[:rows], dtype=np.int32)[selected].astype(np.int64)
+        starts = np.floor(timestamps / resolution) * resolution
+        order = np.lexsort((timestamps, starts))  # by bucket, then chronologically within the bucket
+        timestamps, measurements, voltages, starts = timestamps[order], measurements[order], voltages[order], starts[order]
+
+        bounds = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+        lasts = np.r_[bounds[1:], len(starts)] - 1
+        known = voltages != 0
+        voltageCounts = np.add.reduceat(known.astype(np.int64), bounds)
+        lastKnown = np.maximum.reduceat(np.where(known, np.arange(len(voltages)), -1), bounds)
+        iinfo = np.iinfo(np.int32)
+        values = {
+            'starts': starts[bounds],
+            'lastTimestamps': timestamps[lasts],
+            'counts': np.diff(np.r_[bounds, len(starts)]),
+            'measurementMins': np.minimum.reduceat(measurements, bounds),
+            'measurementMaxs': np.maximum.reduceat(measurements, bounds),
+            'measurementSums': np.add.reduceat(measurements, bounds),
+            'measurementLasts': measurements[lasts],
+            'voltageCounts': voltageCounts,
+            'voltageMins': np.where(voltageCounts > 0, np.minimum.reduceat(np.where(known, voltages, iinfo.max), bounds), 0),
+            'voltageMaxs': np.maximum.reduceat(np.where(known, voltages, 0), bounds),
+            'voltageSums': np.add.reduceat(voltages, bounds),
+            'voltageLasts': np.where(lastKnown >= 0, voltages[np.maximum(lastKnown, 0)], 0),
+            'voltageTimestamps': np.where(lastKnown >= 0, timestamps[np.maximum(lastKnown, 0)], 0),
+        }
+        for name, code in cls.COLUMNS:
+            series.columns[name] = array(code, values[name].astype(np.float64 if code == 'd' else np.int64).tolist())
+        return series
+
+    def add(self, timestamp: float, measurement: int, voltage: int) -> None:
+        c = self.columns
+        start = (timestamp // self.resolution) * self.resolution
+        starts = c['starts']
+        if starts and starts[-1] == start:
+            i = len(starts) - 1
+        elif not starts or starts[-1] < start:
+            for name, _ in self.COLUMNS:
+                c[name].append(0)
+            i = len(starts) - 1
+            starts[i] = start
+        else:  # clock went backwards
+            i = bisect_left(starts, start)
+            if i == len(starts) or starts[i] != start:
+                for name, _ in self.COLUMNS:
+                    c[name].insert(i, 0)
+                starts[i] = start
+
+        first = c['counts'][i] == 0
+        c['counts'][i] += 1
+        c['measurementMins'][i] = measurement if first else min(c['measurementMins'][i], measurement)
+        c['measurementMaxs'][i] = measurement if first else max(c['measurementMaxs'][i], measurement)
+        c['measurementSums'][i] += measurement
+        if first or timestamp >= c['lastTimestamps'][i]:
+            c['lastTimestamps'][i] = timestamp
+            c['measurementLasts'][i] = measurement
+        if voltage:
+            firstVoltage = c['voltageCounts'][i] == 0
+            c['voltageCounts'][i] += 1
+            c['voltageMins'][i] = voltage if firstVoltage else min(c['voltageMins'][i], voltage)
+            c['voltageMaxs'][i] = max(c['voltageMaxs'][i], voltage)
+            c['voltageSums'][i] += voltage
+            if firstVoltage or timestamp >= c['voltageTimestamps'][i]:
+                c['voltageTimestamps'][i] = timestamp
+                c['voltageLasts'][i] = voltage
+
+    def between(self, since: dt.datetime | None = None, until: dt.datetime | None = None) -> List[Rollup]:
+        """ Buckets overlapping [since, until), any of the bounds can be omitted """
+        c = self.columns
+        starts = c['starts']
+        start = bisect_left(starts, (since.timestamp() // self.resolution) * self.resolution) if since else 0
+        stop = bisect_left(starts, until.timestamp()) if until else len(starts)
+        return [Rollup(dt.datetime.fromtimestamp(starts[i]), c['counts'][i], c['measurementMins'][i],
+                       c['measurementMaxs'][i], c['measurementSums'][i] / c['counts'][i], c['measurementLasts'][i],
+                       c['voltageCounts'][i], c['voltageMins'][i], c['voltageMaxs'][i],
+                       c['voltageSums'][i] / c['voltageCounts'][i] if c['voltageCounts'][i] else 0,
+                       c['voltageLasts'][i])
+                for i in range(start, stop)]
+
+
+class RollupStore:
+    """ 5-minute, hourly and daily rollups of the measurements of every device.
+
+        The rollups of a device are built from its history when they are requested for the first time and are
+        updated with each packet afterwards, so range queries over long periods touch a bucket per resolution
+        step instead of every measurement.
+
+        Each device has a lock of its own, so packets of other devices never wait for a build, and the build
+        itself runs without it: packets arriving meanwhile are set aside and aggregated right before the series
+        are published.
+    """
+    def __init__(self, historyOf: Callable[[RemoteDevice], PacketHistory]):
+        self.historyOf: Callable[[RemoteDevice], PacketHistory] = historyOf
+        self._lock = threading.Lock()  # guards the creation of the device locks
+        self._locks: Dict[RemoteDevice, Tuple[threading.Lock, threading.Lock]] = dict()  # series lock, build lock
+        self._series: Dict[RemoteDevice, Dict[int, RollupSeries]] = dict()
+        self._pending: Dict[RemoteDevice, List[Tuple[int, float, int, int]]] = dict()  # rows added during a build
+
+    def add(self, packet: RemotePacket, row: int) -> None:
+        """ Called once the packet has been stored as the row of its device history, devices not queried yet
+            pick it up from their history
+        """
+        if type(packet) != RemotePacketMeasurement:
+            return
+        timestamp = packet.timestamp.timestamp()
+        with self._deviceLocks(packet.remoteDevice)[0]:
+            series = self._series.get(packet.remoteDevice)
+            if series is None:
+                pending = self._pending.get(packet.remoteDevice)
+                if pending is not None:
+                    pending.append((row, timestamp, packet.measurement, packet.voltage))
+                return
+            for rollup in series.values():
+                if row >= rollup.rows:  # not aggregated already when the series was built
+                    rollup.add(timestamp, packet.measurement, packet.voltage)
+
+    def rollups(self, device: RemoteDevice, resolution: int, since: dt.datetime | None = None,
+                until: dt.datetime | None = None) -> List[Rollup]:
+        if resolution not in ROLLUP_RESOLUTIONS:
+            raise ValueError('Unsupported rollup resolution: {0}s'.format(resolution))
+        lock, buildLock = self._deviceLocks(device)
+        with lock:
+            series = self._series.get(device)
+        if series is None:
+            series = self._build(device, lock, buildLock)
+        with lock:
+            return series[resolution].between(since, until)
+
+    def _deviceLocks(self, device: RemoteDevice) -> Tuple[threading.Lock, threading.Lock]:
+        locks = self._locks.get(device)
+        if locks is None:
+            with self._lock:
+                locks = self._locks.setdefault(device, (threading.Lock(), threading.Lock()))
+        return locks
+
+    def _build(self, device: RemoteDevice, lock: threading.Lock, buildLock: threading.Lock) -> Dict[int, RollupSeries]:
+        """ Builds and publishes the series of the device, holding only its build lock while aggregating """
+        with buildLock:  # concurrent readers of the device wait for a single build
+            with lock:
+                series = self._series.get(device)
+                if series is not None:
+                    return series
+                self._pending[device] = []
+            try:
+                history = self.historyOf(device)
+                series = {r: RollupSeries.fromHistory(history, r) for r in ROLLUP_RESOLUTIONS}
+            except BaseException:
+                with lock:
+                    del self._pending[device]
+                raise
+            with lock:
+                for row, timestamp, measurement, voltage in self._pending.pop(device):
+                    for rollup in series.values():
+                        if row >= rollup.rows:
+                            rollup.add(timestamp, measurement, voltage)
+                self._series[device] = series
+            return series
+
+
+def lttb(x: List[float], y: List[float], threshold: int) -> Tuple[List[float], List[float]]:
+    """ Largest-Triangle-Three-Buckets downsampling of a series sorted by x to threshold points.
+
+        Keeps the first and the last point, and from each of the buckets in between the point forming the largest
+        triangle with the point kept from the previous bucket and the average of the next bucket.
+    """
+    if threshold >= len(x) or threshold < 3:
+        return list(x), list(y)
+    xs, ys = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    edges = np.floor(np.linspace(1, len(xs) - 1, threshold - 1)).astype(np.int64)
+    selected = [0]
+    for b in range(threshold - 2):
+        start, stop = edges[b], edges[b + 1]
+        nextStop = edges[b + 2] if b + 2 < len(edges) else len(xs)
+        nextX, nextY = xs[stop:nextStop].mean(), ys[stop:nextStop].mean()
+        ax, ay = xs[selected[-1]], ys[selected[-1]]
+        areas = np.abs((ax - nextX) * (ys[start:stop] - ay) - (ax - xs[start:stop]) * (nextY - ay))
+        selected.append(start + int(np.argmax(areas)))
+    selected.append(len(xs) - 1)
+    return [x[i] for i in selected], [y[i] for i in selected]
@@ -1,34 +1,90 @@
-import sys
-import glob
+import re, threading, time
 import serial
+from serial.tools import list_ports
+from serial.tools.list_ports_common import ListPortInfo
+from collections.abc import Callable
+from typing import Dict, List, Tuple
 
-def listSerialPorts():
+# Printed by the receiver firmware at boot (opening the port resets an Arduino), older firmware is recognized
+# by its regular output
+RECEIVER_BANNER = re.compile(rb'\[RF\] Moistensor receiver|\[D\d+PRv\d+-\d+\]|\[RF\] |\[PR\] ')
+
+_portInfos: Tuple[float, List[ListPortInfo]] | None = None  # (monotonic time, ports) of the latest enumeration
+_portInfosLock = threading.Lock()
+
+
+def serialPortInfos(maxAge: float = 2) -> List[ListPortInfo]:
+    """ Serial ports with their USB metadata (vendor/product id, serial number, location) as reported by the OS
+        (sysfs on Linux), none of the ports is opened. The list is reused for maxAge seconds
+    """
+    global _portInfos
+    with _portInfosLock:
+        if _portInfos is None or time.monotonic() - _portInfos[0] > maxAge:
+            _portInfos = (time.monotonic(), sorted(list_ports.comports(), key=lambda info: info.device))
+        return _portInfos[1]
+
+
+def portIdentifier(info: ListPortInfo) -> str:
+    """ Identifier of the port that survives re-enumeration: 'usb:<vid>:<pid>:<serial number>' or, for adapters
+        without a serial number, 'usb:<vid>:<pid>@<usb location>'. Device name for the other ports
+    """
+    if info.vid is None:
+        return info.device
+    if info.serial_number:
+        return 'usb:{0:04x}:{1:04x}:{2}'.format(info.vid, info.pid, info.serial_number)
+    return 'usb:{0:04x}:{1:04x}@{2}'.format(info.vid, info.pid, info.location)
+
+
+def resolvePort(port: str, maxAge: float = 2) -> str | None:
+    """ Device name of the port given by its device name, identifier or USB serial number, None if not connected """
+    for info in serialPortInfos(maxAge):
+        if port.lower() in (info.device.lower(), portIdentifier(info).lower()) or port == info.serial_number:
+            return info.device
+    return None
+
+
+def listSerialPorts(probe: bool = False, timeout: float = 1) -> List[str]:
     """ Lists serial port names
 
-        :raises EnvironmentError:
-            On unsupported or unknown platforms
+        :param probe: keep only the ports that can be opened, they are probed in parallel and the ones not opened
+            within timeout seconds are skipped
         :returns:
             A list of the serial ports available on the system
+    """
+    ports = [info.device for info in serialPortInfos()]
+    return probePorts(ports, lambda s: True, timeout) if probe else ports
 
-        Source: https://stackoverflow.com/a/14224477/5765191
+
+def probePorts(ports: List[str], check: Callable[[serial.Serial], bool], timeout: float, baudrate: int = 115200) -> List[str]:
+    """ Opens every port in a daemon thread of its own and keeps the ones passing the check within timeout seconds,
+        so a hanging tty delays discovery by timeout at most
     """
-    if sys.platform.startswith('win'):
-        ports = ['COM%s' % (i + 1) for i in range(256)]
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob('/dev/tty[A-Za-z]*')
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
-    else:
-        raise EnvironmentError('Unsupported platform')
-    # return ports
-
-    result = []
-    for port in ports:
+    results: Dict[str, bool] = dict()
+    def probe(port: str):
         try:
-            s = serial.Serial(port)
-            s.close()
-            result.append(port)
-        except (OSError, serial.SerialException):
-            pass
-    return result
\ No newline at end of file
+            with serial.Serial(port, baudrate, timeout=0.1) as s:
+                results[port] = check(s)
+        except (OSError, ValueError, serial.SerialException):
+            results[port] = False
+
+    threads = [threading.Thread(target=probe, args=(port,), name='probe ' + port, daemon=True) for port in ports]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    return [port for port in ports if results.get(port)]
+
+
+def detectReceivers(ports: List[str] | None = None, timeout: float = 3, baudrate: int = 115200,
+                    banner: re.Pattern = RECEIVER_BANNER) -> List[str]:
+    """ Ports among the given (all by default) where a Moistensor receiver prints banner within timeout seconds """
+    def check(s: serial.Serial) -> bool:
+        deadline = time.monotonic() + timeout
+        received = b''
+        while time.monotonic() < deadline:
+            received = received[-256:] + s.read(max(1, s.in_waiting))
+            if banner.search(received):
+                return True
+        return False
+    return probePorts(ports if ports is not None else listSerialPorts(), check, timeout + 1, baudrate)
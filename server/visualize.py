@@ -1,72 +1,39 @@
-import re, numpy as np, datetime as dt, io
+import numpy as np, io
 import matplotlib, matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter
-from protocolHandler import parseMessage
+from logIngest import readLogFile
 matplotlib.use('Qt5Agg')
 
 FILTEROUT_OUTDATED_CALIBRATIONS = False
 
-def parseLogFile(path: str, devices: list = None) -> set:
-    data = dict()
-
-    reTimeStamp = re.compile('^\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2}\.\d{1,6}\t')
-    with open(path) as file:
-        for line in file:
-            curTimeStamp = reTimeStamp.search(line)
-            if curTimeStamp:
-                line = line[len(curTimeStamp.group()):]
-                curTimeStamp = dt.datetime.strptime(curTimeStamp.group().strip(), '%Y-%m-%d %H:%M:%S.%f')
-            else:
-                curTimeStamp = None
-            packet = parseMessage(line)
-            if not packet or 'error' in packet:
-                continue
-            try:
-                device = packet['device']
-                if devices and not (device in devices):
-                    continue
-                if not (device in data):
-                    data[device] = []
-                entry = {
-                    'timestamp': curTimeStamp,
-                    'packetType': packet['packetType'],
-                    **packet['body']
-                }
-                data[device].append(entry)
-            except:
-                continue
-    return data if len(data) else None
-
 FILEPATH = 'data/test.txt'
 
-data = parseLogFile(FILEPATH)
+data = readLogFile(FILEPATH)
 if not len(data):
     print('No devices loaded! Check your data file!')
 
 
-for i, (dev, val) in enumerate(data.items()):
-    data[dev] = sorted(val, key=lambda d: d['timestamp'])
-    calibs = [(v, i) for i, v in enumerate(val) if v['packetType'] == 2]
+for i, (dev, columns) in enumerate(data.items()):
+    order = np.argsort(columns['timestamp'], kind='stable')
+    columns = {name: column[order] for name, column in columns.items()}
+    measurements = columns['packetType'] == 1
+    calibs = np.flatnonzero(columns['packetType'] == 2)
     if not len(calibs):
         print('No calibration entries for device#{0}'.format(dev))
-        data[dev] = ([e for e in data[dev] if e['packetType'] == 1], None)
+        data[dev] = ({name: column[measurements] for name, column in columns.items()}, None)
         continue
-    calibration = calibs[0][0]
-    startIndex = calibs[0][-1]
+    startIndex = calibs[0]
     if FILTEROUT_OUTDATED_CALIBRATIONS:  # Sort out all entries with the outdated calibration
-        calibs.reverse()
-        lCalibIdx = 0  # last calibration index
-        for j, c in enumerate(calibs):
-            if c[0]['calibrDry'] != calibs[lCalibIdx][0]['calibrDry'] or c[0]['calibrWet'] != calibs[lCalibIdx][0]['calibrWet']:
-                break
-            lCalibIdx = j
-        calibration = calibs[lCalibIdx][0]
-        startIndex = calibs[lCalibIdx][-1]
-    data[dev] = ([e for k, e in enumerate(data[dev]) if k > startIndex and e['packetType'] == 1], calibration)
+        dry, wet = columns['calibrDry'][calibs], columns['calibrWet'][calibs]
+        outdated = np.flatnonzero((dry != dry[-1]) | (wet != wet[-1]))
+        startIndex = calibs[outdated[-1] + 1 if len(outdated) else 0]
+    calibration = {name: column[startIndex] for name, column in columns.items()}
+    selected = measurements & (np.arange(len(order)) > startIndex)
+    data[dev] = ({name: column[selected] for name, column in columns.items()}, calibration)
 
 for (dev, (l, calibr)) in data.items():
-    x = [e['timestamp'] for e in l]
-    y = [e['measurement'] for e in l]
+    x = l['timestamp']
+    y = l['measurement']
     fig, ax = plt.subplots()
     ax.plot(x, y)
 